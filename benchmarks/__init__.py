@@ -0,0 +1 @@
+"""Benchmarks for the export server. See `benchmarks/README.md`."""
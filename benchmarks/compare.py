@@ -0,0 +1,88 @@
+"""Compares two benchmark result files, as written by `benchmarks.run`.
+
+Usage:
+    python -m benchmarks.compare before.json after.json
+"""
+
+import argparse
+import json
+
+# metrics compared, and whether higher is better
+METRICS = {
+    "cold": False,
+    "warm": False,
+    "rows_per_s": True,
+    "output_mb_per_s": True,
+    "peak_rss": False,
+}
+
+
+def load(path: str) -> dict:
+    """Loads a result file, keyed by scenario."""
+    with open(path) as f:
+        report = json.load(f)
+    return report["meta"], {r["scenario"]: r for r in report["results"]}
+
+
+def compare(before: dict, after: dict, threshold: float = 0.05) -> list[dict]:
+    """Compares results of each scenario present in both runs.
+
+    Args:
+        before: results by scenario of the baseline run
+        after: results by scenario of the new run
+        threshold: relative change beyond which a metric is flagged
+
+    Returns:
+        One row per scenario and metric, with the ratio of new to baseline and
+        a verdict of `better`, `worse` or `same`.
+    """
+    rows = []
+    for scenario in before.keys() & after.keys():
+        for metric, higher in METRICS.items():
+            old, new = before[scenario].get(metric), after[scenario].get(
+                metric)
+            if not old or new is None:
+                continue
+            ratio = new / old
+            verdict = "same"
+            if abs(ratio - 1) > threshold:
+                verdict = "better" if (ratio > 1) == higher else "worse"
+            rows.append(
+                dict(scenario=scenario,
+                     metric=metric,
+                     before=old,
+                     after=new,
+                     ratio=ratio,
+                     verdict=verdict))
+    return sorted(rows, key=lambda r: (r["scenario"], r["metric"]))
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold",
+                        type=float,
+                        default=0.05,
+                        help="relative change to flag")
+    parser.add_argument("--json",
+                        action="store_true",
+                        help="print rows as JSON instead of a table")
+    args = parser.parse_args(argv)
+
+    before_meta, before = load(args.before)
+    after_meta, after = load(args.after)
+    rows = compare(before, after, args.threshold)
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"before: {before_meta.get('commit')}  after: {after_meta.get('commit')}")
+    print(f"{'scenario':<16}{'metric':<18}{'before':>14}{'after':>14}"
+          f"{'ratio':>8}  verdict")
+    for row in rows:
+        print(f"{row['scenario']:<16}{row['metric']:<18}{row['before']:>14.4g}"
+              f"{row['after']:>14.4g}{row['ratio']:>8.3f}  {row['verdict']}")
+
+
+if __name__ == "__main__":
+    main()
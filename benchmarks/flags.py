@@ -0,0 +1,104 @@
+"""Micro-benchmarks the flag check kernels of carton/mapper filters.
+
+Times `check_flags_packed`, which tests packed `uint64` words, against the
+byte-wise `np.bitwise_and(flags, filters).any(axis=1)` scan it replaces. Both
+run over synthetic `sdss5_target_flags` in chunks, as vaex would pass them, for
+selections from one bit to every bit.
+
+Usage:
+    python -m benchmarks.flags --rows 10000000
+"""
+
+import argparse
+import json
+import sys
+from time import perf_counter
+
+import numpy as np
+
+from sdss_explorer.util.filters import check_flags_packed
+
+from .generate import NBITS, NFLAGS
+
+# bits selected by each scenario
+SELECTIONS = {
+    "one_bit": [3],
+    "two_cartons": [3, 250],
+    "eight_bytes": list(range(0, NFLAGS * NBITS, NFLAGS)),
+    "one_mapper": list(range(0, NFLAGS * NBITS, 2)),
+    "all_bits": list(range(NFLAGS * NBITS)),
+}
+
+
+def make_flags(rng: np.random.Generator, n: int) -> np.ndarray:
+    """Generates flags with about 1.5 bits set per row, mostly in the first bytes."""
+    flags = np.zeros((n, NFLAGS), dtype=np.uint8)
+    rows = rng.integers(0, n, int(1.5 * n))
+    bits = (rng.pareto(1.2, len(rows)) * 8).astype(np.int64) % (NFLAGS * NBITS)
+    np.bitwise_or.at(flags, (rows, bits // NBITS),
+                     (1 << (bits % NBITS)).astype(np.uint8))
+    return flags
+
+
+def make_filters(bits: list[int]) -> np.ndarray:
+    filters = np.zeros(NFLAGS, dtype=np.uint8)
+    for bit in bits:
+        filters[bit // NBITS] |= 1 << (bit % NBITS)
+    return filters
+
+
+def scan(flags: np.ndarray, filters: np.ndarray) -> np.ndarray:
+    return np.bitwise_and(flags, filters).any(axis=1)
+
+
+def time_kernel(kernel, flags: np.ndarray, filters: np.ndarray,
+                chunk_size: int, repeat: int) -> tuple[float, int]:
+    """Best time of `repeat` runs over all chunks, and the rows matched."""
+    best = np.inf
+    for _ in range(repeat):
+        start = perf_counter()
+        matched = 0
+        for i in range(0, len(flags), chunk_size):
+            matched += int(kernel(flags[i:i + chunk_size], filters).sum())
+        best = min(best, perf_counter() - start)
+    return best, matched
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        default=1024**2,
+                        help="rows per chunk passed to a kernel")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    flags = make_flags(np.random.default_rng(args.seed), args.rows)
+    results = []
+    for name, bits in SELECTIONS.items():
+        filters = make_filters(bits)
+        before, expected = time_kernel(scan, flags, filters, args.chunk_size,
+                                       args.repeat)
+        after, matched = time_kernel(check_flags_packed, flags, filters,
+                                     args.chunk_size, args.repeat)
+        assert matched == expected, f"{name}: kernels disagree"
+        result = dict(
+            selection=name,
+            bytes=int(np.count_nonzero(filters)),
+            rows_matched=matched,
+            scan=before,
+            packed=after,
+            speedup=before / after,
+        )
+        print(json.dumps(result), file=sys.stderr, flush=True)
+        results.append(result)
+    json.dump(dict(rows=args.rows, chunk_size=args.chunk_size,
+                   results=results),
+              sys.stdout,
+              indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Generates synthetic explorer data files for benchmarking.
+
+Writes files in the layout `settings.datapath` expects:
+
+    <out>/mappings.parquet
+    <out>/<release>/explorerAll<Datatype>-<vastra>.hdf5
+    <out>/<release>/columnsAll<Datatype>-<vastra>.json
+
+Rows are generated and written in chunks, then concatenated, so memory use
+stays flat up to tens of millions of rows.
+
+Usage:
+    python -m benchmarks.generate --out ./benchdata --rows 1000000
+    python -m benchmarks.generate --out ./benchdata --rows 50000000 \\
+        --datatype visit --pipelines spall=0.6,apogeenet=0.4
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import vaex as vx
+
+# number of bytes in sdss5_target_flags, and bits per byte
+NFLAGS = 57
+NBITS = 8
+
+# mapper programs, and the share of cartons in each
+MAPPERS = {"mwm": 0.6, "bhm": 0.3, "ops": 0.1}
+
+# crossmatch identifier columns, as in `util.filters.crossmatchList`
+ID_COLUMNS = (
+    "sdss_id",
+    "gaia_dr3_source_id",
+    "gaia_dr2_source_id",
+    "tic_v8_id",
+)
+
+DEFAULT_PIPELINES = {
+    "star": "aspcap=0.4,spall=0.3,mwmlite=0.2,thepayne=0.1",
+    "visit": "spall=0.6,apogeenet=0.4",
+}
+
+
+def parse_pipelines(spec: str) -> dict[str, float]:
+    """Parses a pipeline mix like `aspcap=0.5,spall=0.5` into normalized weights."""
+    weights = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    total = sum(weights.values())
+    return {name: weight / total for name, weight in weights.items()}
+
+
+def make_mappings(rng: np.random.Generator) -> pa.Table:
+    """Generates carton/mapper bit mappings, one carton per flag bit."""
+    nbits = NFLAGS * NBITS
+    mappers = rng.choice(list(MAPPERS), size=nbits, p=list(MAPPERS.values()))
+    return pa.table({
+        "bit": np.arange(nbits, dtype="int16"),
+        "mapper": mappers,
+        "program": [f"{mapper}_program_{i % 12}" for i, mapper in enumerate(mappers)],
+        "alt_name": [f"{mapper}_carton_{i}" for i, mapper in enumerate(mappers)],
+    })
+
+
+def make_chunk(rng: np.random.Generator, start: int, n: int,
+               pipelines: dict[str, float], datatype: str,
+               extra_columns: int) -> dict:
+    """Generates `n` rows starting at id `start`."""
+    # carton popularity is heavily skewed, like the real targeting
+    nbits = NFLAGS * NBITS
+    popularity = 1 / np.arange(1, nbits + 1)**1.2
+    popularity /= popularity.sum()
+    ncartons = rng.poisson(1.5, size=n).clip(0, 6)
+    flags = np.zeros((n, NFLAGS), dtype="uint8")
+    rows = np.repeat(np.arange(n), ncartons)
+    bits = rng.choice(nbits, size=len(rows), p=popularity)
+    np.bitwise_or.at(flags, (rows, bits // NBITS),
+                     (1 << (bits % NBITS)).astype("uint8"))
+
+    ids = np.arange(start, start + n, dtype="int64")
+    pipeline = rng.choice(list(pipelines), size=n, p=list(pipelines.values()))
+    data = dict(
+        pipeline=pa.array(pipeline),
+        sdss_id=ids,
+        gaia_dr3_source_id=ids * 7919 + 10**15,
+        gaia_dr2_source_id=ids * 7907 + 10**15,
+        tic_v8_id=ids * 31 + 10**8,
+        sdss4_apogee_id=pa.array([f"2M{i:014d}" for i in ids]),
+        ra=rng.uniform(0, 360, n),
+        dec=np.degrees(np.arcsin(rng.uniform(-1, 1, n))),
+        teff=rng.normal(5200, 900, n).astype("float32"),
+        logg=rng.normal(3.5, 1.0, n).astype("float32"),
+        fe_h=rng.normal(-0.2, 0.4, n).astype("float32"),
+        snr=rng.lognormal(3.5, 1.0, n).astype("float32"),
+        g_mag=rng.normal(16, 1.8, n).astype("float32"),
+        bp_mag=rng.normal(16.4, 1.8, n).astype("float32"),
+        rp_mag=rng.normal(15.5, 1.8, n).astype("float32"),
+        result_flags=(rng.random(n) < 0.2).astype("int64") *
+        rng.integers(1, 2**16, n),
+        flag_bad=rng.random(n) < 0.05,
+        zwarning_flags=(rng.random(n) < 0.1).astype("int64") *
+        rng.integers(1, 2**8, n),
+        release=pa.array(rng.choice(["sdss5", "dr17"], size=n, p=[0.8, 0.2])),
+        telescope=pa.array(
+            rng.choice(["apo25m", "lco25m", "apo1m"], size=n, p=[0.6, 0.35, 0.05])),
+    )
+    if datatype == "visit":
+        data["mjd"] = rng.integers(59000, 60500, n)
+        data["fiber"] = rng.integers(1, 500, n)
+    for i in range(extra_columns):
+        data[f"extra_{i}"] = rng.normal(0, 1, n).astype("float32")
+    return data, flags
+
+
+def generate(out: str,
+             rows: int,
+             release: str = "dr19",
+             datatype: str = "star",
+             pipelines: dict[str, float] | None = None,
+             vastra: str = "0.6.0",
+             extra_columns: int = 0,
+             chunk_size: int = 1_000_000,
+             seed: int = 42) -> str:
+    """Generates a synthetic release and returns the path of its hdf5 file."""
+    rng = np.random.default_rng(seed)
+    pipelines = pipelines or parse_pipelines(DEFAULT_PIPELINES[datatype])
+    releasedir = os.path.join(out, release)
+    partdir = os.path.join(releasedir, f".parts-{datatype}")
+    os.makedirs(partdir, exist_ok=True)
+
+    mappings = os.path.join(out, "mappings.parquet")
+    if not os.path.exists(mappings):
+        pq.write_table(make_mappings(rng), mappings)
+
+    parts = []
+    for start in range(0, rows, chunk_size):
+        n = min(chunk_size, rows - start)
+        data, flags = make_chunk(rng, start, n, pipelines, datatype,
+                                 extra_columns)
+        df = vx.from_dict(data)
+        df.add_column("sdss5_target_flags", flags)
+        part = os.path.join(partdir, f"part-{len(parts):05d}.hdf5")
+        df.export_hdf5(part)
+        parts.append(part)
+        print(f"generated {start + n}/{rows} rows", flush=True)
+
+    path = os.path.join(releasedir,
+                        f"explorerAll{datatype.capitalize()}-{vastra}.hdf5")
+    df = vx.open_many(parts)
+    df.export_hdf5(path)
+    columns = df.get_column_names()
+    df.close()
+    shutil.rmtree(partdir)
+
+    with open(
+            os.path.join(releasedir,
+                         f"columnsAll{datatype.capitalize()}-{vastra}.json"),
+            "w") as f:
+        json.dump({pipeline: columns for pipeline in pipelines}, f)
+    return path
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", required=True, help="output data path")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--release", default="dr19")
+    parser.add_argument("--datatype", choices=("star", "visit"), default="star")
+    parser.add_argument("--pipelines",
+                        help="pipeline mix, e.g. aspcap=0.5,spall=0.5")
+    parser.add_argument("--vastra", default="0.6.0")
+    parser.add_argument("--extra-columns",
+                        type=int,
+                        default=0,
+                        help="extra float columns, to widen rows")
+    parser.add_argument("--chunk-size", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+
+    path = generate(
+        args.out,
+        args.rows,
+        release=args.release,
+        datatype=args.datatype,
+        pipelines=parse_pipelines(args.pipelines) if args.pipelines else None,
+        vastra=args.vastra,
+        extra_columns=args.extra_columns,
+        chunk_size=args.chunk_size,
+        seed=args.seed,
+    )
+    print(f"wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""Load test of the export server with concurrent clients.
+
+Each client repeatedly submits a filter job drawn from a realistic mix, polls
+`/status` until it finishes, then starts another. Latencies of submission,
+polling and job completion are reported as percentiles, along with export
+process utilization and queue depth as seen from job statuses.
+
+By default the server runs in this process under uvicorn, against synthetic
+data from `benchmarks.generate`. Pass `--url` to load a separately started
+server instead, i.e. one run with several `EXPLORER_WORKERS`.
+
+Usage:
+    python -m benchmarks.generate --out ./benchdata --rows 1000000
+    python -m benchmarks.load --data ./benchdata --clients 16 --duration 60 \\
+        --nprocesses 4 --output load.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from time import perf_counter
+
+import httpx
+import numpy as np
+import pyarrow.parquet as pq
+
+from .run import git_commit
+
+# (weight, expression) of custom expressions
+EXPRESSIONS = [
+    (4, ""),
+    (2, "g_mag<17"),
+    (1, "teff<9e3&logg<2"),
+    (1, "teff<12e3&logg>4"),
+    (1, "4000<teff<5000"),
+]
+
+# (weight, flags) of quick flags
+FLAGS = [
+    (4, ""),
+    (2, "purely non-flagged"),
+    (1, "purely non-flagged,sdss5 only"),
+    (1, "snr > 50"),
+]
+
+DATASETS = {
+    "star": [(2, "aspcap"), (1, "spall"), (1, "mwmlite")],
+    "visit": [(1, "spall"), (1, "apogeenet")],
+}
+
+# statuses after which a job is no longer polled
+TERMINAL = ("complete", "failed", "cancelled")
+
+
+def choose(rng: random.Random, options: list[tuple[int, str]]) -> str:
+    weights, values = zip(*options)
+    return rng.choices(values, weights=weights)[0]
+
+
+@dataclass
+class Stats:
+    """Measurements of a load test.
+
+    Attributes:
+        submit: seconds taken by each job submission
+        poll: seconds taken by each status request
+        complete: seconds from submission to each job finishing
+        statuses: final status of each job
+        errors: failed requests, by reason
+        busy: sampled number of jobs running in export processes
+        queued: sampled number of jobs waiting for admission
+        jobs: latest status of each unfinished job
+    """
+
+    submit: list[float] = field(default_factory=list)
+    poll: list[float] = field(default_factory=list)
+    complete: list[float] = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    errors: Counter = field(default_factory=Counter)
+    busy: list[int] = field(default_factory=list)
+    queued: list[int] = field(default_factory=list)
+    jobs: dict[str, dict] = field(default_factory=dict)
+
+
+def random_request(rng: random.Random, datatype: str, cartons: list[str],
+                   mappers: list[str]) -> tuple[str, dict]:
+    """Draws a dataset and filter parameters from the request mix."""
+    dataset = choose(rng, DATASETS[datatype])
+    params = dict(expression=choose(rng, EXPRESSIONS),
+                  flags=choose(rng, FLAGS))
+    if rng.random() < 0.5:
+        params["carton"] = ",".join(rng.sample(cartons, rng.randint(0, 2)))
+    else:
+        params["mapper"] = ",".join(rng.sample(mappers, rng.randint(0, 2)))
+    return dataset, params
+
+
+def make_unique(params: dict, n: int) -> dict:
+    """Adds an always-true term to a request so it can't reuse another's export."""
+    term = f"sdss_id>-{n}"
+    expression = params["expression"]
+    return dict(params,
+                expression=f"({expression})&{term}" if expression else term)
+
+
+def percentiles(values: list[float]) -> dict:
+    """p50, p95 and p99 of values, in milliseconds."""
+    if not values:
+        return dict(n=0)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) * 1e3
+    return dict(n=len(values), p50_ms=p50, p95_ms=p95, p99_ms=p99)
+
+
+async def run_client(client: httpx.AsyncClient, rng: random.Random,
+                     args: argparse.Namespace, stats: Stats, deadline: float,
+                     counter: list[int], cartons: list[str],
+                     mappers: list[str]) -> None:
+    """Submits and polls jobs one at a time until the deadline."""
+    session = f"load-{rng.getrandbits(32):08x}"
+    while perf_counter() < deadline:
+        dataset, params = random_request(rng, args.datatype, cartons, mappers)
+        if args.unique:
+            counter[0] += 1
+            params = make_unique(params, counter[0])
+        start = perf_counter()
+        try:
+            resp = await client.post(
+                f"/filter_subset/{args.release}/{args.datatype}/{dataset}",
+                params=dict(params, columns=args.columns, session=session),
+            )
+            resp.raise_for_status()
+        except httpx.HTTPError as e:
+            stats.errors[f"submit: {type(e).__name__}"] += 1
+            continue
+        stats.submit.append(perf_counter() - start)
+        job = resp.json()
+        uid = job["uid"]
+
+        while job["status"] not in TERMINAL:
+            stats.jobs[uid] = job
+            await asyncio.sleep(args.poll_interval)
+            poll = perf_counter()
+            try:
+                resp = await client.get(f"/status/{uid}")
+                resp.raise_for_status()
+            except httpx.HTTPError as e:
+                stats.errors[f"poll: {type(e).__name__}"] += 1
+                continue
+            stats.poll.append(perf_counter() - poll)
+            job = resp.json()
+        stats.jobs.pop(uid, None)
+        stats.complete.append(perf_counter() - start)
+        stats.statuses[job["status"]] += 1
+
+
+async def sample(stats: Stats, interval: float) -> None:
+    """Samples running and queued jobs from their latest polled statuses."""
+    while True:
+        jobs = list(stats.jobs.values())
+        stats.queued.append(sum(1 for job in jobs if job["stage"] == "queued"))
+        stats.busy.append(len(jobs) - stats.queued[-1])
+        await asyncio.sleep(interval)
+
+
+async def run_load(url: str, args: argparse.Namespace) -> dict:
+    """Runs the load test against a server and summarizes it."""
+    mappings = pq.read_table(os.path.join(args.data,
+                                          "mappings.parquet")).to_pydict()
+    # the most popular cartons, as in the synthetic targeting
+    cartons = mappings["alt_name"][:20]
+    mappers = sorted(set(mappings["mapper"]))
+
+    stats = Stats()
+    counter = [0]
+    limits = httpx.Limits(max_connections=args.clients)
+    async with httpx.AsyncClient(base_url=url, timeout=60,
+                                 limits=limits) as client:
+        start = perf_counter()
+        deadline = start + args.duration
+        sampler = asyncio.create_task(sample(stats, args.poll_interval))
+        await asyncio.gather(*(run_client(client, random.Random(
+            args.seed + i), args, stats, deadline, counter, cartons, mappers)
+                               for i in range(args.clients)))
+        sampler.cancel()
+        elapsed = perf_counter() - start
+
+    slots = args.nprocesses * args.workers
+    return dict(
+        elapsed=elapsed,
+        jobs=sum(stats.statuses.values()),
+        jobs_per_s=sum(stats.statuses.values()) / elapsed,
+        statuses=dict(stats.statuses),
+        errors=dict(stats.errors),
+        submit=percentiles(stats.submit),
+        poll=percentiles(stats.poll),
+        complete=percentiles(stats.complete),
+        utilization=float(np.mean(stats.busy)) / slots if stats.busy else 0.0,
+        busy_max=max(stats.busy, default=0),
+        queue_depth_mean=float(np.mean(stats.queued)) if stats.queued else 0.0,
+        queue_depth_max=max(stats.queued, default=0),
+    )
+
+
+async def run_local(args: argparse.Namespace) -> dict:
+    """Starts the server in this process, then runs the load test against it."""
+    import uvicorn
+
+    # imported here so settings are read from the environment set by `main`
+    from sdss_explorer.server.main import app
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()  # raises why the server failed to start
+        await asyncio.sleep(0.05)
+    try:
+        return await run_load(f"http://127.0.0.1:{port}", args)
+    finally:
+        server.should_exit = True
+        await task
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data",
+                        required=True,
+                        help="data path, as written by benchmarks.generate")
+    parser.add_argument("--url",
+                        help="server to load. Defaults to one run in-process.")
+    parser.add_argument("--release", default="dr19")
+    parser.add_argument("--datatype", choices=("star", "visit"), default="star")
+    parser.add_argument("--vastra", default="0.6.0")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration",
+                        type=float,
+                        default=30,
+                        help="seconds to submit jobs for")
+    parser.add_argument("--poll-interval", type=float, default=0.25)
+    parser.add_argument("--columns",
+                        default="",
+                        help="comma-separated columns to export")
+    parser.add_argument("--nprocesses",
+                        type=int,
+                        default=2,
+                        help="export processes per server worker")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=1,
+                        help="server workers, when loading `--url`")
+    parser.add_argument(
+        "--unique",
+        action="store_true",
+        help="make every request unique, so no job reuses another's export")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="results file. Defaults to stdout.")
+    args = parser.parse_args(argv)
+
+    if args.url:
+        results = asyncio.run(run_load(args.url, args))
+    else:
+        args.workers = 1
+        scratch = tempfile.mkdtemp(prefix="explorer-load-")
+        os.environ.update(
+            EXPLORER_DATAPATH=os.path.abspath(args.data),
+            EXPLORER_SCRATCH=scratch,
+            EXPLORER_JOBSTORE="memory",
+            EXPLORER_NPROCESSES=str(args.nprocesses),
+            VASTRA=args.vastra,
+        )
+        results = asyncio.run(run_local(args))
+
+    report = dict(
+        meta=dict(
+            commit=git_commit(),
+            timestamp=datetime.now(timezone.utc).isoformat(),
+            cpus=os.cpu_count(),
+            url=args.url,
+            release=args.release,
+            datatype=args.datatype,
+            clients=args.clients,
+            duration=args.duration,
+            nprocesses=args.nprocesses,
+            workers=args.workers,
+            unique=args.unique,
+        ),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
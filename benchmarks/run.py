@@ -0,0 +1,209 @@
+"""Runs export benchmark scenarios against a synthetic dataset.
+
+Each scenario runs `filter_dataframe` in a fresh process: once cold, with an
+empty dataframe cache, then `--repeat` times warm. Results are written as JSON
+so runs can be compared across commits with `benchmarks.compare`.
+
+Usage:
+    python -m benchmarks.generate --out ./benchdata --rows 1000000
+    python -m benchmarks.run --data ./benchdata --output results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+from time import perf_counter
+from uuid import uuid4
+
+# filter parameters of each scenario; `{crossmatch}` is filled with sampled ids
+SCENARIOS = {
+    "unfiltered": dict(),
+    "expression": dict(expression="teff>5500&logg<3.5"),
+    "carton_mapper": dict(carton="mwm_carton_0,bhm_carton_3",
+                         mapper="ops",
+                         combotype="OR"),
+    "flags": dict(flags="purely non-flagged,snr > 50"),
+    "crossmatch": dict(crossmatch="{crossmatch}", cmtype="sdss5"),
+    "combined": dict(
+        expression="teff>5000",
+        mapper="mwm",
+        flags="no bad flags",
+        crossmatch="{crossmatch}",
+        cmtype="sdss5",
+    ),
+}
+
+
+def peak_rss() -> int:
+    """Peak resident memory of this process in bytes."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def sample_identifiers(path: str, n: int, seed: int = 42) -> str:
+    """Samples `n` sdss_ids from a dataset as a crossmatch list."""
+    import numpy as np
+    import vaex as vx
+
+    df = vx.open(path)
+    ids = df["sdss_id"].values
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(ids, size=min(n, len(ids)), replace=False)
+    return "\n".join(map(str, sample))
+
+
+def run_scenario(params: dict, release: str, datatype: str, dataset: str,
+                 repeat: int, results: multiprocessing.Queue) -> None:
+    """Runs one scenario in this process and puts its measurements on `results`."""
+    # imported here so settings are read from the environment set by `main`
+    from sdss_explorer.server import progress
+    from sdss_explorer.server.filter import filter_dataframe
+    from sdss_explorer.util.config import settings
+
+    updates = queue.Queue()
+    progress.set_queue(updates)
+    timings = []
+    try:
+        for _ in range(repeat + 1):
+            uid = uuid4()
+            start = perf_counter()
+            filepath = filter_dataframe(uid, release, datatype, dataset,
+                                        **params)
+            timings.append(perf_counter() - start)
+            nbytes = os.path.getsize(os.path.join(settings.scratch, filepath))
+            shutil.rmtree(os.path.join(settings.scratch, str(uid)))
+    except Exception as e:
+        results.put(dict(error=f"{type(e).__name__}: {e}"))
+        return
+
+    fields = {}
+    while not updates.empty():
+        fields.update(updates.get_nowait()[1])
+    results.put(
+        dict(
+            cold=timings[0],
+            warm=statistics.median(timings[1:]) if repeat else None,
+            rows_total=fields.get("rows_total"),
+            rows_matched=fields.get("rows_matched"),
+            output_bytes=nbytes,
+            peak_rss=peak_rss(),
+        ))
+
+
+def measure(name: str, params: dict, args: argparse.Namespace) -> dict:
+    """Runs a scenario in a fresh process and derives throughput."""
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_scenario,
+                              args=(params, args.release, args.datatype,
+                                    args.dataset, args.repeat, results))
+    process.start()
+    result = results.get()
+    process.join()
+    result = dict(scenario=name, **result)
+    if "error" not in result:
+        seconds = result["warm"] or result["cold"]
+        result["rows_per_s"] = result["rows_total"] / seconds
+        result["output_mb"] = result["output_bytes"] / 1e6
+        result["output_mb_per_s"] = result["output_mb"] / seconds
+    return result
+
+
+def git_commit() -> str | None:
+    """Current git commit of the working tree, if any."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data",
+                        required=True,
+                        help="data path, as written by benchmarks.generate")
+    parser.add_argument("--release", default="dr19")
+    parser.add_argument("--datatype", default="star")
+    parser.add_argument("--dataset", default="aspcap")
+    parser.add_argument("--vastra", default="0.6.0")
+    parser.add_argument("--scenarios",
+                        default=",".join(SCENARIOS),
+                        help="comma-separated scenarios to run")
+    parser.add_argument("--columns",
+                        default="",
+                        help="comma-separated columns to export")
+    parser.add_argument("--format", default="parquet")
+    parser.add_argument("--crossmatch-size", type=int, default=100_000)
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=3,
+                        help="warm runs per scenario")
+    parser.add_argument("--output", help="results file. Defaults to stdout.")
+    args = parser.parse_args(argv)
+
+    scratch = tempfile.mkdtemp(prefix="explorer-bench-")
+    os.environ.update(
+        EXPLORER_DATAPATH=os.path.abspath(args.data),
+        EXPLORER_SCRATCH=scratch,
+        EXPLORER_JOBSTORE="memory",
+        EXPLORER_PRELOAD="false",
+        VASTRA=args.vastra,
+    )
+    path = os.path.join(
+        args.data, args.release,
+        f"explorerAll{args.datatype.capitalize()}-{args.vastra}.hdf5")
+    crossmatch = sample_identifiers(path, args.crossmatch_size)
+
+    results = []
+    try:
+        for name in args.scenarios.split(","):
+            params = {
+                key: value.format(crossmatch=crossmatch) if isinstance(
+                    value, str) else value
+                for key, value in SCENARIOS[name].items()
+            }
+            params.update(columns=args.columns, format=args.format)
+            result = measure(name, params, args)
+            print(json.dumps(result), file=sys.stderr, flush=True)
+            results.append(result)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    report = dict(
+        meta=dict(
+            commit=git_commit(),
+            timestamp=datetime.now(timezone.utc).isoformat(),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            cpus=os.cpu_count(),
+            release=args.release,
+            datatype=args.datatype,
+            dataset=args.dataset,
+            format=args.format,
+            columns=args.columns,
+            repeat=args.repeat,
+            crossmatch_size=args.crossmatch_size,
+        ),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
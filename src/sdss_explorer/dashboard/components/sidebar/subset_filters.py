@@ -16,6 +16,8 @@ from ....util.filters import (
     crossmatchList,
     flagList,
 )
+from ....util.expressions import ExpressionError
+from ....util.spatial import POSITION_CMTYPE
 
 from ...dataclass import Alert, State, SubsetState, use_subset, VCData
 from ..textfield import ExpressionField, InputTextExposed
@@ -68,13 +70,10 @@ def ExprEditor(key: str, invert) -> ValueElement:
                                            invert=invert.value)
             set_expfilter(exprfilter)
             return True
-        except AssertionError as e:
-            # INFO: dont unset filters if assertions fail; tell user and let them try again
+        except ExpressionError as e:
+            # INFO: dont unset filters if validation fails; tell user and let them try again
             set_error(e)  # saves error msg to state
             return False
-        except SyntaxError:
-            set_error("modifier at end of sequence with no expression")
-            return False
 
     result: sl.Result[bool] = sl.lab.use_task(
         update_expr,
@@ -357,9 +356,11 @@ def CrossmatchPanel(key: str) -> ValueElement:
                 label="ID Type",
                 value=cmtype,
                 on_value=set_cmtype,
-                values=list(crossmatchList.keys()),
+                values=list(crossmatchList.keys()) + [POSITION_CMTYPE],
             )
             sl.InputTextArea(
+                "Enter some positions, as 'ra dec [radius in arcsec]' in degrees"
+                if cmtype == POSITION_CMTYPE else
                 "Enter some identifiers (integer)",
                 auto_grow=False,
                 value=crossmatch,
@@ -1,11 +1,11 @@
 """Subset options menu component, contains everything under the subset header."""
 
-from typing import Callable
+from typing import AsyncIterator, Callable, cast
 from urllib.parse import urljoin
 import json
 import logging
+import httpx
 import requests
-import asyncio
 
 import reacton.ipyvuetify as rv
 import solara as sl
@@ -13,6 +13,7 @@ from reacton.core import ValueElement
 from solara.lab import ConfirmationDialog
 
 from ...dataclass import Alert, SubsetState
+from ...util.io import export_subset
 from ....util import settings
 from ..dialog import Dialog
 from .subset_filters import (
@@ -24,6 +25,9 @@ from .subset_filters import (
 
 logger = logging.getLogger("dashboard")
 
+# estimated parquet size in bytes above which users are warned before exporting
+LARGE_EXPORT_NBYTES = 2_000_000_000
+
 
 @sl.component()
 def SubsetOptions(key: str, deleter: Callable):
@@ -191,54 +195,41 @@ def DeleteSubsetDialog(deleter: Callable) -> ValueElement:
     return main
 
 
-@sl.component()
-def DownloadMenu(key: str) -> ValueElement:
-    """Download menu and button
-
-    Note:
-        **THIS CONTAINS ALL FUNCTIONALITY FOR QUERYING `sdss_explorer.server`**
+async def subscribe_job_status(uid: str) -> AsyncIterator[dict]:
+    """Subscribes to pushed job status updates until the job finishes
 
     Args:
-        key: subset key
-    """
-
-    router = sl.use_router()
-    subset = SubsetState.subsets.value[key]
-    response, set_response = sl.use_state({"status": "not_run"})
+        uid: job ID
 
-    def reset_status():
-        """On change and not pending a result, reset"""
-        logger.debug(f"Resetting download button on {subset.name}")
-        default = {"status": "not_run"}
-        if response["status"] != "in_progress":
-            set_response(default)
-
-    sl.use_effect(reset_status, dependencies=[subset])
+    Yields:
+        data: Dictionary of response data, per update
+    """
+    async with httpx.AsyncClient(timeout=httpx.Timeout(10,
+                                                       read=None)) as client:
+        async with client.stream("GET",
+                                 urljoin(settings.api_url,
+                                         f"events/{uid}")) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if line.startswith("data:"):
+                    yield json.loads(line[len("data:"):])
 
-    def query_job_status(uid: str) -> dict[str, str]:
-        """Ping command to query job state and return result
 
-        Args:
-            uid: job ID
+def use_job_status(label: str, response: dict, set_response: Callable,
+                   set_progress: Callable) -> None:
+    """Hook that follows an in-progress export job until it finishes
 
-        Returns:
-            data: Dictionary of response data
-            response: previous response data (when failing)
-        """
-        try:
-            resp = requests.get(urljoin(settings.api_url, f"status/{uid}"))
-            if resp.status_code == 200:
-                data = json.loads(resp.text)
-                return data
-        except Exception as e:
-            logger.debug(f"failed to connect: {e}")
-            Alert.update("Failed to connect to download sever", color="error")
-        return response
+    Args:
+        label: what is being exported, for alerts
+        response: latest job response
+        set_response: setter for the job response, called on finish
+        set_progress: setter for the job response, called on each update
+    """
 
     # @sl.lab.task()
     async def query_task():
-        """Runs a GET query continously for the given job of the subset"""
-        logger.debug(f"query task start on {subset.name}")
+        """Subscribes to status updates for the given job"""
+        logger.debug(f"query task start on {label}")
 
         # get our local response
         local_response = response.copy()
@@ -249,69 +240,170 @@ def DownloadMenu(key: str) -> ValueElement:
                                                               == "not_run"):
             return
 
-        # loop until received, spawning in thread
-        while True:
-            local_response = await asyncio.to_thread(query_job_status,
-                                                     local_response["uid"])
-            logger.debug(f"received response {local_response}")
-
-            if local_response["status"] == "complete":
-                logger.debug(f"job returned as complete! {local_response}")
-                Alert.update(
-                    message=
-                    f"Your file for Subset {subset.name} is ready! Hit the download button",
-                    color="success",
-                )
-
-                # apply to everything and get out
-                set_response(local_response)
-                break
-            elif local_response["status"] == "failed":
-                logger.debug(f"job returned as failed! {local_response}")
-                Alert.update(
-                    message="File render failed! Please try again, "
-                    "and inform system adminstrator if it keeps failing.",
-                    color="error",
-                )
-                set_response(local_response)
-                break
-
-            # if not run or in_progress, continues
-            await asyncio.sleep(2)
+        # updates are pushed by the server, so no polling
+        try:
+            async for local_response in subscribe_job_status(
+                    local_response["uid"]):
+                logger.debug(f"received response {local_response}")
+
+                if local_response["status"] == "complete":
+                    logger.debug(f"job returned as complete! {local_response}")
+                    Alert.update(
+                        message=
+                        f"Your file for {label} is ready! Hit the download button",
+                        color="success",
+                    )
+
+                    # apply to everything and get out
+                    set_response(local_response)
+                    break
+                elif local_response["status"] != "in_progress":
+                    logger.debug(f"job returned as failed! {local_response}")
+                    Alert.update(
+                        message="File render failed! Please try again, "
+                        "and inform system adminstrator if it keeps failing.",
+                        color="error",
+                    )
+                    set_response({**local_response, "status": "failed"})
+                    break
+
+                # if in_progress, continues
+                set_progress(local_response)
+        except Exception as e:
+            logger.debug(f"failed to connect: {e}")
+            Alert.update("Failed to connect to download sever", color="error")
+            set_response({**local_response, "status": "failed"})
 
         # flag our exit
-        logger.debug(f"query task shutdown on {subset.name}")
+        logger.debug(f"query task shutdown on {label}")
         return
 
     sl.lab.use_task(query_task, dependencies=[response])
 
+
+def query_estimate(path: str,
+                   params: dict,
+                   crossmatch: str = "") -> dict | None:
+    """Queries the row count and size of an export without running it
+
+    Args:
+        path: `release/datatype/dataset` of the subset
+        params: subset filter parameters, except the crossmatch
+        crossmatch: crossmatch identifiers, sent in the body
+
+    Returns:
+        data: Dictionary of estimate data, or `None` if unavailable
+    """
+    try:
+        resp = requests.post(urljoin(settings.api_url, f"estimate/{path}"),
+                             params=params,
+                             data=crossmatch.encode(),
+                             headers={"Content-Type": "text/plain"})
+        if resp.status_code == 200:
+            return resp.json()
+        logger.debug(f"estimate failed: {resp.text}")
+    except Exception as e:
+        logger.debug(f"failed to connect for estimate: {e}")
+    return None
+
+
+def describe_progress(progress: dict) -> str:
+    """Describes progress of an in-progress job for a tooltip."""
+    stage = progress.get("stage", "queued")
+    if progress.get("queue_position"):
+        return f"Waiting for a free slot, position {progress['queue_position']} in queue"
+    message = f"Preparing file: {stage}, {progress.get('progress', 0):.0%}"
+    if progress.get("eta") is not None:
+        message += f", about {progress['eta']:.0f}s left"
+    return message
+
+
+@sl.component()
+def DownloadMenu(key: str) -> ValueElement:
+    """Download menu and button
+
+    Note:
+        **THIS CONTAINS ALL FUNCTIONALITY FOR QUERYING `sdss_explorer.server`**
+
+    Args:
+        key: subset key
+    """
+
+    router = sl.use_router()
+    subset = SubsetState.subsets.value[key]
+    response, set_response = sl.use_state({"status": "not_run"})
+    progress, set_progress = sl.use_state(cast(dict, {}))
+
+    def reset_status():
+        """On change and not pending a result, reset"""
+        logger.debug(f"Resetting download button on {subset.name}")
+        default = {"status": "not_run"}
+        if response["status"] != "in_progress":
+            set_response(default)
+
+    sl.use_effect(reset_status, dependencies=[subset])
+
+    use_job_status(f"Subset {subset.name}", response, set_response,
+                   set_progress)
+    requested, set_requested = sl.use_state(0)
+
     def send_job():
         """Exports subset data to JSON and sends to FastAPI DL sever."""
         from ...dataclass import State
         from dataclasses import asdict
 
+        if not requested:  # not clicked yet
+            return
+
         # serialize & remove columns/df from req
         data = asdict(subset)
         data.pop("columns")
         data.pop("df")
+        data["session"] = sl.get_session_id()  # for fair queueing
         dataset = data["dataset"]
         jsonData = json.dumps(data)
         logger.debug("requesting" + str(jsonData))
+        # server takes lists as comma-separated strings
+        params = {
+            k: ",".join(v) if isinstance(v, list) else v
+            for k, v in data.items()
+        }
+        # identifiers go in the body, since long lists overflow the URL
+        crossmatch = params.pop("crossmatch", "")
+
+        # dry run first, to skip empty subsets and warn on huge ones
+        message = "Creating file for download! Please wait."
+        estimate = query_estimate(
+            f"{State.release}/{State.datatype}/{dataset}", params, crossmatch)
+        if estimate is not None:
+            if estimate["rows_matched"] == 0:
+                Alert.update(
+                    f"Subset {subset.name} is empty, so there is nothing to download.",
+                    color="warning",
+                )
+                return
+            nbytes = estimate["nbytes"].get("parquet", 0)
+            if nbytes > LARGE_EXPORT_NBYTES:
+                message = (
+                    f"Creating file of {estimate['rows_matched']:,} rows "
+                    f"(about {nbytes / 1e9:.1f} GB) for download. This may take a while."
+                )
         try:
-            # TODO: no idea how requests works
             resp = requests.post(
                 urljoin(
                     settings.api_url,
                     f"filter_subset/{State.release}/{State.datatype}/{dataset}",
                 ),
-                params=data,
-                data=jsonData,
+                params=params,
+                data=crossmatch.encode(),
+                headers={"Content-Type": "text/plain"},
             )
             if resp.status_code == 202:
                 # ready! push update to call query loop task
                 logger.debug("Successfully called for download for" +
                              subset.name)
-                Alert.update("Creating file for download! Please wait.")
+                Alert.update(message)
+                set_progress({})
                 set_response(json.loads(resp.text))
         # on timeout raise, inform user
         except Exception as e:
@@ -319,11 +411,14 @@ def DownloadMenu(key: str) -> ValueElement:
             Alert.update("Failed to connect to download sever", color="error")
         return
 
+    # off the UI thread, since the estimate scans the dataset
+    sending = sl.lab.use_task(send_job, dependencies=[requested])
+
     def click_handler():
         """Handles click events"""
         if (response.get("status") == "not_run") or (response.get("status")
                                                      == "failed"):
-            send_job()
+            set_requested(requested + 1)
         elif response.get("status") == "complete":
             logger.debug(
                 f"sending user to {settings.download_url}{response.get('filepath', 'foobar')}"
@@ -340,7 +435,8 @@ def DownloadMenu(key: str) -> ValueElement:
         label="",
         icon_name="mdi-download",
         color=color,
-        disabled=True if response["status"] == "in_progress" else False,
+        disabled=True if (response["status"] == "in_progress") or
+        sending.pending else False,
         icon=True,
         text=True,
         href=
@@ -359,7 +455,10 @@ def DownloadMenu(key: str) -> ValueElement:
             "children": [button]
         }],
         color=None,  # pyright: ignore[]
-        children=["Download subset"],
+        children=[
+            describe_progress(progress)
+            if response["status"] == "in_progress" else "Download subset"
+        ],
     )
 
     def set_v_on():
@@ -368,4 +467,78 @@ def DownloadMenu(key: str) -> ValueElement:
 
     sl.use_effect(set_v_on, button)
 
-    return sl.Column(children=[tooltipped])
+    children = [tooltipped]
+    if response["status"] == "in_progress":
+        children.append(
+            sl.ProgressLinear(int(progress.get("progress", 0) * 100) or True))
+    return sl.Column(children=children)
+
+
+@sl.component()
+def BatchDownloadMenu() -> ValueElement:
+    """Button to export all subsets at once
+
+    Sends every subset as one batch job, so the server scans each dataset once
+    instead of once per subset. The result is a zip with one file per subset.
+    """
+    subsets = SubsetState.subsets.value
+    response, set_response = sl.use_state({"status": "not_run"})
+    progress, set_progress = sl.use_state(cast(dict, {}))
+
+    def reset_status():
+        """On change and not pending a result, reset"""
+        if response["status"] != "in_progress":
+            set_response({"status": "not_run"})
+
+    sl.use_effect(reset_status, dependencies=[subsets])
+
+    use_job_status("all subsets", response, set_response, set_progress)
+
+    def send_job():
+        """Sends all subsets to the FastAPI DL server as one batch."""
+        from ...dataclass import State
+
+        specs = [{
+            **export_subset(subset),
+            "crossmatch": subset.crossmatch,
+            "cmtype": subset.cmtype,
+        } for subset in subsets.values()]
+        try:
+            resp = requests.post(
+                urljoin(settings.api_url,
+                        f"filter_batch/{State.release}/{State.datatype}"),
+                params={"session": sl.get_session_id()},
+                json={"subsets": specs},
+            )
+            if resp.status_code == 202:
+                Alert.update("Creating files for download! Please wait.")
+                set_progress({})
+                set_response(resp.json())
+            else:
+                logger.debug(f"batch request rejected: {resp.text}")
+                Alert.update("Failed to export all subsets", color="error")
+        except Exception as e:
+            logger.debug(f"failed to connect to call for download: {e}")
+            Alert.update("Failed to connect to download sever", color="error")
+
+    status = response["status"]
+    with sl.Column(gap="0px") as main:
+        with sl.Tooltip(
+                describe_progress(progress) if status ==
+                "in_progress" else "Export every subset in a single zip"):
+            sl.Button(
+                label="Download all subsets"
+                if status == "complete" else "Export all subsets",
+                color="green" if status == "complete" else
+                ("red" if status == "failed" else None),
+                disabled=(status == "in_progress") or not subsets,
+                block=True,
+                href=urljoin(settings.download_url,
+                             response.get("filepath", "foobar"))
+                if status == "complete" else None,
+                target="_blank",
+                on_click=send_job if status != "complete" else None,
+            )
+        if status == "in_progress":
+            sl.ProgressLinear(int(progress.get("progress", 0) * 100) or True)
+    return main
@@ -9,7 +9,7 @@ from reacton.core import ValueElement
 from ..dialog import Dialog
 
 from ...dataclass import SubsetState, State, use_subset
-from .subset_options import SubsetOptions
+from .subset_options import BatchDownloadMenu, SubsetOptions
 
 logger = logging.getLogger("dashboard")
 
@@ -53,6 +53,7 @@ def SubsetMenu() -> ValueElement:
                         on_click=lambda: add.set(True),
                         block=True,
                     )
+                BatchDownloadMenu()
         with rv.ExpansionPanels(flat=True,
                                 popout=True,
                                 v_model=model,
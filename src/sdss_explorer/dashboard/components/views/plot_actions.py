@@ -1,10 +1,14 @@
 """Plot specific actions that are used in effects"""
 
+import io
 import logging
+from urllib.parse import urljoin
 from bokeh.models.tools import HoverTool
 from typing import Optional
 import pyarrow as pa
 import numpy as np
+import requests
+import solara as sl
 import vaex as vx
 from numpy import ndarray
 from bokeh.models import Plot
@@ -13,7 +17,8 @@ from bokeh.models.formatters import (
     BasicTickFormatter,
 )
 
-from ...dataclass import PlotState, Alert, SubsetState
+from ...dataclass import PlotState, Alert, SubsetState, State
+from ....util import settings
 from .plot_utils import (
     check_categorical,
     _calculate_color_range,
@@ -28,6 +33,14 @@ from .plot_utils import (
 
 logger = logging.getLogger("dashboard")
 
+# prefixes of subset store keys of the sidebar's subset filters, which the
+# server can reproduce from the subset; any other filter is a plot selection
+SUBSET_FILTER_KEYS = ("ss-expr-", "ss-flags-", "ss-cartonmapper-",
+                      "ss-crossmatch-")
+
+# time in seconds to wait for the server to aggregate before doing it here
+AGGREGATE_TIMEOUT = 30
+
 
 def update_tooltips(plotstate: PlotState, fig_model: Plot) -> None:
     """Updates tooltips on toolbar's HoverTool
@@ -300,6 +313,95 @@ def fetch_data(plotstate: PlotState,
     return colData
 
 
+def can_aggregate_remotely(plotstate: PlotState) -> bool:
+    """Checks whether the server can reproduce a plot's aggregation.
+
+    It can't for categorical columns, or when any plot has a selection on the
+    subset, since the server only knows the subset's own filters.
+
+    Args:
+        plotstate: plot variables
+    """
+    columns = [plotstate.x.value]
+    if plotstate.plottype == "heatmap":
+        columns += [plotstate.y.value, plotstate.color.value]
+    if any(check_categorical(col) for col in columns):
+        return False
+    subset = SubsetState.subsets.value[plotstate.subset.value]
+    filters = State.subset_store.filters.get(str(id(subset.df)),
+                                             {}).get(plotstate.subset.value,
+                                                     {})
+    return all(
+        key.startswith(SUBSET_FILTER_KEYS) for key, f in filters.items()
+        if f is not None)
+
+
+def aggregate_remote(
+    plotstate: PlotState
+) -> (tuple[ndarray, ndarray, ndarray, list[list[float]]]
+      | tuple[ndarray, ndarray, ndarray]):
+    """Aggregates data for a heatmap or histogram on the download server.
+
+    The server caches results, so sessions plotting the same subset share
+    them. Returns the same as `aggregate_data`.
+
+    Args:
+        plotstate: plot variables
+
+    Raises:
+        requests.HTTPError: if the server fails to aggregate
+    """
+    subset = SubsetState.subsets.value[plotstate.subset.value]
+    heatmap = plotstate.plottype == "heatmap"
+    body = dict(
+        subset=dict(
+            name=subset.name,
+            dataset=subset.dataset,
+            expression=subset.expression,
+            carton=subset.carton,
+            mapper=subset.mapper,
+            flags=subset.flags,
+            crossmatch=subset.crossmatch,
+            cmtype=subset.cmtype,
+        ),
+        plottype=plotstate.plottype,
+        x=plotstate.x.value,
+        nbins=plotstate.nbins.value,
+    )
+    if heatmap:
+        body.update(y=plotstate.y.value,
+                    color=plotstate.color.value,
+                    bintype=plotstate.bintype.value)
+    resp = requests.post(
+        urljoin(settings.api_url,
+                f"aggregate/{State.release}/{State.datatype}"),
+        params={"session": sl.get_session_id()},
+        json=body,
+        timeout=AGGREGATE_TIMEOUT,
+    )
+    resp.raise_for_status()
+    with np.load(io.BytesIO(resp.content), allow_pickle=False) as archive:
+        arrays = dict(archive)
+    grid = arrays["grid"]
+    x_edges = arrays["edges_x"]
+
+    if not heatmap:
+        centers = (x_edges[:-1] + x_edges[1:]) / 2
+        return centers, x_edges, grid
+
+    y_edges = arrays["edges_y"]
+    widths = [x_edges[1] - x_edges[0], y_edges[1] - y_edges[0]]
+    if plotstate.logcolor.value:
+        grid = np.log10(grid)
+    assert not np.all(np.isnan(grid)), "all nan"
+    return (
+        grid,
+        (x_edges[:-1] + x_edges[1:]) / 2,
+        (y_edges[:-1] + y_edges[1:]) / 2,
+        widths,
+    )
+
+
 def aggregate_data(
     plotstate: PlotState, dff: vx.DataFrame
 ) -> (tuple[ndarray, ndarray, ndarray, list[list[float]]]
@@ -317,6 +419,10 @@ def aggregate_data(
         y_edges: 1D array of x-axis coordinates
         limits: splatted list of x and y axis limits
 
+    Note:
+        With `settings.aggregate_remote`, this is delegated to the download
+        server where possible. See `aggregate_remote`.
+
     Raises:
         ValueError: if no bintype (somehow)
         RuntimeError: if binning is too small (stride bug)
@@ -328,6 +434,12 @@ def aggregate_data(
         raise ValueError(
             "no assigned bintype for aggregation. bug somewhere in settings.")
 
+    if settings.aggregate_remote and can_aggregate_remotely(plotstate):
+        try:
+            return aggregate_remote(plotstate)
+        except Exception as e:
+            logger.debug(f"remote aggregation failed, aggregating here: {e}")
+
     assert len(dff) > 0, "no data in dataframe"
 
     if plotstate.plottype == "histogram":
@@ -49,6 +49,7 @@ from .plot_actions import (
 )
 
 from ...dataclass import PlotState, SubsetState, GridState, use_subset, Alert, VCData
+from ....util.filters import filter_range
 
 logger = logging.getLogger("dashboard")
 
@@ -390,8 +391,7 @@ def ScatterPlot(plotstate: PlotState) -> ValueElement:
             assert not np.all(lims == np.nan)
             xmax = np.nanmax(lims)
             xmin = np.nanmin(lims)
-            xfilter = df[
-                f"(({plotstate.x.value} > {xmin}) & ({plotstate.x.value} < {xmax}))"]
+            xfilter = filter_range(df, plotstate.x.value, xmin, xmax)
         except Exception as e:
             pass
         try:
@@ -399,8 +399,7 @@ def ScatterPlot(plotstate: PlotState) -> ValueElement:
             assert not np.all(lims == np.nan)
             ymax = np.nanmax(lims)
             ymin = np.nanmin(lims)
-            yfilter = df[
-                f"(({plotstate.y.value} > {ymin}) & ({plotstate.y.value} < {ymax}))"]
+            yfilter = filter_range(df, plotstate.y.value, ymin, ymax)
 
         except Exception as e:
             pass
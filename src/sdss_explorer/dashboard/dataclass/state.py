@@ -12,6 +12,8 @@ import vaex as vx
 
 from .subsetstore import SubsetStore
 from ...util import settings
+from ...util.bitmaps import add_row_column
+from ...util.sidecars import attach_sidecars
 
 logger = logging.getLogger("dashboard")
 
@@ -70,9 +72,12 @@ def open_file(filename):
     # TODO: verify auth status when attempting to load a working group dataset
     try:
         dataset = vx.open(f"{datapath}/{filename}")
+        add_row_column(dataset)  # to find rows in sidecar indexes
         dataset = dataset.shuffle(
             random_state=42
         )  # shuffle to ensure skyplot looks nice, constant seed for reproducibility
+        # the row column stays lazy, looked up through the shuffle's indices
+        attach_sidecars(dataset, f"{datapath}/{filename}")
         return dataset
     except FileNotFoundError:
         logger.critical("Expected to find %s for dataframe, didn't find it.",
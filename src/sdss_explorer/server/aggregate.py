@@ -0,0 +1,208 @@
+"""Binned aggregation of subsets for histograms and heatmaps.
+
+Aggregates are computed in the export process pool and cached on the scratch
+disk, so every dashboard session plotting the same subset shares one result.
+"""
+
+import hashlib
+import io
+import json
+import logging
+import os
+from functools import cache
+from uuid import UUID
+
+import diskcache
+import numpy as np
+from pydantic import BaseModel, Field
+
+from .batch import SubsetSpec
+from .dataframe import data_path, load_dataframe
+from .filter import build_filter
+from ..util.bitmaps import file_identity
+from ..util.config import settings
+
+__all__ = [
+    "AGGREGATE_BINTYPES",
+    "AggregateRequest",
+    "aggregate_key",
+    "aggregate_subset",
+    "result_cache",
+    "encode",
+    "decode",
+]
+
+logger = logging.getLogger("server")
+
+# aggregations, as in the dashboard's `PlotState.Lookup["bintypes"]`
+AGGREGATE_BINTYPES = ("count", "mean", "median", "sum", "min", "max")
+
+# bins per axis at most
+MAX_NBINS = 2000
+
+# peak memory of an aggregation job beyond the cached dataframe, for admission
+AGGREGATE_MEMORY = 500_000_000
+
+
+@cache
+def result_cache() -> diskcache.Cache:
+    """Cache of aggregation results on the scratch disk, shared by all server workers.
+
+    Least recently used results are evicted beyond `settings.aggregate_cache_size`.
+    """
+    return diskcache.Cache(os.path.join(settings.scratch, "aggregates"),
+                           size_limit=settings.aggregate_cache_size,
+                           eviction_policy="least-recently-used")
+
+
+class AggregateRequest(BaseModel):
+    """Request body of an aggregation.
+
+    Attributes:
+        subset: subset to aggregate
+        plottype: `histogram` for counts binned by `x`, or `heatmap` for
+            `color` aggregated by `bintype` and binned by `x` and `y`
+        x: column to bin by
+        y: second column to bin by, for heatmaps
+        color: column to aggregate, for heatmaps
+        bintype: aggregation, one of `AGGREGATE_BINTYPES`
+        nbins: bins per axis
+        xlimits: limits of `x`. Defaults to its minimum and maximum.
+        ylimits: limits of `y`. Defaults to its minimum and maximum.
+    """
+
+    subset: SubsetSpec
+    plottype: str = "histogram"
+    x: str
+    y: str = ""
+    color: str = ""
+    bintype: str = "count"
+    nbins: int = Field(default=200, ge=1, le=MAX_NBINS)
+    xlimits: tuple[float, float] | None = None
+    ylimits: tuple[float, float] | None = None
+
+    def validate_aggregate(self) -> None:
+        """Validates options that depend on each other.
+
+        Raises:
+            ValueError: if any option is invalid
+        """
+        if self.plottype not in ("histogram", "heatmap"):
+            raise ValueError(f"unsupported plot type {self.plottype}")
+        if self.bintype not in AGGREGATE_BINTYPES:
+            raise ValueError(f"unsupported bintype {self.bintype}")
+        if (self.plottype == "heatmap") and not (self.y and
+                                                 (self.color or self.bintype
+                                                  == "count")):
+            raise ValueError("heatmaps need y and color columns")
+
+
+def aggregate_key(release: str, datatype: str, request: AggregateRequest) -> str:
+    """Generates the cache key of an aggregation.
+
+    Subset names don't change the result, so they are left out. The version
+    and identity of the data file are in, so results of a replaced file are
+    never served.
+    """
+    data = request.model_dump(exclude={"subset": {"name"}})
+    if data["plottype"] == "histogram":
+        data.update(y="", color="", bintype="count", ylimits=None)
+    elif data["bintype"] == "count":
+        data["color"] = ""
+    path = data_path(release, datatype)
+    source = file_identity(path) if os.path.isfile(path) else ""
+    raw = json.dumps([release, datatype, settings.vastra, source, data],
+                     sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def encode(**arrays: np.ndarray) -> bytes:
+    """Packs arrays as an uncompressed `.npz` archive."""
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def decode(data: bytes) -> dict[str, np.ndarray]:
+    """Unpacks arrays packed by `encode`."""
+    with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+        return dict(archive)
+
+
+def aggregate_subset(uuid: UUID, release: str, datatype: str,
+                     params: dict) -> bytes:
+    """Bins a subset for a histogram or heatmap.
+
+    Args:
+        uuid: unique job id, unused
+        release: data release
+        datatype: datatype (star or visit)
+        params: aggregation parameters, see `AggregateRequest`
+
+    Returns:
+        `.npz` archive of `grid`, the aggregated values with `x` along the
+        first axis, the bin `edges_x` (and `edges_y` for heatmaps), and `rows`,
+        the number of rows in the subset. Empty bins of a heatmap are NaN.
+
+    Raises:
+        ValueError: if a column is invalid or the subset is empty
+    """
+    request = AggregateRequest.model_validate(params)
+    spec = request.subset
+    dff, validCols = load_dataframe(release, datatype, spec.dataset)
+    if (dff is None) or (validCols is None):
+        raise Exception("dataframe/columns load failed")
+    heatmap = request.plottype == "heatmap"
+    binby = [request.x, request.y] if heatmap else [request.x]
+    used = binby + ([request.color] if heatmap and request.color else [])
+    for column in used:
+        if column not in validCols:
+            raise ValueError(f"invalid column {column}")
+        if not dff[column].dtype.is_numeric:
+            raise ValueError(f"cannot bin categorical column {column}")
+
+    f = build_filter(dff, validCols, spec.dataset, **spec.filters())
+    if f is not None:
+        dff = dff[f]
+
+    # limits first, in one pass for all axes without given limits
+    given = [request.xlimits, request.ylimits][:len(binby)]
+    missing = [i for i, lim in enumerate(given) if lim is None]
+    found = {}
+    if missing:
+        found = dict(
+            zip(missing,
+                np.atleast_2d(dff.minmax([binby[i] for i in missing]))))
+    limits = [[float(v) for v in (found[i] if lim is None else lim)]
+              for i, lim in enumerate(given)]
+    if any(not np.all(np.isfinite(lim)) for lim in limits):
+        raise ValueError("no data to aggregate")
+
+    shape = request.nbins
+    rows = dff.count(delay=True)
+    if not heatmap or (request.bintype == "count"):
+        grid = dff.count(binby=binby, limits=limits, shape=shape, delay=True)
+    else:
+        aggregate = getattr(dff, "median_approx" if request.bintype ==
+                            "median" else request.bintype)
+        grid = aggregate(request.color,
+                         binby=binby,
+                         limits=limits,
+                         shape=shape,
+                         delay=True)
+    dff.execute()
+    grid = np.asarray(grid.get())
+    if heatmap:
+        grid = grid.astype("float64")
+        if request.bintype == "count":
+            grid[grid == 0] = np.nan
+        grid[np.abs(grid) == np.inf] = np.nan
+
+    arrays = dict(
+        grid=grid,
+        rows=np.asarray(int(rows.get())),
+        edges_x=np.linspace(limits[0][0], limits[0][1], shape + 1),
+    )
+    if heatmap:
+        arrays["edges_y"] = np.linspace(limits[1][0], limits[1][1], shape + 1)
+    return encode(**arrays)
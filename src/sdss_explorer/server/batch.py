@@ -0,0 +1,340 @@
+"""Batch export of many subsets in a single scan of each pipeline dataframe."""
+
+import os
+import gc
+import re
+import shutil
+import zipfile
+import logging
+from datetime import datetime
+from typing import Callable
+from uuid import UUID
+
+import numpy as np
+import vaex as vx
+from pydantic import BaseModel, Field, field_validator
+from vaex.execution import UserAbort
+
+from .dataframe import load_dataframe
+from .filter import (
+    CHUNK_SIZE,
+    EXPORT_FORMATS,
+    build_filter,
+    export_file,
+    export_filename,
+    project_columns,
+    validate_export,
+)
+from .jobs import is_cancelled
+from .progress import JobAborted, ProgressReporter
+from .scheduler import estimate_memory
+from ..util.config import settings
+
+__all__ = [
+    "BATCH_OUTPUTS",
+    "SubsetSpec",
+    "BatchRequest",
+    "unique_names",
+    "membership_columns",
+    "scan_subsets",
+    "filter_batch",
+    "estimate_batch_memory",
+]
+
+logger = logging.getLogger("server")
+
+# batch output modes: a zip of one file per subset, or one file with a
+# membership column per subset
+BATCH_OUTPUTS = ("files", "single")
+
+
+class SubsetSpec(BaseModel):
+    """Filter parameters of one subset, as produced by `export_subset` in the dashboard.
+
+    List fields may be given as lists or comma-separated strings.
+    """
+
+    name: str = "A"
+    dataset: str
+    expression: str = ""
+    carton: str = ""
+    mapper: str = ""
+    flags: str = ""
+    crossmatch: str = ""
+    cmtype: str = "gaia_dr3"
+    combotype: str = "AND"
+    invert: bool = False
+
+    @field_validator("carton", "mapper", "flags", mode="before")
+    @classmethod
+    def _join(cls, value):
+        if isinstance(value, (list, tuple)):
+            return ",".join(value)
+        return value
+
+    def filters(self) -> dict:
+        """Filter parameters, as taken by `build_filter`."""
+        return self.model_dump(exclude={"name", "dataset"})
+
+
+class BatchRequest(BaseModel):
+    """Request body of a batch export.
+
+    Attributes:
+        subsets: subsets to export
+        output: `files` for a zip of one file per subset, or `single` for one
+            file with a boolean `in_<name>` column per subset. `single` needs
+            all subsets to share a dataset.
+        columns: comma-separated columns to export. Defaults to all.
+        format: output format
+        compression: parquet compression codec
+        row_group_size: rows per parquet row group
+    """
+
+    subsets: list[SubsetSpec] = Field(min_length=1)
+    output: str = "files"
+    columns: str = ""
+    format: str = "parquet"
+    compression: str = "snappy"
+    row_group_size: int = CHUNK_SIZE
+
+    def validate_batch(self) -> None:
+        """Validates options that depend on each other.
+
+        Raises:
+            ValueError: if any option is invalid
+        """
+        validate_export(self.format, self.compression, self.row_group_size)
+        if self.output not in BATCH_OUTPUTS:
+            raise ValueError(f"unsupported batch output {self.output}")
+        if (self.output == "single") and len(
+            {spec.dataset for spec in self.subsets}) > 1:
+            raise ValueError("single file output needs all subsets to share a dataset")
+
+
+def unique_names(names: list[str]) -> list[str]:
+    """Makes subset names safe for columns and filenames, and unique."""
+    unique = []
+    for name in names:
+        name = re.sub(r"\W", "_", name) or "subset"
+        candidate, n = name, 1
+        while candidate in unique:
+            n += 1
+            candidate = f"{name}_{n}"
+        unique.append(candidate)
+    return unique
+
+
+def membership_columns(names: list[str]) -> list[str]:
+    """Generates unique, valid column names marking membership of each subset."""
+    return [f"in_{name}" for name in unique_names(names)]
+
+
+def scan_subsets(
+        dff: vx.DataFrame,
+        columns: list[str],
+        dataset: str,
+        specs: list[SubsetSpec],
+        progress: Callable[[float], bool] | None = None) -> list[np.ndarray]:
+    """Evaluates the filters of many subsets in a single pass over a dataframe.
+
+    Args:
+        dff: pipeline dataframe, as from `load_dataframe`
+        columns: valid columns of the dataset
+        dataset: specific dataset i.e. aspcap, spall, best
+        specs: subsets to evaluate
+        progress: vaex progress callback
+
+    Returns:
+        A boolean mask over `dff` per subset.
+    """
+    filters = [
+        build_filter(dff, columns, dataset, **spec.filters())
+        for spec in specs
+    ]
+    expressions = [f for f in filters if f is not None]
+    values = iter(
+        dff.evaluate(expressions, progress=progress) if expressions else [])
+    masks = []
+    for f in filters:
+        if f is None:  # unfiltered subset
+            masks.append(np.ones(len(dff), dtype=bool))
+        else:
+            masks.append(np.ma.filled(next(values), False).astype(bool))
+    return masks
+
+
+def estimate_batch_memory(release: str,
+                          datatype: str,
+                          subsets: list[dict],
+                          columns: str = "",
+                          **kwargs) -> int:
+    """Estimates the peak memory of a batch export job.
+
+    Outputs are written one at a time, so this is the largest single-subset
+    estimate, plus a boolean mask per subset over its dataset.
+    """
+    specs = [SubsetSpec.model_validate(spec) for spec in subsets]
+    peak = 0
+    for spec in specs:
+        memory = estimate_memory(release, datatype, spec.dataset, columns,
+                                 **spec.filters())
+        peak = max(peak, memory)
+    masks = 0
+    for dataset in {spec.dataset for spec in specs}:
+        dff, _ = load_dataframe(release, datatype, dataset)
+        if dff is None:
+            raise Exception("dataframe/columns load failed")
+        masks += len(dff) * sum(1 for spec in specs if spec.dataset == dataset)
+    return peak + masks
+
+
+def filter_batch(
+    uuid: UUID,
+    release: str,
+    datatype: str,
+    subsets: list[dict],
+    output: str = "files",
+    columns: str = "",
+    format: str = "parquet",
+    compression: str = "snappy",
+    row_group_size: int = CHUNK_SIZE,
+) -> tuple[str, dict[str, int]]:
+    """Filters and exports many subsets, scanning each pipeline dataframe once.
+
+    Subsets are grouped by dataset. Each group's filters are evaluated together
+    in one pass, then each subset's rows are taken by index and written, so the
+    cost is one scan per dataset rather than one per subset.
+
+    Args:
+        uuid: unique job id
+        release: data release
+        datatype: datatype (star or visit)
+        subsets: subset specs, see `SubsetSpec`
+        output: output mode, one of `BATCH_OUTPUTS`
+        columns: comma-separated columns to export. Defaults to all.
+        format: output format, one of `EXPORT_FORMATS`
+        compression: parquet compression codec
+        row_group_size: rows per parquet row group
+
+    Returns:
+        Path of the output file, relative to the scratch space, and the job's
+        final row counts, see `progress.COUNT_FIELDS`.
+    """
+    specs = [SubsetSpec.model_validate(spec) for spec in subsets]
+    validate_export(format, compression, row_group_size)
+    logger.debug(f"starting batch job {uuid} of {len(specs)} subsets")
+
+    reporter = ProgressReporter(
+        uuid,
+        timeout=settings.job_timeout,
+        memory=settings.job_memory,
+        cancelled=lambda: is_cancelled(uuid),
+    )
+    jobdir = os.path.join(settings.scratch, str(uuid))
+    try:
+        # group by dataset, keeping order
+        groups: dict[str, list[int]] = {}
+        for i, spec in enumerate(specs):
+            groups.setdefault(spec.dataset, []).append(i)
+
+        reporter.set_stage("loading")
+        frames = {}
+        for dataset in groups:
+            dff, validCols = load_dataframe(release, datatype, dataset)
+            if (dff is None) or (validCols is None):
+                raise Exception("dataframe/columns load failed")
+            frames[dataset] = (dff, validCols,
+                               project_columns(validCols, columns))
+
+        # one pass per dataset for all its subsets
+        total = sum(len(frames[dataset][0]) for dataset in groups)
+        reporter.set_stage("filtering", rows_total=total)
+        scanned_masks: dict[int, np.ndarray] = {}
+        for n, (dataset, indices) in enumerate(groups.items()):
+            dff, validCols, _ = frames[dataset]
+            scanned = scan_subsets(
+                dff,
+                validCols,
+                dataset,
+                [specs[i] for i in indices],
+                progress=lambda f: reporter((n + f) / len(groups)),
+            )
+            scanned_masks.update(zip(indices, scanned))
+        masks = [scanned_masks[i] for i in range(len(specs))]
+        matched = [int(mask.sum()) for mask in masks]
+        # rows in any subset
+        union = sum(
+            int(np.logical_or.reduce([masks[i] for i in indices]).sum())
+            for indices in groups.values())
+        reporter.report(1.0,
+                        force=True,
+                        rows_scanned=total,
+                        rows_matched=union)
+        if not any(matched):
+            raise Exception("attempting to export 0 length df")
+
+        os.makedirs(jobdir, exist_ok=True)
+        ext = EXPORT_FORMATS[format]
+        reporter.set_stage("writing")
+        if output == "single":
+            dataset = specs[0].dataset
+            dff, _, exportCols = frames[dataset]
+            index = np.flatnonzero(np.logical_or.reduce(masks))
+            out = dff.take(index)[exportCols].extract()
+            for column, mask in zip(
+                    membership_columns([spec.name for spec in specs]), masks):
+                out.add_column(column, mask[index])
+            filename = export_filename("batch", release, datatype, dataset,
+                                       ext)
+            disk_path = os.path.join(jobdir, filename)
+            reporter.path = disk_path
+            export_file(out,
+                        disk_path,
+                        format=format,
+                        compression=compression,
+                        row_group_size=row_group_size,
+                        progress=reporter)
+        else:
+            filename = "subsets-{}-{}-{date:%Y-%m-%d_%H:%M:%S}.zip".format(
+                release, datatype, date=datetime.now())
+            disk_path = os.path.join(jobdir, filename)
+            reporter.path = disk_path
+            written = []
+            names = unique_names([spec.name for spec in specs])
+            for i, (spec, mask) in enumerate(zip(specs, masks)):
+                if not matched[i]:
+                    logger.debug(f"skipping empty subset {spec.name}")
+                    continue
+                dff, _, exportCols = frames[spec.dataset]
+                out = dff.take(np.flatnonzero(mask))[exportCols].extract()
+                path = os.path.join(
+                    jobdir,
+                    export_filename(names[i], release, datatype,
+                                    spec.dataset, ext))
+                export_file(out,
+                            path,
+                            format=format,
+                            compression=compression,
+                            row_group_size=row_group_size,
+                            progress=lambda f: reporter((i + f) / len(specs)))
+                written.append(path)
+            # outputs are already compressed, so only store them
+            with zipfile.ZipFile(disk_path, "w",
+                                 compression=zipfile.ZIP_STORED) as archive:
+                for path in written:
+                    archive.write(path, arcname=os.path.basename(path))
+                    os.remove(path)
+        reporter.report(1.0, force=True)
+    except UserAbort:
+        # raised by vaex when our progress callback stops it
+        shutil.rmtree(jobdir, ignore_errors=True)
+        raise JobAborted(reporter.reason or "job was aborted")
+    except Exception:
+        shutil.rmtree(jobdir, ignore_errors=True)
+        raise
+
+    del frames, masks
+    gc.collect()
+    logger.debug("completed batch job, exiting now!")
+    return os.path.join(str(uuid), filename), reporter.counts
@@ -0,0 +1,403 @@
+"""Crossmatching of identifier lists against sorted column indexes.
+
+Each export process sorts an identifier column the first time it is
+crossmatched, and keeps the sorted index for later requests. Matching a list of
+identifiers is then a binary search per identifier, rather than a scan of every
+row against a hash set built per request, and tells how many identifiers are
+unknown for free.
+
+Positions are matched the same way against a declination zone index of `ra`
+and `dec` (see `util.spatial`), which is also saved to the scratch disk, so it
+is sorted once per data file rather than once per process.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import shutil
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import vaex as vx
+
+from ..util.config import settings
+from ..util.filters import crossmatchList
+from ..util.spatial import (
+    POSITION_CMTYPE,
+    ZONE_HEIGHT,
+    ZoneIndex,
+    parse_positions,
+)
+
+__all__ = [
+    "CrossmatchIndex",
+    "column_index",
+    "position_index",
+    "parse_identifiers",
+    "read_identifiers",
+    "read_positions",
+    "match_positions",
+    "match_identifiers",
+    "filter_crossmatch_indexed",
+]
+
+logger = logging.getLogger("server")
+
+# maximum number of sorted column indexes kept per process
+INDEX_CACHE_SIZE = 8
+
+# (source column, index) by id of the source column, least recently used first
+_indexes: OrderedDict[int, tuple[object, "CrossmatchIndex | ZoneIndex"]] = (
+    OrderedDict())
+
+# maximum number of parsed identifier lists kept per process
+IDENTIFIER_CACHE_SIZE = 8
+
+# parsed identifiers by hash of their text and type, least recently used first
+_identifiers: OrderedDict[tuple[bytes, bool], np.ndarray] = OrderedDict()
+
+
+@dataclass
+class CrossmatchIndex:
+    """Sorted values of an identifier column.
+
+    Attributes:
+        values: sorted non-missing values of the column
+        rows: row of each sorted value
+    """
+
+    values: np.ndarray
+    rows: np.ndarray
+
+    def lookup(self, identifiers: np.ndarray) -> tuple[np.ndarray, int]:
+        """Finds the rows of sorted, unique identifiers.
+
+        Returns:
+            The rows with any of the identifiers, and the number of
+            identifiers found.
+        """
+        left = np.searchsorted(self.values, identifiers, side="left")
+        right = np.searchsorted(self.values, identifiers, side="right")
+        counts = right - left
+        found = np.flatnonzero(counts)
+        # expand each found range [left, right) into its positions
+        counts = counts[found]
+        starts = np.repeat(left[found] - np.cumsum(counts) + counts, counts)
+        positions = starts + np.arange(counts.sum())
+        return self.rows[positions], len(found)
+
+
+def _to_numpy(values) -> np.ndarray:
+    if hasattr(values, "to_numpy"):  # arrow strings
+        values = values.to_numpy(zero_copy_only=False)
+    return values
+
+
+def column_index(df: vx.DataFrame, column: str) -> CrossmatchIndex:
+    """Gets the sorted index of an identifier column, building it if needed.
+
+    Indexes are kept per process by the underlying column, which shallow copies
+    of a cached dataframe share, so each is built once per loaded dataset.
+
+    Args:
+        df: unfiltered dataframe, as from `load_dataframe`
+        column: identifier column
+
+    Returns:
+        The sorted index.
+    """
+    source = df.columns[column]
+    index = _cached(source)
+    if isinstance(index, CrossmatchIndex):
+        return index
+
+    values = np.ma.asarray(_to_numpy(df.evaluate(column)))
+    rows = np.flatnonzero(~np.ma.getmaskarray(values))
+    values = np.ma.getdata(values)[rows]
+    if values.dtype.kind == "O":
+        # missing strings come through as None
+        valid = values != None  # noqa: E711, elementwise
+        values, rows = values[valid], rows[valid]
+    order = np.argsort(values, kind="stable")
+    index = CrossmatchIndex(
+        values=values[order],
+        rows=rows[order].astype(np.int32 if len(df) < 2**31 else np.int64),
+    )
+    logger.debug(f"built crossmatch index of {column}, {len(values)} rows")
+    _cache(source, index)
+    return index
+
+
+def _cached(source: object) -> "CrossmatchIndex | ZoneIndex | None":
+    entry = _indexes.get(id(source))
+    if (entry is None) or (entry[0] is not source):
+        return None
+    _indexes.move_to_end(id(source))
+    return entry[1]
+
+
+def _cache(source: object, index: "CrossmatchIndex | ZoneIndex") -> None:
+    _indexes[id(source)] = (source, index)
+    while len(_indexes) > INDEX_CACHE_SIZE:
+        _indexes.popitem(last=False)
+
+
+def position_index(df: vx.DataFrame) -> ZoneIndex:
+    """Gets the zone index of `ra` and `dec`, loading or building it if needed.
+
+    Indexes are saved under `indexes` in the scratch space, named by a hash of
+    the coordinates, and memory mapped, so export processes share one copy.
+
+    Args:
+        df: unfiltered dataframe, as from `load_dataframe`
+
+    Returns:
+        The zone index, with `rows` of `df`.
+    """
+    source = df.columns["ra"]
+    index = _cached(source)
+    if isinstance(index, ZoneIndex):
+        return index
+
+    ra = np.ma.filled(np.ma.asarray(df.evaluate("ra"), dtype=np.float64),
+                      np.nan)
+    dec = np.ma.filled(np.ma.asarray(df.evaluate("dec"), dtype=np.float64),
+                       np.nan)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(ra))
+    digest.update(np.ascontiguousarray(dec))
+    path = os.path.join(settings.scratch, "indexes",
+                        f"positions-{ZONE_HEIGHT:g}-{digest.hexdigest()}")
+    names = ("key", "dec", "rows")
+    try:
+        index = ZoneIndex(*(np.load(os.path.join(path, f"{name}.npy"),
+                                    mmap_mode="r") for name in names))
+        logger.debug(f"loaded position index {path}")
+    except FileNotFoundError:
+        index = ZoneIndex.build(ra, dec)
+        # write aside, then move into place, so readers never see part of it
+        partial = f"{path}.{os.getpid()}"
+        os.makedirs(partial, exist_ok=True)
+        for name in names:
+            np.save(os.path.join(partial, f"{name}.npy"), getattr(index, name))
+        try:
+            os.rename(partial, path)
+            logger.debug(f"saved position index {path}")
+        except OSError:  # another process got there first
+            shutil.rmtree(partial, ignore_errors=True)
+    _cache(source, index)
+    return index
+
+
+def match_positions(df: vx.DataFrame,
+                    crossmatch: str) -> tuple[np.ndarray, int, int]:
+    """Matches positions against the zone index of `ra` and `dec`.
+
+    Args:
+        df: unfiltered dataframe, as from `load_dataframe`
+        crossmatch: positions, see `util.spatial.parse_positions`
+
+    Returns:
+        The rows within the radius of any position, then the number of
+        positions with and without any rows.
+    """
+    ra, dec, radius = parse_positions(crossmatch)
+    index = position_index(df)
+    points, query = index.search(ra, dec, radius)
+    found = len(np.unique(query))
+    rows = points if index.rows is None else index.rows[points]
+    return np.unique(rows), found, len(ra) - found
+
+
+def parse_identifiers(crossmatch: str, numeric: bool) -> np.ndarray:
+    """Parses whitespace-separated identifiers into a sorted unique array.
+
+    Cached, so the same identifiers aren't parsed again for counting and
+    filtering within a job. The cache is keyed by a hash of the text, which
+    can be many megabytes, rather than holding on to the text itself.
+
+    Raises:
+        ValueError: if numeric identifiers fail to convert to integers
+    """
+    key = (hashlib.sha256(crossmatch.encode()).digest(), numeric)
+    parsed = _identifiers.get(key)
+    if parsed is not None:
+        _identifiers.move_to_end(key)
+        return parsed
+    identifiers = crossmatch.split()
+    if numeric:
+        try:
+            parsed = np.unique(np.array(identifiers, dtype=np.int64))
+        except (ValueError, OverflowError):
+            raise ValueError("failed to convert to integer identifiers")
+    else:
+        parsed = np.unique(np.array(identifiers, dtype=object))
+    _identifiers[key] = parsed
+    while len(_identifiers) > IDENTIFIER_CACHE_SIZE:
+        _identifiers.popitem(last=False)
+    return parsed
+
+
+def match_identifiers(df: vx.DataFrame, crossmatch: str,
+                      cmtype: str) -> tuple[np.ndarray, int, int]:
+    """Matches identifiers against the sorted index of their column.
+
+    Args:
+        df: unfiltered dataframe, as from `load_dataframe`
+        crossmatch: whitespace-separated identifiers, or positions
+        cmtype: identifier type, see `util.filters.crossmatchList`, or
+            `position`
+
+    Returns:
+        The rows matching any identifier, then the number of unique
+        identifiers found and not found.
+
+    Raises:
+        ValueError: if the identifier type is unknown, or identifiers are invalid
+    """
+    if cmtype == POSITION_CMTYPE:
+        return match_positions(df, crossmatch)
+    if cmtype not in crossmatchList:
+        raise ValueError(f"unsupported crossmatch type {cmtype}")
+    column = crossmatchList[cmtype]
+    numeric = df[column].dtype != "string"
+    identifiers = parse_identifiers(crossmatch, numeric)
+    rows, found = column_index(df, column).lookup(identifiers)
+    return rows, found, len(identifiers) - found
+
+
+def filter_crossmatch_indexed(
+        df: vx.DataFrame,
+        crossmatch: str,
+        cmtype: str,
+        rows: np.ndarray | None = None) -> vx.Expression | None:
+    """Generates a crossmatch filter from the sorted index of its column.
+
+    The matching rows are marked in a hidden boolean column added to `df`, so
+    `df` must be a copy, as from `load_dataframe`.
+
+    Args:
+        df: unfiltered dataframe to filter
+        crossmatch: whitespace-separated identifiers
+        cmtype: identifier type
+        rows: rows matching the identifiers, if already matched by
+            `match_identifiers`
+
+    Returns:
+        The filter, or `None` if there are no identifiers.
+
+    Raises:
+        ValueError: if the identifier type is unknown, or identifiers are invalid
+        TypeError: if tic_v8 with spall (not supported)
+    """
+    if not crossmatch.strip():
+        return None
+    # bhm doesnt fetch tic_v8's so flag
+    if (cmtype == "tic_v8") and (df["pipeline"].unique()[0] == "spall"):
+        raise TypeError("tic_v8 not supported with spall dataset")
+    if rows is None:
+        rows, _, _ = match_identifiers(df, crossmatch, cmtype)
+    mask = np.zeros(len(df), dtype=bool)
+    mask[rows] = True
+    name = f"__crossmatch_{len(df.get_column_names(hidden=True))}"
+    df.add_column(name, mask)
+    return df[name]
+
+
+def read_identifiers(data: bytes, cmtype: str) -> str:
+    """Reads an uploaded identifier file into newline-separated identifiers.
+
+    Files may be plain text with one identifier per line, CSV, or parquet. Of
+    CSV and parquet files, the column named after the identifier type or its
+    column (i.e. `gaia_dr3` or `gaia_dr3_source_id`) is read, or else the first.
+    CSV files without a header are read if their first value is an integer.
+    Positions are read by `read_positions`.
+
+    Args:
+        data: file contents
+        cmtype: identifier type
+
+    Returns:
+        Newline-separated identifiers, as for the `crossmatch` parameter.
+
+    Raises:
+        ValueError: if the file can't be read
+    """
+    if cmtype == POSITION_CMTYPE:
+        return read_positions(data)
+    names = (cmtype, crossmatchList.get(cmtype, cmtype))
+    try:
+        if data[:4] == b"PAR1":
+            table = pq.read_table(io.BytesIO(data))
+        else:
+            first = data.split(b"\n", 1)[0].decode().strip()
+            if ("," not in first) and (first not in names):  # plain text
+                return data.decode()
+            header = [name.strip() for name in first.split(",")]
+            headless = (not set(names) & set(header)) and header[0].isdigit()
+            table = pacsv.read_csv(
+                io.BytesIO(data),
+                read_options=pacsv.ReadOptions(
+                    autogenerate_column_names=headless),
+                convert_options=pacsv.ConvertOptions(
+                    column_types={name: pa.string()
+                                  for name in names}),
+            )
+    except (pa.ArrowException, UnicodeDecodeError) as e:
+        raise ValueError(f"failed to read identifier file: {e}")
+    if table.num_columns == 0:
+        return ""
+    column = next((name for name in names if name in table.column_names),
+                  table.column_names[0])
+    values = table[column].drop_null().cast(pa.string())
+    return "\n".join(values.to_pylist())
+
+
+def read_positions(data: bytes) -> str:
+    """Reads an uploaded position file into newline-separated positions.
+
+    Files may be text or CSV without a header, with `ra dec [radius]` per line,
+    or CSV with a header, or parquet. Of those, the `ra`, `dec` and `radius`
+    columns are read, or else the first two or three.
+
+    Args:
+        data: file contents
+
+    Returns:
+        Newline-separated positions, as for the `crossmatch` parameter.
+
+    Raises:
+        ValueError: if the file can't be read
+    """
+    try:
+        if data[:4] == b"PAR1":
+            table = pq.read_table(io.BytesIO(data))
+        else:
+            text = data.decode()
+            first = text.split("\n", 1)[0].replace(",", " ").split()
+            try:
+                float(first[0] if first else "")
+                return text  # no header, so already positions
+            except ValueError:
+                pass
+            table = pacsv.read_csv(io.BytesIO(data))
+    except (pa.ArrowException, UnicodeDecodeError) as e:
+        raise ValueError(f"failed to read position file: {e}")
+    columns = [c for c in ("ra", "dec", "radius") if c in table.column_names]
+    if len(columns) < 2:
+        columns = table.column_names[:3]
+    if len(columns) < 2:
+        raise ValueError("position files need ra and dec columns")
+    positions = np.column_stack([
+        table[c].cast(pa.float64()).to_numpy(zero_copy_only=False)
+        for c in columns
+    ])
+    positions = positions[np.isfinite(positions).all(axis=1)]
+    buffer = io.StringIO()
+    np.savetxt(buffer, positions, fmt="%.12g")
+    return buffer.getvalue()
@@ -2,15 +2,223 @@
 
 import json
 import os
+import re
 import logging
+from collections import OrderedDict
+from math import prod
+
 import vaex as vx
 
+from .progress import set_queue
+from ..util.bitmaps import add_row_column, materialize_row_column
 from ..util.config import settings
+from ..util.sidecars import attach_sidecars
+
+__all__ = [
+    "DataFrameCache",
+    "estimate_nbytes",
+    "init_worker",
+    "data_path",
+    "discover_datasets",
+    "warm_up",
+    "load_columns",
+    "load_dataframe",
+    "mappings",
+]
 
 logger = logging.getLogger("server")
 
 mappings = vx.open(os.path.join(settings.datapath, "mappings.parquet"))
 
+# assumed mean bytes per row of string columns, used for memory estimation only
+STRING_NBYTES = 16
+
+
+def estimate_nbytes(df: vx.DataFrame,
+                    columns: list[str] | None = None) -> int:
+    """Estimates the in-memory size of the given columns of a dataframe.
+
+    Note:
+        `vx.DataFrame.byte_size` fails on extracted (filtered) datasets, so this
+        computes it from the dtypes instead.
+
+    Args:
+        df: dataframe to estimate
+        columns: columns to include. Defaults to all real columns.
+
+    Returns:
+        Estimated size in bytes.
+    """
+    if columns is None:
+        columns = df.get_column_names(virtual=False)
+    rowsize = 0
+    for col in columns:
+        dtype = df.data_type(col)
+        if dtype.is_string:
+            rowsize += STRING_NBYTES
+        else:
+            rowsize += dtype.numpy.itemsize * prod(df[col].shape[1:])
+    return rowsize * len(df)
+
+
+class DataFrameCache:
+    """Bounded LRU cache of pipeline dataframes, one instance per export process.
+
+    Entries are keyed by `(release, datatype, dataset)`, and hold the extracted
+    pipeline dataframe and its valid columns. Least recently used entries are
+    evicted once the estimated size of all entries exceeds the budget.
+
+    Attributes:
+        budget: memory budget in bytes
+        nbytes: current estimated size of all entries in bytes
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.nbytes = 0
+        self._entries: OrderedDict[tuple[str, str, str],
+                                   tuple[vx.DataFrame, list[str],
+                                         int]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: tuple[str, str, str]) -> bool:
+        return key in self._entries
+
+    def get(self, key: tuple[str, str,
+                             str]) -> tuple[vx.DataFrame, list[str]] | None:
+        """Gets an entry and marks it as most recently used.
+
+        Args:
+            key: `(release, datatype, dataset)` key
+
+        Returns:
+            A tuple of the dataframe and valid columns, or `None` on a miss.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0], entry[1]
+
+    def put(self, key: tuple[str, str, str], df: vx.DataFrame,
+            columns: list[str]) -> bool:
+        """Adds an entry, evicting least recently used entries to fit the budget.
+
+        Args:
+            key: `(release, datatype, dataset)` key
+            df: extracted pipeline dataframe
+            columns: valid columns for this dataset
+
+        Returns:
+            `True` if the entry was cached, `False` if it alone exceeds the budget.
+        """
+        nbytes = estimate_nbytes(df)
+        if nbytes > self.budget:
+            logger.debug(f"not caching {key}: {nbytes} exceeds budget")
+            return False
+        self.pop(key)
+        while self._entries and (self.nbytes + nbytes > self.budget):
+            oldkey, _ = next(iter(self._entries.items()))
+            logger.debug(f"evicting {oldkey} from dataframe cache")
+            self.pop(oldkey)
+        self._entries[key] = (df, columns, nbytes)
+        self.nbytes += nbytes
+        return True
+
+    def pop(self, key: tuple[str, str, str]) -> None:
+        """Removes an entry if present."""
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[2]
+
+    def clear(self) -> None:
+        """Removes all entries."""
+        self._entries.clear()
+        self.nbytes = 0
+
+
+# per-process cache; reset by `init_worker` in each export process
+cache = DataFrameCache(settings.dfcache_size)
+
+
+def init_worker(queue=None, preload: bool = False) -> None:
+    """Initializer for export processes.
+
+    Ensures vaex caching is on. Export processes are not forked from the
+    server, so they load their own dataframes with `warm_up` if asked to.
+
+    Args:
+        queue (multiprocessing.Queue): queue to report job progress to
+        preload: whether to load all pipeline dataframes now
+    """
+    set_queue(queue)
+    vx.cache.on()
+    cache.budget = settings.dfcache_size
+    if preload:
+        warm_up()
+    logger.debug(
+        f"export process {os.getpid()} initialized with {len(cache)} cached dataframes"
+    )
+
+
+def data_path(release: str, datatype: str) -> str:
+    """Path of the data file of a release and datatype."""
+    return os.path.join(
+        settings.datapath,
+        release,
+        f"explorerAll{datatype.capitalize()}-{settings.vastra}.hdf5",
+    )
+
+
+def discover_datasets() -> list[tuple[str, str, str]]:
+    """Lists every `(release, datatype, dataset)` with files under `settings.datapath`."""
+    pattern = re.compile(
+        rf"columnsAll(\w+)-{re.escape(settings.vastra)}\.json")
+    found: list[tuple[str, str, str]] = []
+    if not os.path.isdir(settings.datapath):
+        return found
+    for release in sorted(os.listdir(settings.datapath)):
+        releasedir = os.path.join(settings.datapath, release)
+        if not os.path.isdir(releasedir):
+            continue
+        for filename in sorted(os.listdir(releasedir)):
+            match = pattern.fullmatch(filename)
+            if match is None:
+                continue
+            datatype = match.group(1).lower()
+            if not os.path.isfile(data_path(release, datatype)):
+                continue
+            with open(os.path.join(releasedir, filename)) as f:
+                datasets = json.load(f).keys()
+            found.extend((release, datatype, dataset) for dataset in datasets)
+    return found
+
+
+def warm_up(datasets: list[tuple[str, str, str]] | None = None) -> int:
+    """Loads pipeline dataframes into this process's cache ahead of any job.
+
+    This opens the release files and builds each pipeline's row index once,
+    so the first request or job in this process doesn't pay the load.
+
+    Args:
+        datasets: `(release, datatype, dataset)` keys to load. Defaults to all
+            found by `discover_datasets`.
+
+    Returns:
+        Number of dataframes in the cache.
+    """
+    for key in (discover_datasets() if datasets is None else datasets):
+        try:
+            load_dataframe(*key)
+        except Exception as e:
+            logger.warning(f"failed to preload {key}: {e}")
+            continue
+        if key not in cache:
+            logger.warning(f"{key} exceeds the dataframe cache budget, not preloaded")
+    return len(cache)
+
 
 def load_columns(release: str, datatype: str, dataset: str):
     """Loads the given columns for a release and datatype"""
@@ -27,7 +235,21 @@ def load_columns(release: str, datatype: str, dataset: str):
 def load_dataframe(
         release: str, datatype: str,
         dataset: str) -> tuple[vx.DataFrame | None, list[str] | None]:
-    """Loads base dataframe and applies dataset filter IMMEDIATELY to reduce memory usage"""
+    """Loads base dataframe and applies dataset filter IMMEDIATELY to reduce memory usage.
+
+    Repeated loads of the same dataset are served from the per-process cache.
+
+    Note:
+        Returns a shallow copy of the cached dataframe, so filters applied to it
+        do not touch the cached entry.
+    """
+    key = (release, datatype, dataset)
+    entry = cache.get(key)
+    if entry is not None:
+        logger.debug("loaded dataframe from cache!")
+        dff, validCols = entry
+        return dff.copy(), list(validCols)
+
     dataroot_dir = settings.datapath
     if dataroot_dir:
         logger.debug("opening dataframe")
@@ -37,15 +259,15 @@ def load_dataframe(
             col for col in cols
             if ("_flags" not in col) and (col != "pipeline")
         ]
-        df = vx.open(
-            os.path.join(
-                dataroot_dir,
-                release,
-                f"explorerAll{datatype.capitalize()}-{settings.vastra}.hdf5",
-            ))
+        path = data_path(release, datatype)
+        df = vx.open(path)
+        add_row_column(df)
         dff = df[df[f"pipeline == '{dataset}'"]].extract()
+        materialize_row_column(dff)
+        attach_sidecars(dff, path)
+        cache.put(key, dff, validCols)
         logger.debug("loaded dataframe!")
-        return dff, validCols
+        return dff.copy(), list(validCols)
     else:
         logger.critical("Cannot load df!")
         return None, None
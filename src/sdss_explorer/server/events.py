@@ -0,0 +1,97 @@
+"""Push notifications of job updates, served as Server-Sent Events."""
+
+import asyncio
+import logging
+from collections.abc import AsyncIterator, Iterator
+from contextlib import contextmanager
+from uuid import UUID
+
+from .jobs import Job, JobStore
+
+__all__ = ["JobEvents", "format_event"]
+
+logger = logging.getLogger("server")
+
+
+def format_event(job: Job) -> str:
+    """Formats a job as a Server-Sent Event."""
+    return f"event: job\ndata: {job.model_dump_json()}\n\n"
+
+
+class JobEvents:
+    """Broadcasts job updates to subscribers in this server process.
+
+    Listens to `put` on the job store, so updates made by this server process
+    are pushed immediately. Updates made by other server workers are picked
+    up by re-reading the store every `recheck` seconds while subscribed.
+
+    Attributes:
+        store: job store to listen to
+        recheck: time in seconds between re-reads of the store
+    """
+
+    def __init__(self, store: JobStore, recheck: float = 1.0):
+        self.store = store
+        self.recheck = recheck
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._subscribers: dict[UUID, set[asyncio.Queue]] = {}
+
+    def start(self) -> None:
+        """Starts listening to the store. Call from within the event loop."""
+        self._loop = asyncio.get_running_loop()
+        self.store.listeners.append(self._on_put)
+
+    def shutdown(self) -> None:
+        """Stops listening to the store."""
+        if self._on_put in self.store.listeners:
+            self.store.listeners.remove(self._on_put)
+
+    def _on_put(self, job: Job) -> None:
+        # called from any thread, so hand over to the event loop
+        if (self._loop is not None) and (job.uid in self._subscribers):
+            self._loop.call_soon_threadsafe(self.publish, job.model_copy())
+
+    def publish(self, job: Job) -> None:
+        """Sends a job update to all its subscribers, replacing any unread update."""
+        for queue in self._subscribers.get(job.uid, ()):
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(job)
+
+    @contextmanager
+    def subscribe(self, uid: UUID) -> Iterator[asyncio.Queue]:
+        """Subscribes to updates of a job.
+
+        Yields:
+            Queue holding the latest unread update.
+        """
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self._subscribers.setdefault(uid, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers[uid].discard(queue)
+            if not self._subscribers[uid]:
+                del self._subscribers[uid]
+
+    async def stream(self, uid: UUID) -> AsyncIterator[str]:
+        """Streams a job's updates as Server-Sent Events until it finishes.
+
+        The current state is sent first. Comments are sent as keepalives while
+        nothing changes.
+        """
+        with self.subscribe(uid) as queue:
+            job = self.store.get(uid)  # read after subscribing to miss nothing
+            last = None
+            while job is not None:
+                if job != last:
+                    yield format_event(job)
+                    last = job
+                else:
+                    yield ": keepalive\n\n"
+                if job.status != "in_progress":
+                    return
+                try:
+                    job = await asyncio.wait_for(queue.get(), self.recheck)
+                except asyncio.TimeoutError:
+                    job = self.store.get(uid)  # may be run by another worker
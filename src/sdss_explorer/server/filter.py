@@ -1,31 +1,96 @@
 import os
 import gc
+import io
+import shutil
 import logging
-from typing import ParamSpec
+from typing import Any, Callable, Iterator, ParamSpec
 from uuid import UUID
 import operator
+from collections import OrderedDict
 from functools import reduce
 from datetime import datetime
 
-from .dataframe import load_dataframe, mappings
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import vaex as vx
+from vaex.execution import UserAbort
+
+from .crossmatch import filter_crossmatch_indexed, match_identifiers
+from .dataframe import estimate_nbytes, load_dataframe, mappings
+from .jobs import fingerprint, is_cancelled
+from .progress import JobAborted, ProgressReporter
+from .sample import is_sampled, sample_dataframe, validate_sample
 from ..util.config import settings
 from ..util.filters import (
     filter_carton_mapper,
     filter_flags,
-    filter_crossmatch,
     filter_expression,
 )
 
+try:
+    import vaex.astro  # noqa: F401 -- only needed for fits export
+    HAS_FITS = True
+except ImportError:
+    HAS_FITS = False
+
 _P = ParamSpec("_P")
 logger = logging.getLogger("server")
 
+# rows per chunk when writing or streaming exports
+CHUNK_SIZE = int(60e3)
 
-def filter_dataframe(
-    uuid: UUID,
-    release: str,
-    datatype: str,
+# media types of streamable formats
+STREAM_FORMATS = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+# file extensions of exportable formats
+EXPORT_FORMATS = {
+    "parquet": "parquet",
+    "arrow": "arrow",
+    "feather": "feather",
+    "hdf5": "hdf5",
+    "csv": "csv",
+    "fits": "fits",
+}
+
+PARQUET_COMPRESSIONS = ("snappy", "gzip", "brotli", "zstd", "lz4", "none")
+
+# rough ratio of output file size to in-memory size, per format
+FORMAT_RATIOS = {
+    "parquet": 0.6,
+    "arrow": 1.0,
+    "feather": 1.0,
+    "hdf5": 1.0,
+    "csv": 2.5,
+    "fits": 1.0,
+}
+
+# parameters that change which rows match, as opposed to export options
+FILTER_PARAMS = (
+    "expression",
+    "carton",
+    "mapper",
+    "flags",
+    "crossmatch",
+    "cmtype",
+    "combotype",
+    "invert",
+)
+
+# maximum number of cached filter counts per process
+COUNT_CACHE_SIZE = 4096
+
+# (rows_total, rows_matched) by `count_key`, least recently used first
+_counts: OrderedDict[str, tuple[int, int]] = OrderedDict()
+
+
+def build_filter(
+    dff: vx.DataFrame,
+    columns: list[str],
     dataset: str,
-    name: str = "A",
     expression: str = "",
     carton: str = "",
     mapper: str = "",
@@ -34,95 +99,528 @@ def filter_dataframe(
     cmtype: str = "",
     combotype: str = "AND",
     invert: bool = False,
-) -> None:
-    """Filters and exports dataframe based on input subset parameters.
+    crossmatch_rows: np.ndarray | None = None,
+) -> vx.Expression | None:
+    """Builds the combined filter expression of subset filter parameters.
 
-    Will write a file to the scratch disk based on `settings.scratch`.
+    Note:
+        Crossmatches add a hidden column to `dff`, so it must be a copy, as
+        from `load_dataframe`.
 
     Args:
-        uuid: unique job id
-        release: data release
-        datatype: datatype (star or visit)
+        dff: pipeline dataframe, as from `load_dataframe`
+        columns: valid columns of the dataset
         dataset: specific dataset i.e. aspcap, spall, best
-        name: name of subset, used in generating output file
         expression: filter expression
         carton: comma-separated cartons
         mapper: comma-separated mappers
-        flags: comma-separated flagss
+        flags: comma-separated flags
+        crossmatch: multiline string of identifiers
+        cmtype: crossmatch identifier type
         combotype: logical reducer for carton/mapper
         invert: whether to invert all filters
+        crossmatch_rows: rows matching the crossmatch, if already matched by
+            `crossmatch.match_identifiers`
 
     Returns:
-        None
+        The filter expression, or `None` if there is nothing to filter on.
     """
-    logger.debug("starting filter job")
-    dff, columns = load_dataframe(release, datatype, dataset)
-    if (dff is None) or (columns is None):
-        raise Exception("dataframe/columns load failed")
     filters = list()
 
-    # generic unpack; show to console
-    logger.debug(f"""requested {release}/{datatype}/{dataset}{uuid}
-                 expr:                 {expression} 
-                 carton:               {carton} 
-                 mapper:               {mapper} 
-                 flags:                {flags}
-                 crossmatch({cmtype}): {crossmatch[:8]}...
-                 combotype:            {combotype}
-                 invert:               {invert}
-                 """)
-
     # process list-like data
-    if carton:
-        carton: list[str] = carton.split(",")
-    if mapper:
-        mapper: list[str] = mapper.split(",")
-    if flags:
-        flags: list[str] = flags.split(",")
+    cartons = carton.split(",") if carton else []
+    mappers = mapper.split(",") if mapper else []
+    flaglist = flags.split(",") if flags else []
 
     # make all filters via utility funcs
     if expression:
         filters.append(
             filter_expression(dff, columns, expression, invert=invert))
-    if carton or mapper:
+    if cartons or mappers:
         cmp_filter = filter_carton_mapper(
             dff,
             mappings,
-            carton if carton else [],
-            mapper if mapper else [],
+            cartons,
+            mappers,
             combotype=combotype,
             invert=invert,
         )
         filters.append(cmp_filter)
-    if flags:
-        flagfilter = filter_flags(dff, flags, dataset, invert=invert)
+    if flaglist:
+        flagfilter = filter_flags(dff, flaglist, dataset, invert=invert)
         filters.append(flagfilter)
     if len(crossmatch) > 0:
-        crossmatchFilter = filter_crossmatch(dff, crossmatch, cmtype)
+        crossmatchFilter = filter_crossmatch_indexed(dff, crossmatch, cmtype,
+                                                     crossmatch_rows)
         filters.append(crossmatchFilter)
 
     # concat all and go!
     filters = [f for f in filters if f is not None]
     if filters:
-        totalfilter = reduce(operator.__and__, filters)
+        return reduce(operator.__and__, filters)
+    return None
+
+
+def apply_filters(dff: vx.DataFrame, columns: list[str], dataset: str,
+                  **kwargs) -> vx.DataFrame:
+    """Applies subset filter parameters to a pipeline dataframe.
+
+    Args:
+        dff: pipeline dataframe, as from `load_dataframe`
+        columns: valid columns of the dataset
+        dataset: specific dataset i.e. aspcap, spall, best
+        kwargs: filter parameters, see `build_filter`
+
+    Returns:
+        The filtered dataframe. Nothing is evaluated yet.
+    """
+    totalfilter = build_filter(dff, columns, dataset, **kwargs)
+    if totalfilter is not None:
         dff = dff[totalfilter]
-    if len(dff) == 0:
+    return dff
+
+
+def load_filtered(release: str,
+                  datatype: str,
+                  dataset: str,
+                  progress: ProgressReporter | None = None,
+                  **kwargs) -> tuple[vx.DataFrame, list[str]]:
+    """Loads a pipeline dataframe and applies subset filter parameters.
+
+    Args:
+        release: data release
+        datatype: datatype (star or visit)
+        dataset: specific dataset i.e. aspcap, spall, best
+        progress: reporter for the loading and filtering stages
+        kwargs: filter parameters, see `apply_filters`
+
+    Returns:
+        The filtered dataframe and its valid columns. With a crossmatch, the
+        numbers of identifiers found and not found are reported as
+        `ids_matched` and `ids_unknown`.
+
+    Raises:
+        Exception: if the load fails or no rows match
+    """
+    if progress is not None:
+        progress.set_stage("loading")
+    dff, columns = load_dataframe(release, datatype, dataset)
+    if (dff is None) or (columns is None):
+        raise Exception("dataframe/columns load failed")
+
+    total = len(dff)
+    if progress is not None:
+        progress.set_stage("filtering", rows_total=total)
+    identifiers = dict()
+    if kwargs.get("crossmatch", "").strip():
+        # matched once, for both the counts and the filter
+        rows, found, unknown = match_identifiers(dff, kwargs["crossmatch"],
+                                                 kwargs.get("cmtype", ""))
+        identifiers = dict(ids_matched=found, ids_unknown=unknown)
+        kwargs["crossmatch_rows"] = rows
+    dff = apply_filters(dff, columns, dataset, **kwargs)
+    matched = int(dff.count(progress=progress))  # evaluates the filter
+    if progress is not None:
+        progress.report(1.0,
+                        force=True,
+                        rows_scanned=total,
+                        rows_matched=matched,
+                        **identifiers)
+    if matched == 0:
+        if identifiers and not identifiers["ids_matched"]:
+            raise Exception(
+                f"none of the {identifiers['ids_unknown']} identifiers were found")
         raise Exception("attempting to export 0 length df")
+    return dff, columns
+
+
+def count_key(release: str, datatype: str, dataset: str, **kwargs) -> str:
+    """Fingerprint of only the filter parameters of a request, ignoring export options."""
+    return fingerprint(release, datatype, dataset,
+                       **{k: kwargs[k]
+                          for k in FILTER_PARAMS if k in kwargs})
+
+
+def cached_count(release: str, datatype: str, dataset: str,
+                 **kwargs) -> tuple[int, int] | None:
+    """Gets the cached `(rows_total, rows_matched)` of filter parameters, or `None`."""
+    key = count_key(release, datatype, dataset, **kwargs)
+    counts = _counts.get(key)
+    if counts is not None:
+        _counts.move_to_end(key)
+    return counts
+
+
+def record_count(release: str, datatype: str, dataset: str, rows_total: int,
+                 rows_matched: int, **kwargs) -> None:
+    """Caches the row counts of filter parameters."""
+    key = count_key(release, datatype, dataset, **kwargs)
+    _counts[key] = (rows_total, rows_matched)
+    _counts.move_to_end(key)
+    while len(_counts) > COUNT_CACHE_SIZE:
+        _counts.popitem(last=False)
+
+
+def estimate_export(release: str,
+                    datatype: str,
+                    dataset: str,
+                    columns: str = "",
+                    **kwargs) -> dict:
+    """Counts the rows matching filter parameters and estimates output sizes.
+
+    Nothing is extracted or written. Counts are answered from the cache where
+    possible, and cached otherwise.
+
+    Args:
+        release: data release
+        datatype: datatype (star or visit)
+        dataset: specific dataset i.e. aspcap, spall, best
+        columns: comma-separated columns to export. Defaults to all.
+        kwargs: filter parameters, see `build_filter`. Others are ignored.
+
+    Returns:
+        Dictionary of `rows_total`, `rows_matched`, `selectivity`, number of
+        `columns`, whether the count was `cached`, and estimated output bytes
+        per format as `nbytes`. With a crossmatch, also the numbers of
+        identifiers found and not found as `ids_matched` and `ids_unknown`.
+
+    Raises:
+        Exception: if the load fails
+        ValueError: if filters or columns are invalid
+    """
+    filters = {k: kwargs[k] for k in FILTER_PARAMS if k in kwargs}
+    dff, validCols = load_dataframe(release, datatype, dataset)
+    if (dff is None) or (validCols is None):
+        raise Exception("dataframe/columns load failed")
+    exportCols = project_columns(validCols, columns)
+
+    total = len(dff)
+    identifiers = dict()
+    rows = None
+    if filters.get("crossmatch", "").strip():
+        rows, found, unknown = match_identifiers(dff, filters["crossmatch"],
+                                                 filters.get("cmtype", ""))
+        identifiers = dict(ids_matched=found, ids_unknown=unknown)
+    counts = cached_count(release, datatype, dataset, **filters)
+    if counts is not None:
+        matched = counts[1]
+    else:
+        matched = int(
+            apply_filters(dff, validCols, dataset, crossmatch_rows=rows,
+                          **filters).count())
+        record_count(release, datatype, dataset, total, matched, **filters)
+
+    nbytes = estimate_nbytes(dff, exportCols) * matched / max(total, 1)
+    estimate = dict(
+        rows_total=total,
+        rows_matched=matched,
+        selectivity=matched / total if total else 0.0,
+        columns=len(exportCols),
+        cached=counts is not None,
+        nbytes={
+            format: int(nbytes * ratio)
+            for format, ratio in FORMAT_RATIOS.items()
+        },
+        **identifiers,
+    )
+    return estimate
+
+
+def validate_export(format: str = "parquet",
+                    compression: str = "snappy",
+                    row_group_size: int = CHUNK_SIZE) -> None:
+    """Validates export format options.
 
-    # make directory and pass back after successful export
-    os.makedirs(os.path.join(settings.scratch, str(uuid)), exist_ok=True)
+    Raises:
+        ValueError: if any option is unsupported
+    """
+    if format not in EXPORT_FORMATS:
+        raise ValueError(f"unsupported export format {format}")
+    if (format == "fits") and not HAS_FITS:
+        raise ValueError("fits export is not available on this server")
+    if compression not in PARQUET_COMPRESSIONS:
+        raise ValueError(f"unsupported parquet compression {compression}")
+    if row_group_size <= 0:
+        raise ValueError("row group size must be positive")
+
+
+def project_columns(validCols: list[str], columns: str = "") -> list[str]:
+    """Selects the columns to export.
+
+    Args:
+        validCols: valid columns of the dataset
+        columns: comma-separated columns to export. Defaults to all valid columns.
+
+    Returns:
+        List of columns, in requested order.
+
+    Raises:
+        ValueError: if any requested column is not valid for the dataset
+    """
+    if not columns:
+        return validCols
+    requested = list(
+        dict.fromkeys(col.strip() for col in columns.split(",")
+                      if col.strip()))
+    invalid = [col for col in requested if col not in validCols]
+    if invalid:
+        raise ValueError(f"invalid columns for dataset: {', '.join(invalid)}")
+    return requested
+
+
+def export_file(dff: vx.DataFrame,
+                disk_path: str,
+                format: str = "parquet",
+                compression: str = "snappy",
+                row_group_size: int = CHUNK_SIZE,
+                progress: Callable[[float], bool] | None = None) -> None:
+    """Writes a projected dataframe to disk in the given format.
+
+    Args:
+        dff: filtered and projected dataframe
+        disk_path: output path
+        format: output format, one of `EXPORT_FORMATS`
+        compression: parquet compression codec
+        row_group_size: rows per parquet row group; also the write chunk size
+        progress: vaex progress callback. Not supported for feather.
+    """
+    if format == "parquet":
+        dff.export_parquet(
+            disk_path,
+            progress=progress,
+            chunk_size=row_group_size,
+            compression=None if compression == "none" else compression,
+        )
+    elif format == "arrow":
+        dff.export_arrow(disk_path,
+                         progress=progress,
+                         chunk_size=row_group_size,
+                         as_stream=False)
+    elif format == "feather":
+        dff.export_feather(disk_path)
+    elif format == "hdf5":
+        dff.export_hdf5(disk_path,
+                        progress=progress,
+                        chunk_size=row_group_size)
+    elif format == "csv":
+        dff.export_csv(disk_path,
+                       progress=progress,
+                       chunk_size=row_group_size)
+    elif format == "fits":
+        dff.export_fits(disk_path, progress=progress)
+    else:
+        raise ValueError(f"unsupported export format {format}")
+
+
+def export_filename(name: str, release: str, datatype: str, dataset: str,
+                    ext: str) -> str:
+    """Generates a timestamped filename for an exported subset."""
     currentTime = "{date:%Y-%m-%d_%H:%M:%S}".format(date=datetime.now())
-    filename = f"subset-{name}-{release}-{datatype}-{dataset}-{currentTime}.parquet"
-    filepath = os.path.join(str(uuid), filename)
-    disk_path = os.path.join(settings.scratch, filepath)
+    return f"subset-{name}-{release}-{datatype}-{dataset}-{currentTime}.{ext}"
+
+
+def filter_dataframe(
+    uuid: UUID,
+    release: str,
+    datatype: str,
+    dataset: str,
+    name: str = "A",
+    expression: str = "",
+    carton: str = "",
+    mapper: str = "",
+    flags: str = "",
+    crossmatch: str = "",
+    cmtype: str = "",
+    combotype: str = "AND",
+    invert: bool = False,
+    columns: str = "",
+    format: str = "parquet",
+    compression: str = "snappy",
+    row_group_size: int = CHUNK_SIZE,
+    sample_size: int = 0,
+    sample_fraction: float = 0.0,
+    sample_seed: int = 0,
+    stratify: str = "",
+    quota: str = "",
+) -> tuple[str, dict[str, int]]:
+    """Filters and exports dataframe based on input subset parameters.
 
-    # extract, then export
-    dff = dff[columns].extract()
-    dff.export_parquet(disk_path, chunk_size=int(60e3))
+    Will write a file to the scratch disk based on `settings.scratch`. Only the
+    exported columns (and those used in filters) are read from the source file.
+    If a sample is requested, rows are sampled after filtering, so only the
+    sampled rows are extracted. `rows_matched` counts rows before sampling.
+
+    Args:
+        uuid: unique job id
+        release: data release
+        datatype: datatype (star or visit)
+        dataset: specific dataset i.e. aspcap, spall, best
+        name: name of subset, used in generating output file
+        expression: filter expression
+        carton: comma-separated cartons
+        mapper: comma-separated mappers
+        flags: comma-separated flagss
+        combotype: logical reducer for carton/mapper
+        invert: whether to invert all filters
+        columns: comma-separated columns to export. Defaults to all.
+        format: output format, one of `EXPORT_FORMATS`
+        compression: parquet compression codec
+        row_group_size: rows per parquet row group
+        sample_size: number of rows to sample. Defaults to all.
+        sample_fraction: fraction of rows to sample
+        sample_seed: seed of the sample
+        stratify: column to stratify the sample by, or `carton`
+        quota: rows per stratum, see `sample.parse_quota`
+
+    Returns:
+        Path of the output file, relative to the scratch space, and the job's
+        final row and identifier counts, see `progress.COUNT_FIELDS`.
+    """
+    logger.debug("starting filter job")
+    validate_export(format, compression, row_group_size)
+    sample: dict[str, Any] = dict(sample_size=sample_size,
+                                  sample_fraction=sample_fraction,
+                                  sample_seed=sample_seed,
+                                  stratify=stratify,
+                                  quota=quota)
+    validate_sample(**sample, carton=carton)
+
+    # generic unpack; show to console
+    logger.debug(f"""requested {release}/{datatype}/{dataset}{uuid}
+                 expr:                 {expression}
+                 carton:               {carton}
+                 mapper:               {mapper}
+                 flags:                {flags}
+                 crossmatch({cmtype}): {crossmatch[:8]}...
+                 combotype:            {combotype}
+                 invert:               {invert}
+                 """)
+
+    reporter = ProgressReporter(
+        uuid,
+        timeout=settings.job_timeout,
+        memory=settings.job_memory,
+        cancelled=lambda: is_cancelled(uuid),
+    )
+    try:
+        dff, validCols = load_filtered(
+            release,
+            datatype,
+            dataset,
+            progress=reporter,
+            expression=expression,
+            carton=carton,
+            mapper=mapper,
+            flags=flags,
+            crossmatch=crossmatch,
+            cmtype=cmtype,
+            combotype=combotype,
+            invert=invert,
+        )
+        exportCols = project_columns(validCols, columns)
+        if is_sampled(**sample):
+            reporter.set_stage("sampling")
+            dff = sample_dataframe(dff,
+                                   validCols,
+                                   **sample,
+                                   carton=carton,
+                                   progress=reporter)
+
+        # make directory and pass back after successful export
+        os.makedirs(os.path.join(settings.scratch, str(uuid)), exist_ok=True)
+        filename = export_filename(name, release, datatype, dataset,
+                                   EXPORT_FORMATS[format])
+        filepath = os.path.join(str(uuid), filename)
+        disk_path = os.path.join(settings.scratch, filepath)
+
+        # extract, then export
+        reporter.set_stage("extracting")
+        dff = dff[exportCols].extract()
+        reporter.path = disk_path
+        reporter.set_stage("writing")
+        export_file(dff,
+                    disk_path,
+                    format=format,
+                    compression=compression,
+                    row_group_size=row_group_size,
+                    progress=reporter)
+        reporter.report(1.0, force=True)
+    except UserAbort:
+        # raised by vaex when our progress callback stops it
+        shutil.rmtree(os.path.join(settings.scratch, str(uuid)),
+                      ignore_errors=True)
+        raise JobAborted(reporter.reason or "job was aborted")
+    except Exception:
+        shutil.rmtree(os.path.join(settings.scratch, str(uuid)),
+                      ignore_errors=True)
+        raise
 
     # cleanup to free memory slightly
-    dff.close()
+    # NOTE: don't close; the source file is shared with the dataframe cache
     del dff
     gc.collect()
     logger.debug("completed filter job, exiting now!")
-    return filepath
+    return filepath, reporter.counts
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object which buffers bytes until drained."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        """Returns and clears all buffered bytes."""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_dataframe(dff: vx.DataFrame,
+                     columns: list[str],
+                     format: str = "parquet",
+                     chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Streams a filtered dataframe as parquet or Arrow IPC bytes.
+
+    Only one chunk of `chunk_size` rows is held in memory at a time; each chunk
+    is written as a parquet row group or Arrow record batch and yielded.
+
+    Args:
+        dff: filtered dataframe, as from `apply_filters`
+        columns: columns to export
+        format: output format, one of `STREAM_FORMATS`
+        chunk_size: rows per chunk
+
+    Yields:
+        Encoded bytes of the output file.
+    """
+    sink = _ChunkSink()
+    writer = None
+    try:
+        for _, _, table in dff.to_arrow_table(columns, chunk_size=chunk_size):
+            if writer is None:
+                schema = table.schema
+                if format == "arrow":
+                    writer = pa.ipc.new_stream(sink, schema)
+                else:
+                    writer = pq.ParquetWriter(sink, schema)
+            writer.write_table(table.cast(schema))
+            yield sink.drain()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
@@ -1,17 +1,613 @@
-"""Jobs structuring classes"""
+"""Jobs structuring classes and job stores"""
 
-from typing import cast, Dict
+import hashlib
+import json
+import os
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter
+from functools import lru_cache
+from time import time
+from typing import Callable, Dict
 from pydantic import BaseModel, Field
 from uuid import UUID, uuid4
 
-__all__ = ["Job", "jobs"]
+from ..util.config import settings
+from ..util.expressions import ExpressionError, parse_expression
+
+__all__ = [
+    "Job",
+    "JobStore",
+    "MemoryJobStore",
+    "SQLiteJobStore",
+    "make_store",
+    "store",
+    "fingerprint",
+    "batch_fingerprint",
+    "current_owner",
+    "owner_alive",
+    "find_job",
+    "is_cancelled",
+    "register_job",
+]
+
+logger = logging.getLogger("server")
+
+# missed heartbeats after which an in-progress job is taken as orphaned
+STALE_HEARTBEATS = 3
+
+
+@lru_cache(maxsize=1)
+def boot_id() -> str:
+    """Identifier of the current boot of the machine, empty if unknown."""
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def current_owner() -> str:
+    """Owner of the jobs run by this process, as `boot_id:pid`."""
+    return f"{boot_id()}:{os.getpid()}"
+
+
+def owner_alive(owner: str) -> bool:
+    """Whether the process owning a job is still running.
+
+    Args:
+        owner: owner of the job, see `current_owner`
+
+    Returns:
+        `True` if the owner was started in this boot and its process exists.
+    """
+    boot, _, pid = owner.rpartition(":")
+    if (not pid.isdigit()) or (boot != boot_id()):
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # exists, but run by another user
+        return True
+    return True
 
 
 class Job(BaseModel):
     uid: UUID = Field(default_factory=uuid4)
     status: str = "in_progress"
     message: str = ""
-    filepath: str = cast(str, None)
+    filepath: str | None = None
+    fingerprint: str = ""
+    # progress, see `progress.py`
+    stage: str = "queued"
+    progress: float = 0.0
+    rows_total: int = 0
+    rows_scanned: int = 0
+    rows_matched: int = 0
+    # unique crossmatch identifiers found and not found
+    ids_matched: int = 0
+    ids_unknown: int = 0
+    bytes_written: int = 0
+    started: float | None = None
+    eta: float | None = None
+    # position in the admission queue while waiting, see `scheduler.py`
+    queue_position: int | None = None
+    timings: dict[str, float] = Field(default_factory=dict)
+    # process running the job, see `current_owner`
+    owner: str = ""
+    # last time the job was put into the store or its owner was seen running
+    heartbeat: float | None = None
+
+    def orphaned(self, stale: float) -> bool:
+        """Whether the job is in progress but its owner is gone.
+
+        Args:
+            stale: time in seconds without a heartbeat after which the owner
+                is taken as gone, even if its process exists
+        """
+        return (self.status == "in_progress") and (
+            (not owner_alive(self.owner)) or (self.heartbeat is None) or
+            (self.heartbeat < time() - stale))
+
+
+class JobStore(ABC):
+    """Base class for job stores.
+
+    Jobs are copied in and out of the store, so any change to a job must be
+    saved again with `put`, which also sets its heartbeat. Jobs not updated
+    within `ttl` seconds are expired.
+
+    Attributes:
+        ttl: time in seconds before a job is expired
+        listeners: callables run with each job put into the store by this process
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.listeners: list[Callable[[Job], None]] = []
+
+    def notify(self, job: Job) -> None:
+        """Runs listeners on a job that was put into the store."""
+        for listener in self.listeners:
+            try:
+                listener(job)
+            except Exception as e:
+                logger.warning(f"job store listener failed: {e}")
+
+    @abstractmethod
+    def get(self, uid: UUID) -> Job | None:
+        """Gets a job by uid, or `None` if not found."""
+
+    @abstractmethod
+    def put(self, job: Job) -> None:
+        """Adds or updates a job."""
+
+    @abstractmethod
+    def update(self, job: Job) -> bool:
+        """Updates a job if it is still in progress, returning whether it was.
+
+        Unlike `put`, this never revives a job cancelled or failed since it
+        was read.
+        """
+
+    @abstractmethod
+    def find(self, fingerprint: str) -> Job | None:
+        """Gets the most recently updated job with a fingerprint, or `None`."""
+
+    @abstractmethod
+    def page(self, offset: int = 0, limit: int = 100) -> list[Job]:
+        """Lists jobs, most recently updated first."""
+
+    @abstractmethod
+    def count(self) -> int:
+        """Counts all jobs."""
+
+    @abstractmethod
+    def count_by_status(self) -> dict[str, int]:
+        """Counts all jobs by status."""
+
+    @abstractmethod
+    def expire(self) -> int:
+        """Removes all jobs older than the TTL, returning the number removed."""
+
+    @abstractmethod
+    def heartbeat(self, owner: str) -> int:
+        """Sets the heartbeat of all in-progress jobs of an owner, returning the number set."""
+
+    @abstractmethod
+    def in_progress(self) -> list[Job]:
+        """Lists all in-progress jobs."""
+
+    @abstractmethod
+    def fail(self, uid: UUID, message: str) -> bool:
+        """Marks a job failed if it is still in progress, returning whether it was."""
+
+    def recover(self, stale: float) -> int:
+        """Fails the in-progress jobs left behind by crashed or restarted processes.
+
+        Args:
+            stale: time in seconds without a heartbeat after which a job is
+                orphaned, even if its owner's process exists
+
+        Returns:
+            The number of jobs failed.
+        """
+        recovered = 0
+        for job in self.in_progress():
+            if job.orphaned(stale) and self.fail(
+                    job.uid, "job was interrupted by a server restart"):
+                logger.info(f"failed orphaned job {job.uid} of {job.owner!r}")
+                recovered += 1
+        return recovered
+
+
+class MemoryJobStore(JobStore):
+    """In-process job store. Only valid for a single worker."""
+
+    def __init__(self, ttl: int):
+        super().__init__(ttl)
+        self._jobs: Dict[UUID, tuple[Job, float]] = {}
+        self._lock = threading.Lock()
+
+    def _live(self) -> list[tuple[Job, float]]:
+        """All unexpired entries."""
+        cutoff = time() - self.ttl
+        return [entry for entry in self._jobs.values() if entry[1] >= cutoff]
+
+    def get(self, uid: UUID) -> Job | None:
+        entry = self._jobs.get(uid)
+        if (entry is None) or (entry[1] < time() - self.ttl):
+            return None
+        return entry[0].model_copy()
+
+    def put(self, job: Job) -> None:
+        now = time()
+        with self._lock:
+            self._jobs[job.uid] = (job.model_copy(update={"heartbeat": now}),
+                                   now)
+        self.notify(job)
+
+    def update(self, job: Job) -> bool:
+        now = time()
+        with self._lock:
+            entry = self._jobs.get(job.uid)
+            if (entry is None) or (entry[0].status != "in_progress"):
+                return False
+            self._jobs[job.uid] = (job.model_copy(update={"heartbeat": now}),
+                                   now)
+        self.notify(job)
+        return True
+
+    def find(self, fingerprint: str) -> Job | None:
+        matches = [(job, updated) for job, updated in self._live()
+                   if job.fingerprint == fingerprint]
+        if not matches:
+            return None
+        return max(matches, key=lambda entry: entry[1])[0].model_copy()
+
+    def page(self, offset: int = 0, limit: int = 100) -> list[Job]:
+        entries = sorted(self._live(), key=lambda entry: entry[1], reverse=True)
+        return [job.model_copy() for job, _ in entries[offset:offset + limit]]
+
+    def count(self) -> int:
+        return len(self._live())
+
+    def count_by_status(self) -> dict[str, int]:
+        return dict(Counter(job.status for job, _ in self._live()))
+
+    def expire(self) -> int:
+        cutoff = time() - self.ttl
+        expired = [
+            uid for uid, (_, updated) in self._jobs.items()
+            if updated < cutoff
+        ]
+        for uid in expired:
+            del self._jobs[uid]
+        return len(expired)
+
+    def heartbeat(self, owner: str) -> int:
+        now = time()
+        beats = 0
+        with self._lock:
+            for uid, (job, _) in list(self._jobs.items()):
+                if (job.status == "in_progress") and (job.owner == owner):
+                    self._jobs[uid] = (job.model_copy(update={"heartbeat": now}),
+                                       now)
+                    beats += 1
+        return beats
+
+    def in_progress(self) -> list[Job]:
+        return [
+            job.model_copy() for job, _ in self._live()
+            if job.status == "in_progress"
+        ]
+
+    def fail(self, uid: UUID, message: str) -> bool:
+        with self._lock:
+            entry = self._jobs.get(uid)
+            if (entry is None) or (entry[0].status != "in_progress"):
+                return False
+            self._jobs[uid] = (entry[0].model_copy(update={
+                "status": "failed",
+                "message": message,
+                "eta": None
+            }), time())
+        return True
+
+
+class SQLiteJobStore(JobStore):
+    """Job store backed by a SQLite file on local disk, shared by all workers.
+
+    Note:
+        Connections are opened lazily per process, so the store is safe to create
+        before gunicorn forks its workers.
+
+    Attributes:
+        path: path to SQLite database
+    """
+
+    # how often in seconds `put` also expires old jobs
+    EXPIRE_INTERVAL = 60
+
+    def __init__(self, path: str, ttl: int):
+        super().__init__(ttl)
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        self._inherited: sqlite3.Connection | None = None
+        self._pid: int | None = None
+        self._last_expire = 0.0
+
+    def _connect(self) -> sqlite3.Connection:
+        """Gets the connection for this process, creating the table on first use."""
+        if (self._conn is None) or (self._pid != os.getpid()):
+            # never close a connection inherited across a fork; keep it referenced
+            self._inherited = self._conn
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                        exist_ok=True)
+            conn = sqlite3.connect(self.path,
+                                   timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                    uid TEXT PRIMARY KEY,
+                    fingerprint TEXT,
+                    updated REAL,
+                    data TEXT
+                )""")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs (fingerprint, updated)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, uid: UUID) -> Job | None:
+        row = (self._connect().execute(
+            "SELECT data FROM jobs WHERE uid = ? AND updated >= ?",
+            (str(uid), time() - self.ttl),
+        ).fetchone())
+        return Job.model_validate_json(row[0]) if row else None
+
+    def put(self, job: Job) -> None:
+        now = time()
+        self._connect().execute(
+            "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)",
+            (str(job.uid), job.fingerprint, now,
+             job.model_copy(update={
+                 "heartbeat": now
+             }).model_dump_json()),
+        )
+        self.notify(job)
+        if now - self._last_expire > self.EXPIRE_INTERVAL:
+            self.expire()
+
+    def update(self, job: Job) -> bool:
+        # in place, so a concurrent cancel or fail of the job is never overwritten
+        now = time()
+        cursor = self._connect().execute(
+            "UPDATE jobs SET updated = ?, data = ? "
+            "WHERE uid = ? AND json_extract(data, '$.status') = 'in_progress'",
+            (now, job.model_copy(update={
+                "heartbeat": now
+            }).model_dump_json(), str(job.uid)))
+        if cursor.rowcount == 0:
+            return False
+        self.notify(job)
+        return True
+
+    def find(self, fingerprint: str) -> Job | None:
+        row = (self._connect().execute(
+            "SELECT data FROM jobs WHERE fingerprint = ? AND updated >= ? ORDER BY updated DESC LIMIT 1",
+            (fingerprint, time() - self.ttl),
+        ).fetchone())
+        return Job.model_validate_json(row[0]) if row else None
+
+    def page(self, offset: int = 0, limit: int = 100) -> list[Job]:
+        rows = self._connect().execute(
+            "SELECT data FROM jobs WHERE updated >= ? ORDER BY updated DESC LIMIT ? OFFSET ?",
+            (time() - self.ttl, limit, offset),
+        )
+        return [Job.model_validate_json(row[0]) for row in rows]
+
+    def count(self) -> int:
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM jobs WHERE updated >= ?",
+            (time() - self.ttl, )).fetchone()[0]
+
+    def count_by_status(self) -> dict[str, int]:
+        rows = self._connect().execute(
+            "SELECT json_extract(data, '$.status'), COUNT(*) FROM jobs WHERE updated >= ? GROUP BY 1",
+            (time() - self.ttl, ))
+        return dict(rows.fetchall())
+
+    def expire(self) -> int:
+        self._last_expire = time()
+        cursor = self._connect().execute("DELETE FROM jobs WHERE updated < ?",
+                                         (self._last_expire - self.ttl, ))
+        if cursor.rowcount:
+            logger.debug(f"expired {cursor.rowcount} jobs")
+        return cursor.rowcount
+
+    def heartbeat(self, owner: str) -> int:
+        # in place, so a concurrent `put` of the job is never overwritten
+        now = time()
+        cursor = self._connect().execute(
+            "UPDATE jobs SET updated = ?, data = json_set(data, '$.heartbeat', ?) "
+            "WHERE json_extract(data, '$.status') = 'in_progress' AND json_extract(data, '$.owner') = ?",
+            (now, now, owner))
+        return cursor.rowcount
+
+    def in_progress(self) -> list[Job]:
+        rows = self._connect().execute(
+            "SELECT data FROM jobs WHERE json_extract(data, '$.status') = 'in_progress' AND updated >= ?",
+            (time() - self.ttl, ))
+        return [Job.model_validate_json(row[0]) for row in rows]
+
+    def fail(self, uid: UUID, message: str) -> bool:
+        cursor = self._connect().execute(
+            "UPDATE jobs SET updated = ?, data = json_set(data, '$.status', 'failed', '$.message', ?, '$.eta', NULL) "
+            "WHERE uid = ? AND json_extract(data, '$.status') = 'in_progress'",
+            (time(), message, str(uid)))
+        return cursor.rowcount > 0
+
+
+def make_store() -> JobStore:
+    """Creates the job store given by `settings.jobstore`."""
+    if settings.jobstore == "memory":
+        return MemoryJobStore(settings.jobttl)
+    path = settings.jobstore or os.path.join(settings.scratch, "jobs.sqlite")
+    return SQLiteJobStore(path, settings.jobttl)
+
+
+store: JobStore = make_store()
+
+
+def _split(items: str) -> list[str]:
+    """Splits a comma-separated string into a sorted list of unique items."""
+    return sorted({item.strip() for item in items.split(",") if item.strip()})
+
+
+def _canonical(expression: str) -> str:
+    """Canonical form of an expression, or the expression itself if it doesn't parse."""
+    try:
+        return parse_expression(expression).canonical
+    except ExpressionError:
+        return expression
+
+
+def fingerprint(
+    release: str,
+    datatype: str,
+    dataset: str,
+    expression: str = "",
+    carton: str = "",
+    mapper: str = "",
+    flags: str = "",
+    crossmatch: str = "",
+    cmtype: str = "",
+    combotype: str = "AND",
+    invert: bool = False,
+    columns: str = "",
+    format: str = "parquet",
+    compression: str = "snappy",
+    row_group_size: int = 0,
+    sample_size: int = 0,
+    sample_fraction: float = 0.0,
+    sample_seed: int = 0,
+    stratify: str = "",
+    quota: str = "",
+    **kwargs,
+) -> str:
+    """Generates a canonical fingerprint of a filter job's parameters.
+
+    Two jobs with the same fingerprint produce the same rows and columns, so an
+    export for one can be served for the other.
+
+    Note:
+        Parameters which only change the output name (such as `name`) are ignored.
+
+    Args:
+        release: data release
+        datatype: datatype (star or visit)
+        dataset: specific dataset i.e. aspcap, spall, best
+        expression: filter expression
+        carton: comma-separated cartons
+        mapper: comma-separated mappers
+        flags: comma-separated flags
+        crossmatch: multiline string of identifiers
+        cmtype: crossmatch identifier type
+        combotype: logical reducer for carton/mapper
+        invert: whether to invert all filters
+        columns: comma-separated columns to export
+        format: output format
+        compression: parquet compression codec
+        row_group_size: rows per parquet row group
+        sample_size: number of rows to sample
+        sample_fraction: fraction of rows to sample
+        sample_seed: seed of the sample
+        stratify: column to stratify the sample by
+        quota: rows per stratum
+
+    Returns:
+        Hex digest of the normalized parameters.
+    """
+    identifiers = sorted(
+        {line.strip()
+         for line in crossmatch.split("\n") if line.strip()})
+    spec = dict(
+        release=release,
+        datatype=datatype,
+        dataset=dataset,
+        vastra=settings.vastra,
+        expression=_canonical(expression),
+        carton=_split(carton),
+        mapper=_split(mapper),
+        flags=_split(flags),
+        crossmatch=hashlib.sha256("\n".join(identifiers).encode()).hexdigest()
+        if identifiers else "",
+        cmtype=cmtype if identifiers else "",
+        combotype=combotype,
+        invert=invert,
+        # column order is kept, since it is the order in the output
+        columns=list(
+            dict.fromkeys(col.strip() for col in columns.split(",")
+                          if col.strip())),
+        format=format,
+        compression=compression if format == "parquet" else "",
+        row_group_size=row_group_size if format == "parquet" else 0,
+    )
+    if sample_size or sample_fraction or stratify:
+        # only when sampling, so fingerprints of unsampled exports are unchanged
+        spec["sample"] = dict(size=sample_size,
+                              fraction=sample_fraction,
+                              seed=sample_seed,
+                              stratify=stratify,
+                              quota=quota.replace(" ", ""))
+    return hashlib.sha256(json.dumps(spec,
+                                     sort_keys=True).encode()).hexdigest()
+
+
+def batch_fingerprint(release: str, datatype: str, subsets: list[dict],
+                      output: str = "files", **kwargs) -> str:
+    """Generates a canonical fingerprint of a batch job's parameters.
+
+    Subset names are kept, since they appear in the output.
+
+    Args:
+        release: data release
+        datatype: datatype (star or visit)
+        subsets: subset specs, each with a `dataset` and `name`
+        output: batch output mode
+        kwargs: export parameters shared by all subsets, see `fingerprint`
+
+    Returns:
+        Hex digest of the normalized parameters.
+    """
+    spec = dict(
+        output=output,
+        subsets=[(subset.get("name", ""),
+                  fingerprint(release, datatype, **subset, **kwargs))
+                 for subset in subsets],
+    )
+    return hashlib.sha256(json.dumps(spec,
+                                     sort_keys=True).encode()).hexdigest()
+
+
+def find_job(key: str) -> Job | None:
+    """Finds a reusable job for a fingerprint.
+
+    A job is reusable if it is still in progress and its owner is running, or if
+    it completed and its file is still on the scratch disk.
+
+    Args:
+        key: job fingerprint
+
+    Returns:
+        The matching job, or `None` if there is nothing to reuse.
+    """
+    job = store.find(key)
+    if job is not None:
+        if job.status == "in_progress":
+            if not job.orphaned(STALE_HEARTBEATS * settings.job_heartbeat):
+                return job
+        elif (job.status == "complete") and (job.filepath is not None) and (
+                os.path.isfile(os.path.join(settings.scratch, job.filepath))):
+            return job
+    return None
+
+
+def is_cancelled(uid: UUID) -> bool:
+    """Checks whether a job has been cancelled."""
+    job = store.get(uid)
+    return (job is not None) and (job.status == "cancelled")
 
 
-jobs: Dict[UUID, Job] = {}
+def register_job(job: Job) -> None:
+    """Adds or updates a job in the job store."""
+    store.put(job)
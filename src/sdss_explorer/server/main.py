@@ -2,22 +2,67 @@
 
 import asyncio
 import os
+import shutil
 import logging
-from concurrent.futures.process import ProcessPoolExecutor
 from contextlib import asynccontextmanager
 from http import HTTPStatus
-from functools import partial
 from timeit import default_timer as timer
+from typing import Any, Callable
 
 from fastapi import BackgroundTasks
-from fastapi import FastAPI
-from uuid import UUID
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from uuid import UUID, uuid4
 import vaex.cache
 import vaex.logging
 
 from ..util import setup_logging
-from .filter import filter_dataframe
-from .jobs import Job, jobs
+from .aggregate import (
+    AGGREGATE_MEMORY,
+    AggregateRequest,
+    aggregate_key,
+    aggregate_subset,
+    result_cache,
+)
+from .crossmatch import read_identifiers
+from .dataframe import warm_up
+from .batch import BatchRequest, estimate_batch_memory, filter_batch
+from .filter import (
+    CHUNK_SIZE,
+    FILTER_PARAMS,
+    STREAM_FORMATS,
+    estimate_export,
+    export_filename,
+    filter_dataframe,
+    load_filtered,
+    project_columns,
+    record_count,
+    stream_dataframe,
+    validate_export,
+)
+from .events import JobEvents
+from .metrics import (
+    CONTENT_TYPE,
+    aggregate_requests,
+    record_job,
+    render_metrics,
+)
+from .jobs import (
+    Job,
+    store,
+    STALE_HEARTBEATS,
+    current_owner,
+    fingerprint,
+    batch_fingerprint,
+    find_job,
+    register_job,
+)
+from .progress import JobAborted
+from .runner import JobRunner
+from .sample import sample_dataframe, validate_sample
+from .scheduler import estimate_memory, record_selectivity
+from .scratch import ScratchManager
 from ..util.config import settings
 
 setup_logging(log_path=settings.logpath, console_log_level=settings.loglevel)
@@ -37,13 +82,61 @@ except AssertionError:
     solara_server = None
 
 
+scratch = ScratchManager(settings.scratch, store, settings.scratch_quota,
+                         settings.scratch_maxage)
+
+
+async def sweep_scratch(interval: int) -> None:
+    """Sweeps the scratch space every `interval` seconds, unless another worker is."""
+    while True:
+        try:
+            await run_in_threadpool(scratch.sweep)
+        except Exception as e:
+            logger.warning(f"scratch sweep failed: {e}")
+        await asyncio.sleep(interval)
+
+
+async def heartbeat_jobs(interval: int) -> None:
+    """Sets the heartbeat of this worker's running jobs every `interval` seconds."""
+    while True:
+        try:
+            await run_in_threadpool(store.heartbeat, current_owner())
+        except Exception as e:
+            logger.warning(f"job heartbeat failed: {e}")
+        await asyncio.sleep(interval)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.state.executor = ProcessPoolExecutor(max_workers=settings.nworkers)
+    # jobs of crashed or restarted workers will never finish
+    n = await run_in_threadpool(store.recover,
+                                STALE_HEARTBEATS * settings.job_heartbeat)
+    if n:
+        logger.warning(f"failed {n} jobs orphaned by a previous server")
+    if settings.preload:
+        # for estimates and streamed exports, which run in this process
+        start = timer()
+        n = await run_in_threadpool(warm_up)
+        logger.info(f"preloaded {n} dataframes in {timer() - start:.2f}s")
+    app.state.runner = JobRunner(max_workers=settings.nprocesses,
+                                 timeout=settings.job_timeout,
+                                 memory=settings.job_memory,
+                                 grace=settings.job_grace,
+                                 budget=settings.job_memory_budget,
+                                 preload=settings.preload)
+    await run_in_threadpool(app.state.runner.prestart)
+    app.state.runner.start()
+    app.state.events = JobEvents(store)
+    app.state.events.start()
+    sweeper = asyncio.create_task(sweep_scratch(settings.scratch_interval))
+    heartbeat = asyncio.create_task(heartbeat_jobs(settings.job_heartbeat))
     try:
         yield
     finally:
-        app.state.executor.shutdown()  # free any resources
+        heartbeat.cancel()
+        sweeper.cancel()
+        app.state.events.shutdown()
+        app.state.runner.shutdown()  # free any resources
 
 
 app = FastAPI(lifespan=lifespan)
@@ -54,34 +147,124 @@ async def health_check():
     return {"This is": "Explorer server"}
 
 
-async def run_in_process(fn, *args, **kwargs):
-    """Helper to run in background"""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(app.state.executor,
-                                      partial(fn, *args, **kwargs)
-                                      )  # wait and return result
+async def run_job(uid: UUID, session: str, label: str, fn: Callable,
+                  estimate: Callable, *args, **kwargs) -> Job:
+    """Runs an export job once admitted by the scheduler, then records its outcome.
 
+    Args:
+        uid: job id
+        session: session the job was submitted from
+        label: dataset label of the job in metrics
+        fn: export function, called as `fn(uid, *args, **kwargs)`, returning
+            the output file and final counts of the job
+        estimate: peak memory estimator, called as `estimate(*args, **kwargs)`
 
-async def start_filter(uid: UUID, release: str, datatype: str, dataset: str,
-                       **kwargs) -> None:
-    """Starts a filtering job"""
+    Returns:
+        The finished job.
+    """
+    start = timer()
     try:
-        start = timer()
-        jobs[uid].filepath = await run_in_process(filter_dataframe, uid,
-                                                  release, datatype, dataset,
-                                                  **kwargs)
+        memory = await run_in_threadpool(estimate, *args, **kwargs)
+        filepath, counts = await app.state.runner.run(uid,
+                                                      fn,
+                                                      *args,
+                                                      session=session,
+                                                      memory=memory,
+                                                      **kwargs)
         logger.info(f"job {uid} completed! took {timer() - start:.4f}s")
-        jobs[uid].status = "complete"
+        job = store.get(uid)
+        if job is None:
+            raise Exception("job expired from the job store")
+        if job.status == "cancelled":  # finished as it was cancelled
+            raise JobAborted("job was cancelled")
+        # the last progress update may not have been applied yet
+        job = job.model_copy(update=counts)
+        job.filepath = filepath
+        job.status = "complete"
+        job.progress = 1.0
+        job.eta = 0.0
+        job.bytes_written = os.path.getsize(
+            os.path.join(settings.scratch, filepath))
+        # unless cancelled since, maybe through another server worker
+        if not store.update(job):
+            raise JobAborted("job was cancelled")
     except Exception as e:
         logger.info(f"job {uid} failed: {e}")
-        jobs[uid].message = str(e)
-        jobs[uid].status = "failed"
+        # killed processes can't clean up after themselves
+        shutil.rmtree(os.path.join(settings.scratch, str(uid)),
+                      ignore_errors=True)
+        # keeps the user's cancellation message
+        store.fail(uid, str(e))
+        job = store.get(uid) or Job(uid=uid)
+        if job.status == "in_progress":  # expired from the job store
+            job.message = str(e)
+            job.status = "failed"
+            job.eta = None
+            register_job(job)
+    record_job(job, label, timer() - start)
+    return job
+
+
+async def start_filter(uid: UUID, release: str, datatype: str, dataset: str,
+                       session: str, **kwargs) -> None:
+    """Starts a filtering job"""
+    job = await run_job(uid, session, dataset, filter_dataframe,
+                        estimate_memory, release, datatype, dataset, **kwargs)
+    if job.status == "complete":  # with the counts returned by the job
+        record_count(release, datatype, dataset, job.rows_total,
+                     job.rows_matched, **kwargs)
+        if any(kwargs.get(k) for k in FILTER_PARAMS):
+            record_selectivity(release, datatype, dataset, job.rows_total,
+                               job.rows_matched)
+
+
+async def start_batch(uid: UUID, release: str, datatype: str, session: str,
+                      **kwargs) -> None:
+    """Starts a batch export job"""
+    await run_job(uid, session, "batch", filter_batch, estimate_batch_memory,
+                  release, datatype, **kwargs)
+
+
+# media types of request bodies read as crossmatch identifier files
+IDENTIFIER_TYPES = ("text/plain", "text/csv", "application/octet-stream",
+                    "application/vnd.apache.parquet")
+
+
+async def read_crossmatch(request: Request, cmtype: str) -> str | None:
+    """Reads crossmatch identifiers uploaded in a request body.
+
+    Identifiers are read from the `crossmatch` file of a multipart form, or
+    from the whole body if it is a text, CSV or parquet file. Other bodies are
+    ignored.
+
+    Returns:
+        Newline-separated identifiers, or `None` if none were uploaded.
+
+    Raises:
+        ValueError: if the identifier file can't be read
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0]
+    if content_type == "multipart/form-data":
+        form = await request.form()
+        upload = form.get("crossmatch")
+        if upload is None:
+            return None
+        data = (await upload.read() if hasattr(upload, "read") else
+                upload.encode())
+    elif content_type in IDENTIFIER_TYPES:
+        data = await request.body()
+    else:
+        return None
+    if not data.strip():
+        return None
+    return await run_in_threadpool(read_identifiers, data, cmtype)
 
 
 @app.post("/filter_subset/{release}/{datatype}/{dataset}",
           status_code=HTTPStatus.ACCEPTED)
 async def task_handler(
     background_tasks: BackgroundTasks,
+    request: Request,
     release: str,
     datatype: str,
     dataset: str,
@@ -94,12 +277,30 @@ async def task_handler(
     cmtype: str = "gaia_dr3",
     combotype: str = "AND",
     invert: bool = False,
+    columns: str = "",
+    format: str = "parquet",
+    compression: str = "snappy",
+    row_group_size: int = CHUNK_SIZE,
+    sample_size: int = 0,
+    sample_fraction: float = 0.0,
+    sample_seed: int = 0,
+    stratify: str = "",
+    quota: str = "",
+    session: str = "",
 ):
     """Task handler endpoint
 
     Note:
         You can't have this kwargs overload because it needs to know the properties.
 
+        Requests with the same filters as a running or completed export return
+        that job instead of starting a new one. See `jobs.fingerprint`.
+
+        Long crossmatch lists can be sent as the request body instead of
+        `crossmatch`, either as a text, CSV or parquet file, or as the
+        `crossmatch` file of a multipart form. See `read_crossmatch`. The
+        finished job reports `ids_matched` and `ids_unknown`.
+
     Args:
         release: data release to hit
         datatype: datatype, star or visit
@@ -113,9 +314,35 @@ async def task_handler(
         cmtype: crossmatch identifier type to search for
         combotype: how to combine filters. unused.
         invert: whether to invert filters. unused.
+        columns: comma-separated columns to export. Defaults to all.
+        format: output format; parquet, arrow, feather, hdf5, csv or fits
+        compression: parquet compression codec
+        row_group_size: rows per parquet row group
+        sample_size: number of matched rows to sample. Defaults to all.
+        sample_fraction: fraction of matched rows to sample
+        sample_seed: seed of the sample, so it is reproducible
+        stratify: column to stratify the sample by, i.e. `telescope`, or
+            `carton` for each of the requested cartons
+        quota: rows per stratum, i.e. `100` or `100,apo1m=10`
+        session: session id, for fair queueing between users. Defaults to the client address.
     """
-    new_task = Job()  # create jobspec
-    jobs[new_task.uid] = new_task  # add to global joblist
+    sample: dict[str, Any] = dict(sample_size=sample_size,
+                                  sample_fraction=sample_fraction,
+                                  sample_seed=sample_seed,
+                                  stratify=stratify,
+                                  quota=quota)
+    try:
+        validate_export(format, compression, row_group_size)
+        validate_sample(**sample, carton=carton)
+        uploaded = await read_crossmatch(request, cmtype)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    if uploaded is not None:
+        if crossmatch:
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST,
+                                detail="crossmatch given twice")
+        crossmatch = uploaded
+
     # bundle data
     kwargs = dict(
         name=name,
@@ -127,22 +354,351 @@ async def task_handler(
         cmtype=cmtype,
         combotype=combotype,
         invert=invert,
+        columns=columns,
+        format=format,
+        compression=compression,
+        row_group_size=row_group_size,
+        **sample,
     )
+
+    # reuse an identical export if one is done or running
+    key = await run_in_threadpool(fingerprint, release, datatype, dataset,
+                                  **kwargs)
+    existing = find_job(key)
+    if existing is not None:
+        logger.info(f"request matches job {existing.uid}, reusing")
+        if (existing.status == "complete") and existing.filepath:
+            scratch.touch(existing.filepath)  # counts as a use for eviction
+        return existing
+
+    new_task = Job(fingerprint=key, owner=current_owner())  # create jobspec
+    register_job(new_task)  # add to global joblist
+    session = session or (request.client.host if request.client else "")
     background_tasks.add_task(start_filter, new_task.uid, release, datatype,
-                              dataset, **kwargs)
+                              dataset, session, **kwargs)
     return new_task
 
 
+@app.post("/filter_batch/{release}/{datatype}",
+          status_code=HTTPStatus.ACCEPTED)
+async def batch_handler(
+    background_tasks: BackgroundTasks,
+    request: Request,
+    release: str,
+    datatype: str,
+    batch: BatchRequest,
+    session: str = "",
+):
+    """Batch export endpoint
+
+    Exports many subsets as one job, evaluating all their filters in a single
+    scan of each dataset. Subsets are given in the request body, in the same
+    form as `export_subset` in the dashboard. See `batch.BatchRequest`.
+
+    Args:
+        release: data release to hit
+        datatype: datatype, star or visit
+        batch: subsets and export options
+        session: session id, for fair queueing between users. Defaults to the client address.
+    """
+    try:
+        batch.validate_batch()
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+
+    kwargs = batch.model_dump()
+    key = batch_fingerprint(release, datatype, **kwargs)
+    existing = find_job(key)
+    if existing is not None:
+        logger.info(f"request matches job {existing.uid}, reusing")
+        if (existing.status == "complete") and existing.filepath:
+            scratch.touch(existing.filepath)  # counts as a use for eviction
+        return existing
+
+    new_task = Job(fingerprint=key, owner=current_owner())
+    register_job(new_task)
+    session = session or (request.client.host if request.client else "")
+    background_tasks.add_task(start_batch, new_task.uid, release, datatype,
+                              session, **kwargs)
+    return new_task
+
+
+@app.get("/export/{release}/{datatype}/{dataset}")
+async def export_handler(
+    release: str,
+    datatype: str,
+    dataset: str,
+    name: str = "A",
+    expression: str = "",
+    carton: str = "",
+    mapper: str = "",
+    flags: str = "",
+    crossmatch: str = "",
+    cmtype: str = "gaia_dr3",
+    combotype: str = "AND",
+    invert: bool = False,
+    columns: str = "",
+    format: str = "parquet",
+    sample_size: int = 0,
+    sample_fraction: float = 0.0,
+    sample_seed: int = 0,
+    stratify: str = "",
+    quota: str = "",
+):
+    """Streaming export endpoint
+
+    Streams the filtered subset directly as it is read, without writing to the
+    scratch disk. Filter and sample parameters are the same as for
+    `task_handler`.
+
+    Args:
+        columns: comma-separated columns to export. Defaults to all.
+        format: output format, `parquet` or `arrow` (IPC stream)
+    """
+    if format not in STREAM_FORMATS:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST,
+                            detail=f"unsupported stream format {format}")
+    sample: dict[str, Any] = dict(sample_size=sample_size,
+                                  sample_fraction=sample_fraction,
+                                  sample_seed=sample_seed,
+                                  stratify=stratify,
+                                  quota=quota)
+    kwargs: dict[str, Any] = dict(
+        expression=expression,
+        carton=carton,
+        mapper=mapper,
+        flags=flags,
+        crossmatch=crossmatch,
+        cmtype=cmtype,
+        combotype=combotype,
+        invert=invert,
+    )
+    try:
+        validate_sample(**sample, carton=carton)
+        dff, validCols = await run_in_threadpool(load_filtered, release,
+                                                 datatype, dataset, **kwargs)
+        exportCols = project_columns(validCols, columns)
+        dff = await run_in_threadpool(sample_dataframe,
+                                      dff,
+                                      validCols,
+                                      **sample,
+                                      carton=carton)
+    except Exception as e:
+        logger.info(f"export of {release}/{datatype}/{dataset} failed: {e}")
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+
+    filename = export_filename(name, release, datatype, dataset, format)
+    return StreamingResponse(
+        stream_dataframe(dff, exportCols, format=format),
+        media_type=STREAM_FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@app.get("/estimate/{release}/{datatype}/{dataset}")
+@app.post("/estimate/{release}/{datatype}/{dataset}")
+async def estimate_handler(
+    request: Request,
+    release: str,
+    datatype: str,
+    dataset: str,
+    expression: str = "",
+    carton: str = "",
+    mapper: str = "",
+    flags: str = "",
+    crossmatch: str = "",
+    cmtype: str = "gaia_dr3",
+    combotype: str = "AND",
+    invert: bool = False,
+    columns: str = "",
+):
+    """Dry-run estimation endpoint
+
+    Counts the rows a subset matches and estimates its export size, without
+    extracting or writing anything. Filter parameters are the same as for
+    `task_handler`, including crossmatch lists sent as a POST body. See
+    `filter.estimate_export` for the response.
+
+    Args:
+        columns: comma-separated columns to export. Defaults to all.
+    """
+    try:
+        uploaded = await read_crossmatch(request, cmtype)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    if uploaded is not None:
+        if crossmatch:
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST,
+                                detail="crossmatch given twice")
+        crossmatch = uploaded
+
+    kwargs = dict(
+        expression=expression,
+        carton=carton,
+        mapper=mapper,
+        flags=flags,
+        crossmatch=crossmatch,
+        cmtype=cmtype,
+        combotype=combotype,
+        invert=invert,
+    )
+    try:
+        estimate = await run_in_threadpool(estimate_export, release, datatype,
+                                           dataset, columns, **kwargs)
+        estimate["memory"] = await run_in_threadpool(estimate_memory, release,
+                                                     datatype, dataset,
+                                                     columns, **kwargs)
+    except Exception as e:
+        logger.info(f"estimate of {release}/{datatype}/{dataset} failed: {e}")
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    return estimate
+
+
+# aggregations being computed by this server worker, by cache key
+aggregating: dict[str, asyncio.Task] = {}
+
+
+async def compute_aggregate(key: str, release: str, datatype: str,
+                            body: AggregateRequest, session: str) -> bytes:
+    """Computes an aggregation in the process pool and caches the result."""
+    data = await app.state.runner.run(uuid4(),
+                                      aggregate_subset,
+                                      release,
+                                      datatype,
+                                      body.model_dump(),
+                                      session=session,
+                                      memory=AGGREGATE_MEMORY)
+    await run_in_threadpool(result_cache().set, key, data)
+    return data
+
+
+@app.post("/aggregate/{release}/{datatype}")
+async def aggregate_handler(
+    request: Request,
+    release: str,
+    datatype: str,
+    body: AggregateRequest,
+    session: str = "",
+):
+    """Aggregation endpoint for histograms and heatmaps
+
+    Bins a subset's rows, returning the grid as an `.npz` archive; see
+    `aggregate.aggregate_subset` for its arrays. Results are cached across
+    sessions and server workers, and identical requests made while one is being
+    computed wait for it rather than computing it again. The `X-Cache` header is
+    `hit` if the result was cached, `shared` if it was being computed for
+    another request, and `miss` otherwise.
+
+    Args:
+        release: data release to hit
+        datatype: datatype, star or visit
+        body: subset and binning parameters
+        session: session id, for fair queueing between users. Defaults to the client address.
+    """
+    try:
+        body.validate_aggregate()
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+
+    key = aggregate_key(release, datatype, body)
+    data = await run_in_threadpool(result_cache().get, key)
+    status = "hit" if data is not None else "miss"
+    if data is None:
+        task = aggregating.get(key)
+        if task is not None:
+            status = "shared"
+        else:
+            session = session or (request.client.host
+                                  if request.client else "")
+            task = aggregating[key] = asyncio.create_task(
+                compute_aggregate(key, release, datatype, body, session))
+            task.add_done_callback(lambda _: aggregating.pop(key, None))
+        try:
+            # shielded, so one client disconnecting doesn't cancel it for others
+            data = await asyncio.shield(task)
+        except Exception as e:
+            logger.info(f"aggregation of {release}/{datatype} failed: {e}")
+            raise HTTPException(status_code=HTTPStatus.BAD_REQUEST,
+                                detail=str(e))
+    aggregate_requests.inc(cache=status)
+    return Response(content=data,
+                    media_type="application/octet-stream",
+                    headers={"X-Cache": status})
+
+
 @app.get("/status/{uid}")
 async def status_handler(uid: UUID):
     """Status check endpoint"""
-    return jobs[uid]
+    job = store.get(uid)
+    if job is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND,
+                            detail=f"job {uid} not found")
+    return job
+
+
+@app.get("/events/{uid}")
+async def events_handler(uid: UUID):
+    """Job status push endpoint
+
+    Streams the job's status as Server-Sent Events, one `job` event per update,
+    until the job is no longer in progress.
+    """
+    if store.get(uid) is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND,
+                            detail=f"job {uid} not found")
+    return StreamingResponse(
+        app.state.events.stream(uid),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # don't buffer in nginx
+        },
+    )
+
+
+@app.delete("/jobs/{uid}")
+async def cancel_handler(uid: UUID):
+    """Cancels a running job.
+
+    The job is marked as cancelled immediately. Its export process stops at the
+    next progress check, or is killed after `settings.job_grace` seconds.
+    """
+    job = store.get(uid)
+    if job is None:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND,
+                            detail=f"job {uid} not found")
+    if job.status != "in_progress":
+        raise HTTPException(status_code=HTTPStatus.CONFLICT,
+                            detail=f"job {uid} is already {job.status}")
+    job.status = "cancelled"
+    job.message = "cancelled by user"
+    job.eta = None
+    register_job(job)
+    # jobs started by other server workers are stopped by their watchdogs
+    app.state.runner.stop(uid, "job was cancelled")
+    return job
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_handler():
+    """Metrics endpoint
+
+    Serves job counts, durations, queue depth, export process use, bytes
+    written and memory in the Prometheus text format. See `metrics.py`.
+    """
+    return PlainTextResponse(render_metrics(store, app.state.runner),
+                             media_type=CONTENT_TYPE)
 
 
 @app.get("/status-all")
-async def status_all():
-    """Get all job statuses"""
-    return jobs
+async def status_all(offset: int = 0, limit: int = 100):
+    """Get job statuses, most recently updated first.
+
+    Args:
+        offset: number of jobs to skip
+        limit: maximum number of jobs to return
+    """
+    return {job.uid: job for job in store.page(offset, limit)}
 
 
 # mount if found
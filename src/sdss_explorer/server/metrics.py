@@ -0,0 +1,264 @@
+"""Server metrics, exposed at `/metrics` in the Prometheus text format.
+
+Instrumenting a job costs a few dictionary updates, so metrics are always on.
+Counters and histograms are kept per server worker. With several workers,
+scrape each one or sum them in Prometheus; job counts by status come from the
+shared job store, so those are the same on every worker.
+"""
+
+from bisect import bisect_left
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, TypeVar
+
+from .progress import process_rss
+
+if TYPE_CHECKING:
+    from .jobs import Job, JobStore
+    from .runner import JobRunner
+
+__all__ = [
+    "CONTENT_TYPE",
+    "Metric",
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "Registry",
+    "registry",
+    "record_job",
+    "render_metrics",
+]
+
+# upper bounds in seconds of job duration histogram buckets
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+                    1800)
+
+# upper bounds in seconds of stage duration histogram buckets
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n",
+                                                    "\\n").replace('"', '\\"')
+
+
+def _format(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# sorted label items of a series
+Labels = tuple[tuple[str, str], ...]
+
+
+def _key(labels: dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class Metric:
+    """Base class of metrics, rendered as a header and samples.
+
+    Attributes:
+        name: metric name
+        help: description of the metric
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+
+    def samples(self) -> list[str]:
+        return []
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+            *self.samples(),
+        ]
+
+
+class Counter(Metric):
+    """A monotonically increasing value per set of labels.
+
+    Attributes:
+        values: value by sorted label items
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values: dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}{_labels(key)} {_format(value)}"
+            for key, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    """A value per set of labels which can go up and down."""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[_key(labels)] = value
+
+
+@dataclass
+class Observations:
+    """Observations of a histogram for one set of labels.
+
+    Attributes:
+        counts: count per bucket, plus overflow
+        total: sum of the observations
+        count: number of observations
+    """
+
+    counts: list[int]
+    total: float = 0.0
+    count: int = 0
+
+
+class Histogram(Metric):
+    """Counts of observations in cumulative buckets, per set of labels.
+
+    Attributes:
+        buckets: upper bounds of buckets, ascending
+        values: observations by sorted label items
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...]):
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.values: dict[Labels, Observations] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = Observations(
+                [0] * (len(self.buckets) + 1))
+        entry.counts[bisect_left(self.buckets, value)] += 1
+        entry.total += value
+        entry.count += 1
+
+    def samples(self) -> list[str]:
+        lines = []
+        bounds = [f"{bound:g}" for bound in self.buckets] + ["+Inf"]
+        for key, entry in self.values.items():
+            cumulative = 0
+            for le, n in zip(bounds, entry.counts):
+                cumulative += n
+                lines.append(
+                    f"{self.name}_bucket{_labels(key + (('le', le), ))} {cumulative}"
+                )
+            lines.append(
+                f"{self.name}_sum{_labels(key)} {_format(entry.total)}")
+            lines.append(f"{self.name}_count{_labels(key)} {entry.count}")
+        return lines
+
+
+MetricT = TypeVar("MetricT", bound=Metric)
+
+
+class Registry:
+    """Named collection of metrics, rendered together."""
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def add(self, metric: MetricT) -> MetricT:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+jobs_finished = registry.add(
+    Counter("explorer_jobs_finished_total",
+            "Jobs finished by this server worker, by status."))
+job_duration = registry.add(
+    Histogram(
+        "explorer_job_duration_seconds",
+        "Time from submission to finishing of completed jobs, by dataset.",
+        DURATION_BUCKETS))
+stage_duration = registry.add(
+    Histogram("explorer_job_stage_seconds",
+              "Time completed jobs spent in each stage.", STAGE_BUCKETS))
+bytes_written = registry.add(
+    Counter("explorer_bytes_written_total",
+            "Bytes written to the scratch space by completed jobs."))
+aggregate_requests = registry.add(
+    Counter("explorer_aggregate_requests_total",
+            "Successful aggregation requests, by cache status (hit, shared or miss)."))
+jobs = registry.add(
+    Gauge("explorer_jobs", "Jobs in the job store, by status."))
+queue_depth = registry.add(
+    Gauge("explorer_queue_depth",
+          "Jobs waiting for admission to the export processes."))
+busy_slots = registry.add(
+    Gauge("explorer_executor_busy_slots",
+          "Jobs admitted to the export processes."))
+slots = registry.add(
+    Gauge("explorer_executor_slots", "Number of export processes."))
+memory_admitted = registry.add(
+    Gauge("explorer_admitted_memory_bytes",
+          "Estimated peak memory of admitted jobs."))
+rss = registry.add(
+    Gauge("explorer_process_resident_memory_bytes",
+          "Resident memory of this server worker and its export processes."))
+
+
+def record_job(job: "Job", dataset: str, duration: float) -> None:
+    """Records a finished job.
+
+    Args:
+        job: finished job
+        dataset: dataset label, i.e. aspcap or `batch`
+        duration: time in seconds from submission to finishing
+    """
+    jobs_finished.inc(status=job.status)
+    if job.status != "complete":
+        return
+    job_duration.observe(duration, dataset=dataset)
+    bytes_written.inc(job.bytes_written)
+    for stage, seconds in job.timings.items():
+        stage_duration.observe(seconds, stage=stage)
+
+
+def render_metrics(store: "JobStore", runner: "JobRunner") -> str:
+    """Updates gauges from the job store and runner, then renders all metrics."""
+    jobs.values.clear()
+    for status, n in store.count_by_status().items():
+        jobs.set(n, status=status)
+    queue_depth.set(len(runner.scheduler.waiting))
+    busy_slots.set(len(runner.scheduler.admitted))
+    slots.set(runner.max_workers)
+    memory_admitted.set(runner.scheduler.in_use)
+    rss.set(process_rss(), process="server")
+    rss.set(sum(process_rss(pid) for pid in runner.pids()),
+            process="export")
+    return registry.render()
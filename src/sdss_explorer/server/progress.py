@@ -0,0 +1,239 @@
+"""Progress reporting from export processes back to the server process.
+
+Export processes put updates on a `multiprocessing` queue handed to them by the
+pool initializer. The server process drains the queue and applies updates to
+the job store.
+"""
+
+import os
+import logging
+from multiprocessing.queues import Queue
+from queue import Empty
+from time import time
+from typing import TYPE_CHECKING, Callable
+from uuid import UUID
+
+if TYPE_CHECKING:
+    from .jobs import Job
+
+__all__ = [
+    "STAGES",
+    "COUNT_FIELDS",
+    "JobAborted",
+    "ProgressReporter",
+    "process_rss",
+    "set_queue",
+    "drain",
+    "apply_update",
+]
+
+logger = logging.getLogger("server")
+
+# job stages, with the fraction of the whole job each is assumed to take
+STAGES = {
+    "queued": 0.0,
+    "loading": 0.05,
+    "filtering": 0.45,
+    "sampling": 0.0,  # only sampled exports; timed but not weighted
+    "extracting": 0.1,
+    "writing": 0.4,
+}
+
+# fields counting rows and identifiers, final once a job's filter is evaluated
+COUNT_FIELDS = ("rows_total", "rows_scanned", "rows_matched", "ids_matched",
+                "ids_unknown")
+
+# queue set by the pool initializer; None when not in an export process
+_queue: Queue | None = None
+
+
+class JobAborted(Exception):
+    """Raised in an export process when a job is cancelled or exceeds its limits."""
+
+
+def process_rss(pid: int | None = None) -> int:
+    """Gets the resident memory of a process in bytes, or 0 if unavailable.
+
+    Args:
+        pid: process id. Defaults to this process.
+    """
+    try:
+        with open(f"/proc/{pid or 'self'}/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def set_queue(queue: Queue | None) -> None:
+    """Sets the queue progress is reported to in this process."""
+    global _queue
+    _queue = queue
+
+
+def overall_progress(stage: str, fraction: float) -> float:
+    """Converts progress within a stage to progress of the whole job."""
+    done = 0.0
+    for name, weight in STAGES.items():
+        if name == stage:
+            return done + weight * min(max(fraction, 0.0), 1.0)
+        done += weight
+    return done
+
+
+class ProgressReporter:
+    """Reports a job's stage and progress, throttled to every `interval` seconds.
+
+    Instances are callable, so they can be passed as the `progress` argument of
+    vaex methods. They also enforce the job's limits: the callback returns
+    `False`, aborting the vaex task, once the job is cancelled or exceeds its
+    time or memory limit.
+
+    Attributes:
+        uid: job id
+        interval: minimum time between reports and limit checks in seconds
+        timeout: maximum run time in seconds, if any
+        memory: maximum resident memory of the process in bytes, if any
+        cancelled: callable checking whether the job was cancelled, if any
+        stage: current stage
+        fields: extra fields to report, such as row counts
+        path: file to report the size of as `bytes_written`, if any
+        reason: why the job should abort, if it should
+        timings: time in seconds spent in each stage, reported as `timings`
+    """
+
+    def __init__(self,
+                 uid: UUID,
+                 interval: float = 0.5,
+                 timeout: float | None = None,
+                 memory: int | None = None,
+                 cancelled: Callable[[], bool] | None = None):
+        self.uid = uid
+        self.interval = interval
+        self.timeout = timeout
+        self.memory = memory
+        self.cancelled = cancelled
+        self.stage = ""
+        self.fields: dict = {"pid": os.getpid()}
+        self.path: str | None = None
+        self.reason: str | None = None
+        self.timings: dict[str, float] = {}
+        self._started = time()
+        self._stage_started = self._started
+        self._last = 0.0
+        self._last_check = 0.0
+
+    def set_stage(self, stage: str, **fields) -> None:
+        """Starts a new stage, always reporting immediately.
+
+        Raises:
+            JobAborted: if the job should abort
+        """
+        self.check(force=True)
+        now = time()
+        if self.stage:
+            self.timings[self.stage] = now - self._stage_started
+        self.stage = stage
+        self._stage_started = now
+        self.fields.update(fields)
+        self.report(0.0, force=True)
+
+    def check(self, force: bool = False) -> None:
+        """Checks the job's limits.
+
+        Args:
+            force: check even if within `interval` of last check
+
+        Raises:
+            JobAborted: if the job should abort
+        """
+        now = time()
+        if force or (now - self._last_check >= self.interval):
+            self._last_check = now
+            if self.cancelled is not None and self.cancelled():
+                self.reason = "job was cancelled"
+            elif (self.timeout is not None) and (now - self._started
+                                                 > self.timeout):
+                self.reason = f"job exceeded time limit of {self.timeout}s"
+            elif (self.memory is not None) and (process_rss() > self.memory):
+                self.reason = f"job exceeded memory limit of {self.memory} bytes"
+        if self.reason is not None:
+            raise JobAborted(self.reason)
+
+    def report(self, fraction: float, force: bool = False, **fields) -> None:
+        """Reports progress within the current stage.
+
+        Args:
+            fraction: progress of current stage, from 0 to 1
+            force: report even if within `interval` of last report
+            fields: extra fields to report
+        """
+        self.fields.update(fields)
+        now = time()
+        if (_queue is None) or (not force and now - self._last < self.interval):
+            return
+        self._last = now
+        update = dict(stage=self.stage,
+                      progress=overall_progress(self.stage, fraction),
+                      timings={
+                          **self.timings, self.stage: now - self._stage_started
+                      },
+                      **self.fields)
+        if self.path is not None:
+            try:
+                update["bytes_written"] = os.path.getsize(self.path)
+            except FileNotFoundError:
+                pass
+        try:
+            _queue.put_nowait((self.uid, update))
+        except Exception as e:
+            logger.debug(f"failed to report progress: {e}")
+
+    @property
+    def counts(self) -> dict[str, int]:
+        """Row and identifier counts reported so far, see `COUNT_FIELDS`."""
+        return {
+            field: self.fields[field]
+            for field in COUNT_FIELDS if field in self.fields
+        }
+
+    def __call__(self, fraction: float) -> bool:
+        """vaex progress callback. Returning `False` aborts the vaex task."""
+        if (self.stage == "filtering") and ("rows_total" in self.fields):
+            self.fields["rows_scanned"] = int(fraction *
+                                              self.fields["rows_total"])
+        self.report(fraction)
+        try:
+            self.check()
+        except JobAborted:
+            return False
+        return True
+
+
+def drain(queue: Queue, timeout: float = 0.5) -> dict[UUID, dict]:
+    """Gets all pending updates from a queue, keeping only the latest per job.
+
+    Blocks for up to `timeout` seconds for the first update.
+    """
+    updates: dict[UUID, dict] = {}
+    try:
+        uid, update = queue.get(timeout=timeout)
+        updates.setdefault(uid, {}).update(update)
+        while True:
+            uid, update = queue.get_nowait()
+            updates.setdefault(uid, {}).update(update)
+    except Empty:
+        pass
+    return updates
+
+
+def apply_update(job: "Job", update: dict) -> "Job":
+    """Applies a progress update to a job, estimating its remaining time."""
+    for key, value in update.items():
+        if key in type(job).model_fields:
+            setattr(job, key, value)
+    if job.started is None:
+        job.started = time()  # first update is when the job actually starts
+    if job.progress > 0:
+        elapsed = time() - job.started
+        job.eta = elapsed * (1 - job.progress) / job.progress
+    return job
@@ -0,0 +1,269 @@
+"""Runs export jobs in a pool of processes, enforcing cancellation and limits."""
+
+import asyncio
+import multiprocessing
+import os
+import signal
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from functools import partial
+from time import time
+from typing import Any, Callable
+from uuid import UUID
+
+from fastapi.concurrency import run_in_threadpool
+
+from .dataframe import init_worker
+from .jobs import store
+from .progress import JobAborted, apply_update, drain, process_rss
+from .scheduler import Scheduler
+
+__all__ = ["RunningJob", "JobRunner"]
+
+logger = logging.getLogger("server")
+
+
+@dataclass
+class RunningJob:
+    """A job submitted to the pool by this server process.
+
+    Attributes:
+        uid: job id
+        future: future of the submitted call
+        pid: export process running the job, once it has reported
+        started: time the job started running, once it has reported
+        reason: why the job is being stopped, if it is
+        kill_at: time to kill the process if the job has not stopped by itself
+    """
+
+    uid: UUID
+    future: Future | None = None
+    pid: int | None = None
+    started: float | None = None
+    reason: str | None = None
+    kill_at: float | None = None
+
+
+class JobRunner:
+    """Process pool for export jobs, with cancellation, time and memory limits.
+
+    Jobs are stopped cooperatively first: the export process sees the
+    cancellation or limit in its progress callback and aborts. A job which has
+    not stopped within `grace` seconds has its process killed, and the pool is
+    replaced. Other jobs running in the old pool are resubmitted to the new one.
+
+    Jobs only reach the pool once admitted by the scheduler, see `scheduler.py`.
+
+    Attributes:
+        max_workers: number of export processes
+        timeout: maximum run time of a job in seconds
+        memory: maximum resident memory of an export process in bytes
+        grace: time in seconds to wait for a job to stop before killing it
+        preload: whether export processes load all dataframes on startup
+        scheduler: admission control in front of the pool
+        context: multiprocessing context of the pool
+        queue: progress queue shared with export processes
+        running: jobs submitted by this server process
+    """
+
+    # time in seconds between watchdog checks
+    INTERVAL = 1.0
+
+    def __init__(self, max_workers: int, timeout: int, memory: int,
+                 grace: int, budget: int, preload: bool = False):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory = memory
+        self.grace = grace
+        self.preload = preload
+        self.scheduler = Scheduler(budget, max_workers)
+        # not fork: the server has threads by now (vaex hashes with a blake3
+        # thread pool), and a forked process deadlocks on their locks. This
+        # holds for pools replaced later on just as for the first one.
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload([init_worker.__module__])
+        self.queue = self.context.Queue()
+        self.executor = self._make_executor()
+        self.running: dict[UUID, RunningJob] = {}
+        self._tasks: list[asyncio.Task] = []
+
+    def _make_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers,
+                                   mp_context=self.context,
+                                   initializer=init_worker,
+                                   initargs=(self.queue, self.preload))
+
+    def prestart(self) -> None:
+        """Starts all export processes now, rather than on the first jobs.
+
+        With `preload`, this waits until every process has loaded its cache.
+        """
+        # the pool starts a process per submit while none are idle
+        futures = [
+            self.executor.submit(os.getpid) for _ in range(self.max_workers)
+        ]
+        pids = {future.result() for future in futures}
+        logger.info(f"started {len(pids)} export processes")
+
+    def start(self) -> None:
+        """Starts progress tracking and the watchdog. Call from within the event loop."""
+        self._tasks = [
+            asyncio.create_task(self.track_progress()),
+            asyncio.create_task(self.watchdog()),
+        ]
+
+    def pids(self) -> list[int]:
+        """Process ids of the pool's export processes."""
+        # no public API for this; empty until the pool has started
+        return list(getattr(self.executor, "_processes", None) or {})
+
+    def shutdown(self) -> None:
+        """Stops background tasks and the pool."""
+        for task in self._tasks:
+            task.cancel()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self,
+                  uid: UUID,
+                  fn: Callable,
+                  *args,
+                  session: str = "",
+                  memory: int = 0,
+                  **kwargs) -> Any:
+        """Runs `fn(uid, *args, **kwargs)` in an export process once admitted.
+
+        Args:
+            uid: job id
+            fn: function to run
+            session: session the job was submitted from, for fair queueing
+            memory: estimated peak memory of the job in bytes
+
+        Raises:
+            JobAborted: if the job was stopped
+        """
+        record = self.running[uid] = RunningJob(uid)
+        try:
+            # a task cancelled once admitted, but before it resumes, still
+            # holds its share of the budget; releasing is a no-op otherwise
+            await self.scheduler.acquire(uid, session, memory)
+            # stopped once admitted, but before it could be submitted
+            if record.reason is not None:
+                raise JobAborted(record.reason)
+            return await self._submit(record, fn, *args, **kwargs)
+        finally:
+            self.scheduler.release(uid)
+            self.running.pop(uid, None)
+
+    async def _submit(self, record: RunningJob, fn: Callable, *args,
+                      **kwargs) -> Any:
+        """Submits a job to the pool, resubmitting it if the pool is replaced under it."""
+        while True:
+            executor = self.executor
+            record.future = executor.submit(
+                partial(fn, record.uid, *args, **kwargs))
+            try:
+                return await asyncio.wrap_future(record.future)
+            except asyncio.CancelledError:
+                if record.reason is not None:  # stopped before it started
+                    raise JobAborted(record.reason) from None
+                raise
+            except BrokenProcessPool:
+                if record.reason is not None:
+                    raise JobAborted(record.reason) from None
+                if executor is self.executor:
+                    # broke by itself, i.e. a process was OOM killed
+                    self._replace_executor()
+                    raise
+                logger.info(f"resubmitting job {record.uid} to new pool")
+                record.pid = record.started = None
+
+    def stop(self, uid: UUID, reason: str) -> bool:
+        """Stops a job, if it was submitted by this server process.
+
+        Jobs not yet started are removed from the scheduler's or the pool's
+        queue. Running jobs are killed if they do not stop by themselves within
+        `grace` seconds.
+
+        Returns:
+            `True` if the job is stopping, `False` if it is not running here.
+        """
+        record = self.running.get(uid)
+        if record is None:
+            return False
+        if self.scheduler.abort(uid, reason):
+            logger.info(f"removed job {uid} from queue: {reason}")
+            return True
+        if record.reason is None:
+            logger.info(f"stopping job {uid}: {reason}")
+            record.reason = reason
+            record.kill_at = time() + self.grace
+        if (record.future is not None) and record.future.cancel():
+            self.running.pop(uid, None)
+        return True
+
+    def kill(self, record: RunningJob) -> None:
+        """Kills a job's process and replaces the pool.
+
+        A job which has not reported its process yet is left to abort at its
+        first progress check, and killed `grace` seconds later if it hasn't.
+        """
+        if record.pid is None:
+            logger.warning(f"job {record.uid} has no process to kill yet")
+            record.kill_at = time() + self.grace
+            return
+        logger.warning(f"killing process {record.pid} of job {record.uid}")
+        try:
+            os.kill(record.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self._replace_executor()
+
+    def _replace_executor(self) -> None:
+        old = self.executor
+        self.executor = self._make_executor()
+        old.shutdown(wait=False, cancel_futures=True)
+
+    def check(self, record: RunningJob) -> None:
+        """Checks a running job against cancellation and its limits."""
+        if record.reason is not None:
+            if (record.kill_at is not None) and (time() > record.kill_at):
+                record.kill_at = None
+                self.kill(record)
+            return
+        job = store.get(record.uid)
+        if (job is not None) and (job.status == "cancelled"):
+            self.stop(record.uid, "job was cancelled")
+        elif (record.started is not None) and (time() - record.started
+                                               > self.timeout):
+            self.stop(record.uid,
+                      f"job exceeded time limit of {self.timeout}s")
+        elif (record.pid is not None) and (process_rss(record.pid)
+                                           > self.memory):
+            self.stop(record.uid,
+                      f"job exceeded memory limit of {self.memory} bytes")
+
+    async def watchdog(self) -> None:
+        """Checks all running jobs every `INTERVAL` seconds."""
+        while True:
+            for record in list(self.running.values()):
+                try:
+                    self.check(record)
+                except Exception as e:
+                    logger.warning(f"watchdog check of {record.uid} failed: {e}")
+            await asyncio.sleep(self.INTERVAL)
+
+    async def track_progress(self) -> None:
+        """Applies progress updates from export processes to the job store."""
+        while True:
+            updates = await run_in_threadpool(drain, self.queue)
+            for uid, update in updates.items():
+                record = self.running.get(uid)
+                if record is not None:
+                    record.pid = update.get("pid", record.pid)
+                    record.started = record.started or time()
+                job = store.get(uid)
+                if (job is not None) and (job.status == "in_progress"):
+                    # unless cancelled or failed since, maybe by another worker
+                    store.update(apply_update(job, update))
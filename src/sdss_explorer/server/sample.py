@@ -0,0 +1,230 @@
+"""Random and stratified sampling of filtered subsets.
+
+Sampling picks row positions within the filtered dataframe, so only the
+stratifying column (if any) is evaluated over the matched rows. The sampled
+positions are taken in ascending order, and the exported columns are then only
+read for the sampled rows.
+"""
+
+import logging
+
+import numpy as np
+import vaex as vx
+
+from .dataframe import mappings
+from .progress import ProgressReporter
+from ..util.filters import filter_carton_mapper
+
+__all__ = [
+    "SAMPLE_PARAMS",
+    "parse_quota",
+    "validate_sample",
+    "is_sampled",
+    "sample_dataframe",
+    "sampled_rows",
+]
+
+logger = logging.getLogger("server")
+
+# parameters that select a sample of the matched rows
+SAMPLE_PARAMS = (
+    "sample_size",
+    "sample_fraction",
+    "sample_seed",
+    "stratify",
+    "quota",
+)
+
+# `stratify` value to stratify by the requested cartons
+CARTON_STRATA = "carton"
+
+
+def parse_quota(quota: str) -> tuple[int | None, dict[str, int]]:
+    """Parses per-stratum quotas.
+
+    Quotas are comma-separated, either a bare count applying to every stratum,
+    or `value=count` for a specific one, i.e. `100,apo1m=10`.
+
+    Args:
+        quota: quota string
+
+    Returns:
+        The default quota (`None` if strata without a quota are left out), and
+        quotas by stratum value.
+
+    Raises:
+        ValueError: if a quota is malformed or negative
+    """
+    default = None
+    quotas = dict()
+    for item in quota.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        value, _, number = item.rpartition("=")
+        try:
+            count = int(number)
+        except ValueError:
+            raise ValueError(f"invalid sample quota {item}")
+        if count < 0:
+            raise ValueError(f"negative sample quota {item}")
+        if value:
+            quotas[value.strip()] = count
+        else:
+            default = count
+    return default, quotas
+
+
+def validate_sample(sample_size: int = 0,
+                    sample_fraction: float = 0.0,
+                    sample_seed: int = 0,
+                    stratify: str = "",
+                    quota: str = "",
+                    carton: str = "") -> None:
+    """Validates sampling options.
+
+    Raises:
+        ValueError: if any option is invalid, or options conflict
+    """
+    if sample_size < 0:
+        raise ValueError("sample size must not be negative")
+    if not 0.0 <= sample_fraction <= 1.0:
+        raise ValueError("sample fraction must be between 0 and 1")
+    if sample_size and sample_fraction:
+        raise ValueError("give either a sample size or a fraction, not both")
+    if stratify:
+        if sample_size or sample_fraction:
+            raise ValueError("stratified samples are sized by quota")
+        default, quotas = parse_quota(quota)
+        if (default is None) and not quotas:
+            raise ValueError("stratified samples need a quota")
+        if (stratify == CARTON_STRATA) and not carton:
+            raise ValueError("stratifying by carton needs cartons")
+    elif quota:
+        raise ValueError("sample quotas need a column to stratify by")
+
+
+def is_sampled(sample_size: int = 0,
+               sample_fraction: float = 0.0,
+               stratify: str = "",
+               **kwargs) -> bool:
+    """Whether options select a sample rather than all matched rows."""
+    return bool(sample_size or sample_fraction or stratify)
+
+
+def _choose(rng: np.random.Generator, positions: np.ndarray,
+            k: int) -> np.ndarray:
+    if k >= len(positions):
+        return positions
+    return rng.choice(positions, k, replace=False)
+
+
+def _strata(dff: vx.DataFrame, columns: list[str], stratify: str, carton: str,
+            progress: ProgressReporter | None) -> list[tuple[str, np.ndarray]]:
+    """Positions in `dff` of each stratum, by stratum value."""
+    if stratify == CARTON_STRATA:
+        cartons = [c for c in carton.split(",") if c]
+        masks = [
+            filter_carton_mapper(dff, mappings, [c], []) for c in cartons
+        ]
+        masks = dff.evaluate(masks, progress=progress)  # in one pass
+        return [(c, np.flatnonzero(np.asarray(mask)))
+                for c, mask in zip(cartons, masks)]
+
+    if stratify not in columns:
+        raise ValueError(f"invalid column to stratify by {stratify}")
+    values = dff.evaluate(stratify, progress=progress)
+    if hasattr(values, "to_numpy"):  # arrow strings
+        values = values.to_numpy(zero_copy_only=False)
+    values = np.asarray(values)
+    keys, inverse = np.unique(values.astype(str), return_inverse=True)
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(keys)))[:-1]
+    return list(zip(keys.tolist(), np.split(order, bounds)))
+
+
+def sample_dataframe(dff: vx.DataFrame,
+                     columns: list[str],
+                     sample_size: int = 0,
+                     sample_fraction: float = 0.0,
+                     sample_seed: int = 0,
+                     stratify: str = "",
+                     quota: str = "",
+                     carton: str = "",
+                     progress: ProgressReporter | None = None,
+                     **kwargs) -> vx.DataFrame:
+    """Samples rows of a filtered dataframe.
+
+    Uniform samples draw `sample_size` rows, or `sample_fraction` of rows.
+    Stratified samples draw up to a quota of rows from each value of the
+    `stratify` column, or from each of the requested cartons if `stratify` is
+    `carton`. A row in several cartons is exported once.
+
+    Args:
+        dff: filtered dataframe, as from `load_filtered`
+        columns: valid columns of the dataset
+        sample_size: number of rows to sample
+        sample_fraction: fraction of rows to sample
+        sample_seed: seed of the random generator, so samples are reproducible
+        stratify: column to stratify by, or `carton`
+        quota: rows per stratum, see `parse_quota`
+        carton: comma-separated cartons of the filter, as strata
+        progress: reporter for evaluating strata
+        kwargs: other parameters, ignored
+
+    Returns:
+        The sampled dataframe, or `dff` as is if no sample is requested.
+
+    Raises:
+        ValueError: if options are invalid
+    """
+    if not is_sampled(sample_size, sample_fraction, stratify):
+        return dff
+    validate_sample(sample_size, sample_fraction, sample_seed, stratify,
+                    quota, carton)
+    rng = np.random.default_rng(sample_seed)
+
+    if stratify:
+        default, quotas = parse_quota(quota)
+        chosen = []
+        for key, positions in _strata(dff, columns, stratify, carton,
+                                      progress):
+            k = quotas.get(key, default)
+            if k:
+                chosen.append(_choose(rng, positions, k))
+        positions = np.unique(np.concatenate(chosen)) if chosen else []
+    else:
+        n = len(dff)
+        k = sample_size or int(round(sample_fraction * n))
+        if k >= n:
+            return dff
+        positions = np.sort(rng.choice(n, k, replace=False))
+
+    if len(positions) == 0:
+        raise Exception("sample has no rows")
+    logger.debug(f"sampled {len(positions)} of {len(dff)} rows")
+    return dff.take(positions)
+
+
+def sampled_rows(matched: float,
+                 sample_size: int = 0,
+                 sample_fraction: float = 0.0,
+                 stratify: str = "",
+                 quota: str = "",
+                 carton: str = "",
+                 **kwargs) -> float:
+    """Upper bound of the rows sampled from `matched` rows, for memory estimates."""
+    if stratify:
+        default, quotas = parse_quota(quota)
+        if default is None:
+            bound = sum(quotas.values())
+        elif stratify == CARTON_STRATA:
+            bound = default * len(carton.split(",")) + sum(quotas.values())
+        else:  # unknown number of strata
+            return matched
+        return min(matched, bound)
+    if sample_size:
+        return min(matched, sample_size)
+    if sample_fraction:
+        return matched * sample_fraction
+    return matched
@@ -0,0 +1,280 @@
+"""Admission control for export jobs.
+
+Jobs are admitted to the process pool only while the sum of their estimated
+peak memory stays under a budget. Waiting jobs are queued fairly across
+sessions, so one user's batch of exports can't starve everyone else.
+"""
+
+import asyncio
+import logging
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from time import time
+from uuid import UUID
+
+from .dataframe import estimate_nbytes, load_dataframe
+from .filter import cached_count, project_columns
+from .jobs import store
+from .progress import JobAborted
+from .sample import sampled_rows
+from ..util.spatial import POSITION_CMTYPE
+
+__all__ = [
+    "Ticket",
+    "Scheduler",
+    "estimate_memory",
+    "estimate_selectivity",
+    "record_selectivity",
+]
+
+logger = logging.getLogger("server")
+
+# fixed memory cost of a job: interpreter, vaex, arrow buffers
+JOB_OVERHEAD = 300_000_000
+
+# bytes per scanned row for the filter mask and selection index
+MASK_NBYTES = 9
+
+# fraction of rows assumed to match a filter with no history to go on
+DEFAULT_SELECTIVITY = 0.5
+
+# weight of the newest job in the running mean of selectivity
+SELECTIVITY_WEIGHT = 0.2
+
+# running mean of selectivity of filtered jobs, by (release, datatype, dataset)
+_selectivity: dict[tuple[str, str, str], float] = {}
+
+
+def record_selectivity(release: str, datatype: str, dataset: str,
+                       rows_total: int, rows_matched: int) -> None:
+    """Records the selectivity of a completed filtered job."""
+    if rows_total <= 0:
+        return
+    key = (release, datatype, dataset)
+    observed = rows_matched / rows_total
+    previous = _selectivity.get(key)
+    _selectivity[key] = observed if previous is None else (
+        SELECTIVITY_WEIGHT * observed + (1 - SELECTIVITY_WEIGHT) * previous)
+
+
+def estimate_selectivity(release: str,
+                         datatype: str,
+                         dataset: str,
+                         nrows: int,
+                         expression: str = "",
+                         carton: str = "",
+                         mapper: str = "",
+                         flags: str = "",
+                         crossmatch: str = "",
+                         **kwargs) -> float:
+    """Estimates the fraction of rows a job's filters will match.
+
+    Unfiltered jobs match everything. Filters counted before, by a job or by
+    `/estimate`, use that count. Crossmatches of identifiers match at most one
+    row per identifier. Otherwise, the running mean of past jobs on the
+    dataset is used.
+
+    Args:
+        release: data release
+        datatype: datatype (star or visit)
+        dataset: specific dataset i.e. aspcap, spall, best
+        nrows: rows in the dataset
+        kwargs: remaining filter parameters, ignored
+
+    Returns:
+        Estimated fraction of rows matched, from 0 to 1.
+    """
+    if not any((expression, carton, mapper, flags, crossmatch)):
+        return 1.0
+    counts = cached_count(release,
+                          datatype,
+                          dataset,
+                          expression=expression,
+                          carton=carton,
+                          mapper=mapper,
+                          flags=flags,
+                          crossmatch=crossmatch,
+                          **kwargs)
+    if counts is not None:
+        return counts[1] / max(counts[0], 1)
+    if crossmatch and (kwargs.get("cmtype") != POSITION_CMTYPE):
+        identifiers = sum(1 for line in crossmatch.split("\n") if line.strip())
+        return min(1.0, identifiers / max(nrows, 1))
+    return _selectivity.get((release, datatype, dataset), DEFAULT_SELECTIVITY)
+
+
+def estimate_memory(release: str,
+                    datatype: str,
+                    dataset: str,
+                    columns: str = "",
+                    **kwargs) -> int:
+    """Estimates the peak memory of an export job.
+
+    The model is a fixed overhead, plus a mask and index over every row of the
+    dataset, plus the projected columns of every matched (or sampled) row.
+
+    Args:
+        release: data release
+        datatype: datatype (star or visit)
+        dataset: specific dataset i.e. aspcap, spall, best
+        columns: comma-separated columns to export. Defaults to all.
+        kwargs: filter parameters, see `estimate_selectivity`
+
+    Returns:
+        Estimated peak memory in bytes.
+
+    Raises:
+        Exception: if the dataset fails to load or columns are invalid
+    """
+    dff, validCols = load_dataframe(release, datatype, dataset)
+    if (dff is None) or (validCols is None):
+        raise Exception("dataframe/columns load failed")
+    nrows = len(dff)
+    matched = nrows * estimate_selectivity(release, datatype, dataset, nrows,
+                                           **kwargs)
+    matched = sampled_rows(matched, **kwargs)
+    rowsize = estimate_nbytes(dff, project_columns(validCols, columns)) / max(
+        nrows, 1)
+    return int(JOB_OVERHEAD + nrows * MASK_NBYTES + matched * rowsize)
+
+
+@dataclass
+class Ticket:
+    """A job waiting for or holding admission.
+
+    Attributes:
+        uid: job id
+        session: session the job was submitted from
+        memory: estimated peak memory in bytes
+        arrival: time the job was queued
+        admitted: resolved when the job is admitted
+        position: last published queue position, if waiting
+    """
+
+    uid: UUID
+    session: str
+    memory: int
+    arrival: float = field(default_factory=time)
+    admitted: asyncio.Future = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future())
+    position: int | None = None
+
+
+class Scheduler:
+    """Admits jobs within a memory budget and a number of slots.
+
+    Waiting jobs are ordered by how many jobs their session already has
+    admitted, then by arrival, so sessions take turns. Admission stops at the
+    first job in that order which does not fit, so large jobs are not starved
+    by smaller ones behind them. A job is always admitted if nothing else is
+    running, even if it alone exceeds the budget.
+
+    Queue positions are published to the job store as `queue_position`.
+
+    Attributes:
+        budget: total estimated memory of admitted jobs in bytes
+        slots: maximum number of admitted jobs
+        waiting: waiting jobs, in arrival order
+        admitted: admitted jobs
+    """
+
+    def __init__(self, budget: int, slots: int):
+        self.budget = budget
+        self.slots = slots
+        self.waiting: list[Ticket] = []
+        self.admitted: dict[UUID, Ticket] = {}
+
+    @property
+    def in_use(self) -> int:
+        """Total estimated memory of admitted jobs in bytes."""
+        return sum(ticket.memory for ticket in self.admitted.values())
+
+    def order(self) -> list[Ticket]:
+        """Orders waiting jobs as they would be admitted."""
+        counts = Counter(ticket.session for ticket in self.admitted.values())
+        queues: dict[str, deque[Ticket]] = {}
+        for ticket in self.waiting:
+            queues.setdefault(ticket.session, deque()).append(ticket)
+        order = []
+        while queues:
+            session = min(queues,
+                          key=lambda s: (counts[s], queues[s][0].arrival))
+            order.append(queues[session].popleft())
+            counts[session] += 1
+            if not queues[session]:
+                del queues[session]
+        return order
+
+    def fits(self, ticket: Ticket) -> bool:
+        """Checks whether a job can be admitted now."""
+        if not self.admitted:
+            return True
+        return (len(self.admitted) < self.slots) and (self.in_use +
+                                                      ticket.memory
+                                                      <= self.budget)
+
+    def schedule(self) -> None:
+        """Admits waiting jobs in order while they fit, then publishes queue positions."""
+        order = self.order()
+        while order and self.fits(order[0]):
+            ticket = order.pop(0)
+            self.waiting.remove(ticket)
+            self.admitted[ticket.uid] = ticket
+            if not ticket.admitted.done():
+                ticket.admitted.set_result(None)
+            logger.debug(
+                f"admitted job {ticket.uid} ({ticket.memory} bytes, {self.in_use} in use)"
+            )
+            if ticket.position is not None:
+                self._publish(ticket, None)
+        for position, ticket in enumerate(order, start=1):
+            if ticket.position != position:
+                self._publish(ticket, position)
+
+    def _publish(self, ticket: Ticket, position: int | None) -> None:
+        ticket.position = position
+        job = store.get(ticket.uid)
+        if (job is not None) and (job.status == "in_progress"):
+            job.queue_position = position
+            store.put(job)
+
+    async def acquire(self, uid: UUID, session: str, memory: int) -> None:
+        """Waits until a job is admitted.
+
+        Args:
+            uid: job id
+            session: session the job was submitted from
+            memory: estimated peak memory in bytes
+
+        Raises:
+            JobAborted: if the job is aborted while waiting
+        """
+        ticket = Ticket(uid, session, memory)
+        self.waiting.append(ticket)
+        self.schedule()
+        try:
+            await ticket.admitted
+        except BaseException:
+            if ticket in self.waiting:
+                self.waiting.remove(ticket)
+                self.schedule()
+            raise
+
+    def release(self, uid: UUID) -> None:
+        """Releases an admitted job's share of the budget."""
+        if self.admitted.pop(uid, None) is not None:
+            self.schedule()
+
+    def abort(self, uid: UUID, reason: str) -> bool:
+        """Removes a waiting job from the queue.
+
+        Returns:
+            `True` if the job was waiting, `False` otherwise.
+        """
+        for ticket in self.waiting:
+            if ticket.uid == uid:
+                self.waiting.remove(ticket)
+                ticket.admitted.set_exception(JobAborted(reason))
+                self.schedule()
+                return True
+        return False
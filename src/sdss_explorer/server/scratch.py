@@ -0,0 +1,148 @@
+"""Scratch space management. Evicts old or least recently used exports to keep the scratch disk under quota."""
+
+import fcntl
+import os
+import shutil
+import logging
+from dataclasses import dataclass
+from time import time
+from uuid import UUID
+
+from .jobs import JobStore
+
+__all__ = ["ScratchEntry", "ScratchManager"]
+
+logger = logging.getLogger("server")
+
+
+@dataclass
+class ScratchEntry:
+    """A job's export directory on the scratch disk.
+
+    Attributes:
+        uid: job id, which is also the directory name
+        path: path to directory
+        nbytes: total size of files in bytes
+        accessed: last access or modification time of any file
+    """
+
+    uid: UUID
+    path: str
+    nbytes: int
+    accessed: float
+
+
+class ScratchManager:
+    """Enforces a byte quota and maximum age on the scratch disk.
+
+    Each job writes to `scratch/<uid>/`, so the job directory is the unit of
+    eviction. Jobs still in progress are never evicted, and evicted jobs are
+    marked as `expired` in the job store.
+
+    Every server worker has a manager, but only one sweeps at a time: sweeps
+    hold a lock on `LOCKFILE` in the scratch directory, and are skipped while
+    another process holds it.
+
+    Attributes:
+        root: scratch directory
+        store: job store to check and update statuses in
+        quota: maximum total size in bytes
+        maxage: maximum time in seconds since last access
+    """
+
+    # lock file held while sweeping; not a job directory, so never scanned
+    LOCKFILE = ".sweep.lock"
+
+    def __init__(self, root: str, store: JobStore, quota: int, maxage: int):
+        self.root = root
+        self.store = store
+        self.quota = quota
+        self.maxage = maxage
+
+    def scan(self) -> list[ScratchEntry]:
+        """Lists all job directories in the scratch space, least recently used first."""
+        entries: list[ScratchEntry] = []
+        if not os.path.isdir(self.root):
+            return entries
+        for it in os.scandir(self.root):
+            if not it.is_dir():
+                continue
+            try:
+                uid = UUID(it.name)
+            except ValueError:
+                continue  # not ours
+            nbytes = 0
+            accessed = 0.0
+            for dirpath, _, filenames in os.walk(it.path):
+                for filename in filenames:
+                    try:
+                        stat = os.stat(os.path.join(dirpath, filename))
+                    except FileNotFoundError:
+                        continue
+                    nbytes += stat.st_size
+                    accessed = max(accessed, stat.st_atime, stat.st_mtime)
+            if not accessed:  # nothing written yet
+                accessed = it.stat().st_mtime
+            entries.append(ScratchEntry(uid, it.path, nbytes, accessed))
+        return sorted(entries, key=lambda entry: entry.accessed)
+
+    def touch(self, filepath: str) -> None:
+        """Marks a file as recently used.
+
+        Args:
+            filepath: path relative to the scratch root
+        """
+        try:
+            os.utime(os.path.join(self.root, filepath))
+        except FileNotFoundError:
+            pass
+
+    def evict(self, entry: ScratchEntry) -> bool:
+        """Deletes a job directory and marks its job as expired.
+
+        Returns:
+            `True` if evicted, `False` if the job is still in progress.
+        """
+        job = self.store.get(entry.uid)
+        if (job is not None) and (job.status == "in_progress"):
+            return False
+        shutil.rmtree(entry.path, ignore_errors=True)
+        if job is not None:
+            job.status = "expired"
+            job.message = "file was removed from the scratch space"
+            self.store.put(job)
+        logger.debug(f"evicted {entry.uid} ({entry.nbytes} bytes)")
+        return True
+
+    def sweep(self) -> int:
+        """Evicts expired entries, then least recently used entries until under quota.
+
+        Returns:
+            Number of bytes freed, 0 if another process is sweeping.
+        """
+        if not os.path.isdir(self.root):
+            return 0
+        with open(os.path.join(self.root, self.LOCKFILE), "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug("scratch is being swept by another process")
+                return 0
+            # released when the file is closed
+            return self._sweep()
+
+    def _sweep(self) -> int:
+        entries = self.scan()
+        total = sum(entry.nbytes for entry in entries)
+        cutoff = time() - self.maxage
+        freed = 0
+        for entry in entries:
+            if (entry.accessed >= cutoff) and (total - freed <= self.quota):
+                break  # sorted by access, so everything after is kept too
+            if self.evict(entry):
+                freed += entry.nbytes
+        if freed:
+            logger.info(
+                f"scratch sweep freed {freed} bytes, {total - freed} bytes in use"
+            )
+        return freed
@@ -0,0 +1,74 @@
+"""Tests for binned aggregation of subsets."""
+
+import os
+from typing import Any
+from uuid import uuid4
+
+import numpy as np
+import pytest
+import vaex as vx
+
+from . import aggregate
+from .aggregate import AggregateRequest, aggregate_key, aggregate_subset, decode
+
+
+def test_aggregate_key(monkeypatch, tmp_path):
+    body: dict[str, Any] = dict(subset=dict(name="A", dataset="aspcap"),
+                                x="teff")
+    key = aggregate_key("dr19", "star", AggregateRequest(**body))
+    # names and unused heatmap parameters don't change the result
+    renamed = dict(body, subset=dict(name="B", dataset="aspcap"), y="logg")
+    assert aggregate_key("dr19", "star", AggregateRequest(**renamed)) == key
+    assert aggregate_key("dr19", "visit", AggregateRequest(**body)) != key
+    # nor do results of another version or a replaced file
+    monkeypatch.setattr(aggregate.settings, "vastra", "0.0.0")
+    monkeypatch.setattr(aggregate.settings, "datapath", str(tmp_path))
+    assert aggregate_key("dr19", "star", AggregateRequest(**body)) != key
+    path = tmp_path / "dr19" / "explorerAllStar-0.0.0.hdf5"
+    path.parent.mkdir()
+    path.write_bytes(b"old")
+    key = aggregate_key("dr19", "star", AggregateRequest(**body))
+    os.utime(path, ns=(0, path.stat().st_mtime_ns + 10**9))
+    assert aggregate_key("dr19", "star", AggregateRequest(**body)) != key
+
+    with pytest.raises(ValueError, match="bintype"):
+        AggregateRequest(**body, bintype="mode").validate_aggregate()
+    with pytest.raises(ValueError, match="heatmaps"):
+        AggregateRequest(**body, plottype="heatmap").validate_aggregate()
+
+
+def test_aggregate_subset(monkeypatch):
+    dff = vx.from_arrays(teff=np.array([4000.0, 5000.0, 5500.0, 6000.0]),
+                         logg=np.array([1.0, 2.0, 3.0, 4.0]),
+                         telescope=np.array(["apo25m"] * 4))
+    columns = ["teff", "logg", "telescope"]
+    monkeypatch.setattr(aggregate, "load_dataframe",
+                        lambda *args: (dff, columns))
+    subset = dict(dataset="test", expression="teff > 4500")
+
+    hist = decode(
+        aggregate_subset(uuid4(), "dr19", "star",
+                         dict(subset=subset, x="logg", nbins=3,
+                              xlimits=(1.5, 4.5))))
+    assert hist["grid"].tolist() == [1, 1, 1]
+    assert hist["edges_x"].tolist() == [1.5, 2.5, 3.5, 4.5]
+    assert hist["rows"] == 3
+
+    heatmap = decode(
+        aggregate_subset(
+            uuid4(), "dr19", "star",
+            dict(subset=subset,
+                 plottype="heatmap",
+                 x="logg",
+                 y="teff",
+                 color="teff",
+                 bintype="max",
+                 nbins=2,
+                 xlimits=(1.5, 4.5),
+                 ylimits=(4500, 6500))))
+    assert heatmap["grid"].shape == (2, 2)
+    assert np.nanmax(heatmap["grid"]) == 6000.0
+
+    with pytest.raises(ValueError, match="categorical"):
+        aggregate_subset(uuid4(), "dr19", "star",
+                         dict(subset=subset, x="telescope"))
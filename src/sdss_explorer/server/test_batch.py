@@ -0,0 +1,38 @@
+"""Tests for batch export of many subsets."""
+
+import numpy as np
+import pytest
+import vaex as vx
+
+from .batch import BatchRequest, SubsetSpec, membership_columns, scan_subsets
+
+
+def test_membership_columns():
+    assert membership_columns(["A", "B", "A", "my set"]) == [
+        "in_A", "in_B", "in_A_2", "in_my_set"
+    ]
+
+
+def test_scan_subsets():
+    dff = vx.from_arrays(teff=np.array([3000.0, 4000.0, np.nan, 6000.0]),
+                         logg=np.array([1.0, 2.0, 3.0, 4.0]))
+    specs = [
+        SubsetSpec(dataset="test", expression="teff > 3500"),
+        SubsetSpec.model_validate(dict(dataset="test", flags=[])),
+        SubsetSpec(dataset="test", expression="logg < 2.5"),
+    ]
+    masks = scan_subsets(dff, ["teff", "logg"], "test", specs)
+    assert [mask.tolist() for mask in masks] == [
+        [False, True, False, True],
+        [True, True, True, True],
+        [True, True, False, False],
+    ]
+
+
+def test_batch_request_validation():
+    subsets = [SubsetSpec(dataset="aspcap"), SubsetSpec(dataset="spall")]
+    BatchRequest(subsets=subsets).validate_batch()
+    with pytest.raises(ValueError, match="share a dataset"):
+        BatchRequest(subsets=subsets, output="single").validate_batch()
+    with pytest.raises(ValueError):
+        BatchRequest(subsets=subsets, output="zip").validate_batch()
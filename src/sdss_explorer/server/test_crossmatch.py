@@ -0,0 +1,148 @@
+"""Tests for indexed crossmatching."""
+
+import io
+from collections import OrderedDict
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+import vaex as vx
+
+from . import crossmatch as crossmatch_module
+from .crossmatch import (
+    filter_crossmatch_indexed,
+    match_identifiers,
+    parse_identifiers,
+    read_identifiers,
+)
+from ..util.config import settings
+from ..util.spatial import ZoneIndex, parse_positions
+
+
+@pytest.fixture
+def df():
+    return vx.from_arrays(
+        sdss_id=np.array([5, 3, 9, 3, 7, 1]),
+        sdss4_apogee_id=pa.array(["a", None, "c", "b", "a", "d"]),
+    )
+
+
+def test_match_identifiers(df):
+    # rows of duplicated identifiers are all found
+    rows, found, unknown = match_identifiers(df, "3\n7\n3\n42\n", "sdss5")
+    assert sorted(rows) == [1, 3, 4]
+    assert (found, unknown) == (2, 1)
+
+    rows, found, unknown = match_identifiers(df, "a\nd\nzz", "sdss4_apogee")
+    assert sorted(rows) == [0, 4, 5]
+    assert (found, unknown) == (2, 1)
+
+    with pytest.raises(ValueError):
+        match_identifiers(df, "3\nthree", "sdss5")
+
+
+def test_index_shared_by_copies(df):
+    match_identifiers(df, "1", "sdss5")
+    copy = df.copy()
+    f = filter_crossmatch_indexed(copy, "1 9", "sdss5")
+    assert copy[f].sdss_id.tolist() == [9, 1]
+    # the hidden mask column is only added to the copy
+    assert len(df.get_column_names(hidden=True)) == 2
+    assert filter_crossmatch_indexed(copy, "", "sdss5") is None
+
+
+def test_filter_matched_rows(df, monkeypatch):
+    rows, _, _ = match_identifiers(df, "1 9", "sdss5")
+    # rows already matched aren't matched again
+    monkeypatch.setattr(crossmatch_module, "match_identifiers", None)
+    copy = df.copy()
+    f = filter_crossmatch_indexed(copy, "1 9", "sdss5", rows)
+    assert copy[f].sdss_id.tolist() == [9, 1]
+
+
+def test_read_identifiers():
+    assert read_identifiers(b"1\n2\n", "sdss5") == "1\n2\n"
+    csv = b"ra,sdss_id\n1.5,10\n2.5,20\n"
+    assert read_identifiers(csv, "sdss5") == "10\n20"
+    # without a header, the first column
+    assert read_identifiers(b"10,1.5\n20,2.5\n", "sdss5") == "10\n20"
+    # a single named column
+    assert read_identifiers(b"sdss5\n10\n", "sdss5") == "10"
+
+    buffer = io.BytesIO()
+    pq.write_table(pa.table({"gaia_dr3_source_id": [1, None, 3]}), buffer)
+    assert read_identifiers(buffer.getvalue(), "gaia_dr3") == "1\n3"
+
+
+def test_parse_identifiers(monkeypatch):
+    monkeypatch.setattr(crossmatch_module, "IDENTIFIER_CACHE_SIZE", 2)
+    monkeypatch.setattr(crossmatch_module, "_identifiers", OrderedDict())
+    parsed = parse_identifiers("3 1\n3", True)
+    assert parsed.tolist() == [1, 3]
+    assert parse_identifiers("3 1\n3", True) is parsed
+    assert parse_identifiers("3 1\n3", False).tolist() == ["1", "3"]
+    # keyed by a hash, not the text, and bounded
+    assert all(isinstance(key[0], bytes) and len(key[0]) == 32
+               for key in crossmatch_module._identifiers)
+    parse_identifiers("4", True)
+    assert len(crossmatch_module._identifiers) == 2
+    with pytest.raises(ValueError, match="integer"):
+        parse_identifiers("a", True)
+
+
+def separation(ra1, dec1, ra2, dec2):
+    """Angular separation in degrees, by dot product of unit vectors."""
+    ra1, dec1, ra2, dec2 = map(np.radians, (ra1, dec1, ra2, dec2))
+    dot = (np.sin(dec1) * np.sin(dec2) +
+           np.cos(dec1) * np.cos(dec2) * np.cos(ra1 - ra2))
+    return np.degrees(np.arccos(np.clip(dot, -1, 1)))
+
+
+def test_zone_index_matches_brute_force():
+    rng = np.random.default_rng(0)
+    ra = rng.uniform(0, 360, 20000)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, 20000)))
+    # cones across the wrap in ra, at a pole, and wider than a zone
+    qra = np.array([0.1, 359.9, 10, 200, 45])
+    qdec = np.array([0, 10, 89.5, -30, 60])
+    radius = np.array([1, 2, 1, 0.01, 3])
+
+    index = ZoneIndex.build(ra, dec)
+    points, query = index.search(qra, qdec, radius)
+    assert index.rows is not None
+    found = set(zip(index.rows[points].tolist(), query.tolist()))
+    d = separation(ra[:, None], dec[:, None], qra, qdec)
+    expected = set(zip(*map(np.ndarray.tolist, np.nonzero(d <= radius))))
+    assert found == expected
+
+
+def test_parse_positions():
+    ra, dec, radius = parse_positions("10 20\n-10, -20, 3600\n")
+    assert np.allclose(ra, [10, 350]) and np.allclose(dec, [20, -20])
+    assert np.allclose(radius, [1 / 3600, 1])
+    with pytest.raises(ValueError):
+        parse_positions("10 95")
+    with pytest.raises(ValueError):
+        parse_positions("10")
+
+
+def test_match_positions(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "scratch", str(tmp_path))
+    df = vx.from_arrays(ra=np.array([10.0, 10.0001, 50.0, np.nan]),
+                        dec=np.array([20.0, 20.0, -5.0, 0.0]))
+    # within 1 arcsec of the first row, 0.36 arcsec from the second
+    rows, found, unknown = match_identifiers(df, "10 20\n100 0", "position")
+    assert rows.tolist() == [0, 1] and (found, unknown) == (1, 1)
+    rows, _, _ = match_identifiers(df, "10 20 0.1", "position")
+    assert rows.tolist() == [0]
+
+    # saved to the scratch disk and loaded by other processes
+    assert len(list((tmp_path / "indexes").iterdir())) == 1
+    monkeypatch.setattr(crossmatch_module, "_indexes",
+                        crossmatch_module.OrderedDict())
+    rows, _, _ = match_identifiers(df, "50 -5", "position")
+    assert rows.tolist() == [2]
+    assert isinstance(crossmatch_module.position_index(df).key, np.memmap)
+
+    assert read_identifiers(b"name,dec,ra\nx,1.5,2\n", "position") == "2 1.5\n"
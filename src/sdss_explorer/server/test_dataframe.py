@@ -0,0 +1,51 @@
+"""Tests for the per-process dataframe cache."""
+
+import json
+
+import numpy as np
+import vaex as vx
+
+from .dataframe import DataFrameCache, discover_datasets, estimate_nbytes
+from ..util.config import settings
+
+
+def make_df(n: int) -> vx.DataFrame:
+    return vx.from_arrays(x=np.arange(n, dtype="float64"))
+
+
+def test_cache_evicts_lru():
+    df = make_df(100)
+    nbytes = estimate_nbytes(df)
+    assert nbytes == 800
+
+    cache = DataFrameCache(budget=2 * nbytes)
+    cache.put(("dr19", "star", "a"), df, ["x"])
+    cache.put(("dr19", "star", "b"), make_df(100), ["x"])
+    cache.get(("dr19", "star", "a"))  # a is now most recent
+    cache.put(("dr19", "star", "c"), make_df(100), ["x"])
+
+    assert ("dr19", "star", "a") in cache
+    assert ("dr19", "star", "b") not in cache
+    assert ("dr19", "star", "c") in cache
+    assert cache.nbytes == 2 * nbytes
+
+
+def test_cache_skips_oversized():
+    cache = DataFrameCache(budget=10)
+    assert not cache.put(("dr19", "star", "a"), make_df(100), ["x"])
+    assert len(cache) == 0
+
+
+def test_discover_datasets(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "datapath", str(tmp_path))
+    release = tmp_path / "dr19"
+    release.mkdir()
+    (release / f"columnsAllStar-{settings.vastra}.json").write_text(
+        json.dumps({"aspcap": [], "spall": []}))
+    (release / f"explorerAllStar-{settings.vastra}.hdf5").touch()
+    # no data file, so skipped
+    (release / f"columnsAllVisit-{settings.vastra}.json").write_text(
+        json.dumps({"apogeenet": []}))
+
+    assert discover_datasets() == [("dr19", "star", "aspcap"),
+                                   ("dr19", "star", "spall")]
@@ -0,0 +1,46 @@
+"""Tests for pushed job status updates."""
+
+import asyncio
+import json
+import threading
+
+from .events import JobEvents
+from .jobs import Job, MemoryJobStore
+
+
+def test_events_push_until_finished():
+
+    async def main():
+        jobstore = MemoryJobStore(ttl=60)
+        events = JobEvents(jobstore, recheck=10)
+        events.start()
+        job = Job()
+        jobstore.put(job)
+
+        received = []
+
+        async def consume():
+            async for event in events.stream(job.uid):
+                received.append(json.loads(event.split("data: ")[1]))
+
+        consumer = asyncio.create_task(consume())
+        await asyncio.sleep(0)
+        job.progress = 0.5
+        jobstore.put(job)
+        await asyncio.sleep(0)
+        job.status = "complete"
+        # puts from other threads are pushed too
+        thread = threading.Thread(target=jobstore.put, args=(job, ))
+        thread.start()
+        thread.join()
+        await asyncio.wait_for(consumer, 1)  # well within `recheck`
+
+        assert [(e["status"], e["progress"]) for e in received] == [
+            ("in_progress", 0.0),
+            ("in_progress", 0.5),
+            ("complete", 0.5),
+        ]
+        assert job.uid not in events._subscribers
+        events.shutdown()
+
+    asyncio.run(main())
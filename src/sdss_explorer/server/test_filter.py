@@ -0,0 +1,36 @@
+"""Tests for export option handling."""
+
+import pytest
+
+from . import filter as filter_module
+from .filter import cached_count, project_columns, record_count, validate_export
+
+
+def test_project_columns():
+    valid = ["teff", "logg", "sdss_id"]
+    assert project_columns(valid) == valid
+    assert project_columns(valid, "sdss_id, teff,sdss_id") == ["sdss_id", "teff"]
+    with pytest.raises(ValueError, match="nope"):
+        project_columns(valid, "teff,nope")
+
+
+def test_validate_export():
+    validate_export("csv")
+    with pytest.raises(ValueError):
+        validate_export("xls")
+    with pytest.raises(ValueError):
+        validate_export("parquet", compression="rar")
+
+
+def test_count_cache(monkeypatch):
+    monkeypatch.setattr(filter_module, "COUNT_CACHE_SIZE", 2)
+    monkeypatch.setattr(filter_module, "_counts", filter_module.OrderedDict())
+    record_count("dr19", "star", "aspcap", 100, 10, expression="teff>1")
+    # export options don't change the count
+    assert cached_count("dr19", "star", "aspcap", expression="teff > 1",
+                        format="csv", columns="teff") == (100, 10)
+    assert cached_count("dr19", "star", "aspcap", expression="teff>2") is None
+
+    record_count("dr19", "star", "aspcap", 100, 20, expression="teff>2")
+    record_count("dr19", "star", "aspcap", 100, 30, expression="teff>3")
+    assert cached_count("dr19", "star", "aspcap", expression="teff>1") is None
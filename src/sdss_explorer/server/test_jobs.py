@@ -0,0 +1,153 @@
+"""Tests for job stores, fingerprinting and reuse."""
+
+import subprocess
+import sys
+
+import pytest
+
+from . import jobs as jobs_module
+from .jobs import (
+    Job,
+    MemoryJobStore,
+    SQLiteJobStore,
+    boot_id,
+    current_owner,
+    fingerprint,
+    find_job,
+    register_job,
+)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def jobstore(request, tmp_path):
+    if request.param == "memory":
+        return MemoryJobStore(ttl=60)
+    return SQLiteJobStore(str(tmp_path / "jobs.sqlite"), ttl=60)
+
+
+def test_store_roundtrip(jobstore):
+    jobs = [Job(fingerprint=str(i)) for i in range(5)]
+    for job in jobs:
+        jobstore.put(job)
+    jobs[0].status = "complete"
+    jobstore.put(jobs[0])
+
+    assert jobstore.get(jobs[0].uid).status == "complete"
+    assert jobstore.find("3").uid == jobs[3].uid
+    assert jobstore.find("missing") is None
+    assert jobstore.count() == 5
+    assert jobstore.count_by_status() == {"complete": 1, "in_progress": 4}
+    assert [job.uid for job in jobstore.page(0, 2)] == [jobs[0].uid, jobs[4].uid]
+
+
+def test_store_expires(jobstore):
+    job = Job()
+    jobstore.put(job)
+    jobstore.ttl = -1
+    assert jobstore.get(job.uid) is None
+    assert jobstore.expire() == 1
+    assert jobstore.count() == 0
+
+
+def test_fingerprint_normalizes():
+    a = fingerprint("dr19", "star", "aspcap", expression="teff < 4000",
+                    carton="b,a", flags="snr > 50,sdss5 only",
+                    crossmatch="2\n1\n")
+    b = fingerprint("dr19", "star", "aspcap", expression="teff<4000",
+                    carton="a,b", flags="sdss5 only,snr > 50",
+                    crossmatch="1\n2", name="B")
+    assert a == b
+    assert a != fingerprint("dr19", "star", "aspcap", expression="teff<4000",
+                            carton="a,b", flags="sdss5 only,snr > 50",
+                            crossmatch="1\n2", invert=True)
+
+    # equivalent expressions match, but not strings differing in spaces
+    assert fingerprint("dr19", "star", "aspcap",
+                       expression="teff > 1 & logg < 2") == fingerprint(
+                           "dr19", "star", "aspcap",
+                           expression="logg<2&teff>1")
+    assert fingerprint("dr19", "star", "aspcap",
+                       expression="telescope == 'a b'") != fingerprint(
+                           "dr19", "star", "aspcap",
+                           expression="telescope == 'ab'")
+    # unparsed expressions are kept as given
+    assert fingerprint("dr19", "star", "aspcap",
+                       expression="teff >") != fingerprint(
+                           "dr19", "star", "aspcap", expression="teff > 0")
+
+
+def test_find_job_reuses_in_progress(monkeypatch):
+    monkeypatch.setattr(jobs_module, "store", MemoryJobStore(ttl=60))
+    key = fingerprint("dr19", "star", "aspcap", expression="logg > 4")
+    assert find_job(key) is None
+    job = Job(fingerprint=key, owner=current_owner())
+    register_job(job)
+    found = find_job(key)
+    assert (found is not None) and (found.uid == job.uid)
+    job.status = "failed"
+    register_job(job)
+    assert find_job(key) is None
+
+
+def dead_owner() -> str:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return f"{boot_id()}:{process.pid}"
+
+
+def test_recover_after_restart(tmp_path, monkeypatch):
+    path = str(tmp_path / "jobs.sqlite")
+    before = SQLiteJobStore(path, ttl=60)
+    crashed = Job(fingerprint="a", owner=dead_owner())
+    rebooted = Job(fingerprint="b", owner="another-boot:1")
+    running = Job(fingerprint="c", owner=current_owner())
+    done = Job(fingerprint="d", owner=dead_owner(), status="complete")
+    for job in (crashed, rebooted, running, done):
+        before.put(job)
+
+    # as a restarted worker, with its own connection
+    after = SQLiteJobStore(path, ttl=60)
+    monkeypatch.setattr(jobs_module, "store", after)
+    assert find_job("a") is None  # skipped even before recovery
+    found = find_job("c")
+    assert (found is not None) and (found.uid == running.uid)
+    assert after.recover(stale=60) == 2
+    statuses = {job.uid: job.status for job in after.page()}
+    assert statuses[crashed.uid] == "failed"
+    assert statuses[rebooted.uid] == "failed"
+    assert statuses[running.uid] == "in_progress"
+    assert statuses[done.uid] == "complete"
+    assert after.recover(stale=60) == 0
+
+
+def test_heartbeat(jobstore):
+    running = Job(owner=current_owner())
+    done = Job(owner=current_owner(), status="complete")
+    jobstore.put(running)
+    jobstore.put(done)
+    # a running owner's jobs go stale without heartbeats
+    assert jobstore.get(running.uid).orphaned(stale=-1)
+    assert not jobstore.get(running.uid).orphaned(stale=60)
+    beat = jobstore.get(running.uid).heartbeat
+    assert jobstore.heartbeat(current_owner()) == 1
+    assert jobstore.get(running.uid).heartbeat >= beat
+    assert jobstore.get(done.uid).status == "complete"
+    assert jobstore.fail(running.uid, "gone")
+    assert not jobstore.fail(done.uid, "gone")
+    assert [job.status for job in jobstore.page()] == ["failed", "complete"]
+
+
+def test_update_never_revives(jobstore):
+    job = Job()
+    jobstore.put(job)
+    read = jobstore.get(job.uid)
+    assert jobstore.update(read.model_copy(update={"progress": 0.5}))
+    assert jobstore.get(job.uid).progress == 0.5
+
+    # cancelled, as by another worker, between reading and updating
+    read = jobstore.get(job.uid)
+    jobstore.put(read.model_copy(update={"status": "cancelled"}))
+    assert not jobstore.update(read.model_copy(update={"progress": 0.9}))
+    assert jobstore.get(job.uid).status == "cancelled"
+    assert jobstore.get(job.uid).progress == 0.5
+    assert not jobstore.update(Job())  # not in the store
@@ -0,0 +1,35 @@
+"""Tests for server metrics."""
+
+from . import metrics
+from .jobs import Job
+from .metrics import Counter, Histogram, Registry
+
+
+def test_render():
+    registry = Registry()
+    counter = registry.add(Counter("jobs_total", "Jobs."))
+    histogram = registry.add(Histogram("duration", "Durations.", (1, 10)))
+    counter.inc(status="complete")
+    counter.inc(2, status="complete")
+    for value in (0.5, 1, 5, 50):
+        histogram.observe(value, dataset='a"b')
+
+    lines = registry.render().splitlines()
+    assert "# TYPE jobs_total counter" in lines
+    assert 'jobs_total{status="complete"} 3' in lines
+    assert 'duration_bucket{dataset="a\\"b",le="1"} 2' in lines
+    assert 'duration_bucket{dataset="a\\"b",le="10"} 3' in lines
+    assert 'duration_bucket{dataset="a\\"b",le="+Inf"} 4' in lines
+    assert 'duration_sum{dataset="a\\"b"} 56.5' in lines
+    assert 'duration_count{dataset="a\\"b"} 4' in lines
+
+
+def test_record_job():
+    job = Job(status="complete",
+              bytes_written=100,
+              timings=dict(loading=0.1, writing=2.0))
+    before = metrics.bytes_written.values.get((), 0)
+    metrics.record_job(job, "aspcap", 3.0)
+    assert metrics.bytes_written.values[()] == before + 100
+    assert metrics.stage_duration.values[(("stage", "writing"), )].count >= 1
+    assert metrics.job_duration.values[(("dataset", "aspcap"), )].count >= 1
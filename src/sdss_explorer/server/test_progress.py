@@ -0,0 +1,66 @@
+"""Tests for job progress reporting."""
+
+from queue import Queue
+from time import time
+from typing import Any
+from uuid import uuid4
+
+import pytest
+
+from . import progress
+from .jobs import Job
+
+
+def test_overall_progress():
+    assert progress.overall_progress("loading", 0.0) == 0.0
+    assert progress.overall_progress("filtering", 1.0) == 0.5
+    assert progress.overall_progress("writing", 1.0) == 1.0
+
+
+def test_reporter_coalesces_updates(monkeypatch):
+    queue: Any = Queue()  # no feeder thread, so updates are readable immediately
+    monkeypatch.setattr(progress, "_queue", queue)
+    uid = uuid4()
+    reporter = progress.ProgressReporter(uid, interval=0)
+    reporter.set_stage("filtering", rows_total=100)
+    reporter(0.5)
+
+    updates = progress.drain(queue, timeout=1)
+    assert updates[uid]["rows_scanned"] == 50
+    assert updates[uid]["progress"] == progress.overall_progress("filtering", 0.5)
+
+    job = Job(started=time() - 10)
+    progress.apply_update(job, updates[uid])
+    assert job.stage == "filtering"
+    assert (job.eta is not None) and (job.eta > 0)
+
+    reporter.set_stage("writing")
+    assert set(reporter.timings) == {"filtering"}
+    assert set(progress.drain(queue, timeout=1)[uid]["timings"]) == {
+        "filtering", "writing"
+    }
+
+
+def test_reporter_counts():
+    # kept without a queue, so a job can return its final counts
+    reporter = progress.ProgressReporter(uuid4(), interval=60)
+    reporter.set_stage("filtering", rows_total=100)
+    reporter.report(1.0, rows_scanned=100, rows_matched=7)
+    reporter.set_stage("writing")
+    assert reporter.counts == dict(rows_total=100,
+                                   rows_scanned=100,
+                                   rows_matched=7)
+
+
+def test_reporter_aborts():
+    cancelled = False
+    reporter = progress.ProgressReporter(uuid4(),
+                                         interval=0,
+                                         cancelled=lambda: cancelled)
+    reporter.set_stage("filtering")
+    assert reporter(0.1) is True
+
+    cancelled = True
+    assert reporter(0.2) is False
+    with pytest.raises(progress.JobAborted, match="cancelled"):
+        reporter.set_stage("writing")
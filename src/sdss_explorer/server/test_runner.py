@@ -0,0 +1,155 @@
+"""Tests for running jobs with cancellation and limits."""
+
+import asyncio
+import time
+from uuid import uuid4
+
+import numpy as np
+import pytest
+import vaex.utils
+
+from . import runner as runner_module
+from . import scheduler as scheduler_module
+from .jobs import Job, MemoryJobStore
+from .progress import JobAborted
+from .runner import JobRunner, RunningJob
+
+
+def sleeper(uid, seconds):
+    """Stands in for an export that never checks its limits."""
+    time.sleep(seconds)
+    return uid
+
+
+def hasher(uid, nbytes):
+    """Hashes like vaex does when a column is added to a dataframe."""
+    hasher = vaex.utils.create_hasher(large_data=True)
+    hasher.update(np.ones(nbytes, dtype=np.uint8))
+    return hasher.hexdigest()
+
+
+@pytest.fixture
+def jobstore(monkeypatch):
+    jobstore = MemoryJobStore(ttl=60)
+    monkeypatch.setattr(runner_module, "store", jobstore)
+    monkeypatch.setattr(scheduler_module, "store", jobstore)
+    return jobstore
+
+
+def test_runner_kills_stuck_job(jobstore):
+
+    async def main():
+        runner = JobRunner(max_workers=1,
+                           timeout=60,
+                           memory=2**40,
+                           grace=0,
+                           budget=2**40)
+        runner.INTERVAL = 0.1
+        runner.start()
+        try:
+            stuck = Job()
+            jobstore.put(stuck)
+            queued_uid = uuid4()
+            queued = asyncio.create_task(runner.run(queued_uid, sleeper, 0))
+            task = asyncio.create_task(runner.run(stuck.uid, sleeper, 60))
+            await asyncio.sleep(0.5)
+            # the stuck job never reports progress, so give it a pid
+            runner.running[stuck.uid].pid = next(
+                iter(runner.executor._processes))
+            assert await queued == queued_uid
+
+            stuck.status = "cancelled"
+            jobstore.put(stuck)
+            with pytest.raises(JobAborted, match="cancelled"):
+                await asyncio.wait_for(task, 10)
+            # pool is replaced and still usable
+            after = uuid4()
+            assert await runner.run(after, sleeper, 0) == after
+        finally:
+            runner.shutdown()
+
+    asyncio.run(main())
+
+
+def test_runner_hashes_after_parent(jobstore):
+    # the parent hashing first starts blake3's thread pool, which would
+    # deadlock forked processes
+    expected = hasher(None, 2**24)
+
+    async def main():
+        runner = JobRunner(max_workers=1,
+                           timeout=60,
+                           memory=2**40,
+                           grace=0,
+                           budget=2**40)
+        assert runner.context.get_start_method() != "fork"
+        try:
+            runner.prestart()
+            for _ in range(2):  # first and replaced pool
+                result = runner.run(uuid4(), hasher, 2**24)
+                assert await asyncio.wait_for(result, 30) == expected
+                runner._replace_executor()
+        finally:
+            runner.shutdown()
+
+    asyncio.run(main())
+
+
+def test_runner_stops_admitted_job(jobstore, monkeypatch):
+
+    async def main():
+        runner = JobRunner(max_workers=1,
+                           timeout=60,
+                           memory=2**40,
+                           grace=0,
+                           budget=2**40)
+        acquire = runner.scheduler.acquire
+
+        async def stopped(uid, session, memory):
+            # cancelled as it is admitted, before its task resumes
+            await acquire(uid, session, memory)
+            assert runner.stop(uid, "job was cancelled")
+
+        monkeypatch.setattr(runner.scheduler, "acquire", stopped)
+        try:
+            with pytest.raises(JobAborted, match="cancelled"):
+                await runner.run(uuid4(), sleeper, 60)
+            assert not runner.pids()  # never submitted
+            assert not runner.scheduler.admitted and not runner.running
+
+            # a job without a process yet is left to abort by itself
+            executor = runner.executor
+            record = RunningJob(uuid4(), reason="job was cancelled")
+            runner.kill(record)
+            assert runner.executor is executor
+            assert record.kill_at is not None
+        finally:
+            runner.shutdown()
+
+    asyncio.run(main())
+
+
+def test_runner_releases_cancelled_admission(jobstore, monkeypatch):
+
+    async def main():
+        runner = JobRunner(max_workers=1,
+                           timeout=60,
+                           memory=2**40,
+                           grace=0,
+                           budget=2**40)
+        acquire = runner.scheduler.acquire
+
+        async def cancelled(uid, session, memory):
+            # cancelled as it is admitted, before its task resumes
+            await acquire(uid, session, memory)
+            raise asyncio.CancelledError
+
+        monkeypatch.setattr(runner.scheduler, "acquire", cancelled)
+        try:
+            with pytest.raises(asyncio.CancelledError):
+                await runner.run(uuid4(), sleeper, 60)
+            assert not runner.scheduler.admitted and not runner.running
+        finally:
+            runner.shutdown()
+
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""Tests for sampling of filtered subsets."""
+
+import numpy as np
+import pytest
+import vaex as vx
+
+from .sample import parse_quota, sample_dataframe, sampled_rows, validate_sample
+
+
+@pytest.fixture
+def dff():
+    n = 1000
+    df = vx.from_arrays(
+        x=np.arange(n),
+        telescope=np.array(["apo25m", "lco25m", "apo1m", "apo25m"] * (n // 4)),
+    )
+    return df[df.x % 2 == 0]  # sampled positions are within the filter
+
+
+def test_parse_quota():
+    assert parse_quota("100") == (100, {})
+    assert parse_quota("100, apo1m=10") == (100, {"apo1m": 10})
+    assert parse_quota("apo1m=0") == (None, {"apo1m": 0})
+    with pytest.raises(ValueError):
+        parse_quota("apo1m=many")
+
+
+def test_validate_sample():
+    validate_sample(sample_size=10, sample_seed=3)
+    validate_sample(stratify="telescope", quota="10")
+    with pytest.raises(ValueError):
+        validate_sample(sample_size=10, sample_fraction=0.5)
+    with pytest.raises(ValueError):
+        validate_sample(sample_fraction=2.0)
+    with pytest.raises(ValueError):
+        validate_sample(stratify="telescope")
+    with pytest.raises(ValueError):
+        validate_sample(quota="10")
+    with pytest.raises(ValueError):
+        validate_sample(stratify="carton", quota="10")
+
+
+def test_uniform_sample(dff):
+    assert sample_dataframe(dff, ["x"]) is dff
+    sample = sample_dataframe(dff, ["x"], sample_size=50, sample_seed=1)
+    x = sample.x.values
+    assert len(x) == 50
+    assert np.all(x % 2 == 0) and np.all(np.diff(x) > 0)
+    # same seed, same sample
+    again = sample_dataframe(dff, ["x"], sample_size=50, sample_seed=1)
+    assert np.array_equal(again.x.values, x)
+    assert len(sample_dataframe(dff, ["x"], sample_fraction=0.1)) == 50
+
+
+def test_stratified_sample(dff):
+    columns = ["x", "telescope"]
+    sample = sample_dataframe(dff, columns, stratify="telescope", quota="20")
+    counts = sample.telescope.value_counts()
+    # odd rows are filtered out, leaving no lco25m rows
+    assert counts.to_dict() == {"apo25m": 20, "apo1m": 20}
+
+    sample = sample_dataframe(dff,
+                              columns,
+                              stratify="telescope",
+                              quota="apo1m=5,apo25m=300")
+    counts = sample.telescope.value_counts()
+    assert counts.to_dict() == {"apo25m": 250, "apo1m": 5}
+
+    with pytest.raises(ValueError):
+        sample_dataframe(dff, columns, stratify="nope", quota="20")
+
+
+def test_sampled_rows():
+    assert sampled_rows(1000) == 1000
+    assert sampled_rows(1000, sample_size=10) == 10
+    assert sampled_rows(1000, stratify="telescope", quota="10") == 1000
+    assert sampled_rows(1000, stratify="telescope", quota="a=10,b=5") == 15
+    assert sampled_rows(1000, stratify="carton", quota="10",
+                        carton="a,b") == 20
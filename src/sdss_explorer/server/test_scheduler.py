@@ -0,0 +1,68 @@
+"""Tests for admission control of export jobs."""
+
+import asyncio
+
+import pytest
+
+from . import scheduler as scheduler_module
+from .jobs import Job, MemoryJobStore
+from .progress import JobAborted
+from .scheduler import Scheduler, estimate_selectivity, record_selectivity
+
+
+@pytest.fixture
+def jobstore(monkeypatch):
+    jobstore = MemoryJobStore(ttl=60)
+    monkeypatch.setattr(scheduler_module, "store", jobstore)
+    return jobstore
+
+
+def test_scheduler_budget_and_fairness(jobstore):
+
+    async def main():
+        scheduler = Scheduler(budget=100, slots=4)
+        jobs = {name: Job() for name in ("a1", "a2", "a3", "b1", "big")}
+        for job in jobs.values():
+            jobstore.put(job)
+
+        def submit(name, session, memory):
+            return asyncio.create_task(
+                scheduler.acquire(jobs[name].uid, session, memory))
+
+        tasks = {name: submit(name, "a", 40) for name in ("a1", "a2", "a3")}
+        tasks["b1"] = submit("b1", "b", 40)
+        await asyncio.sleep(0)
+        # a1 and a2 fit; b1 goes ahead of a3 since session a already has two
+        assert [t.uid for t in scheduler.order()
+                ] == [jobs["b1"].uid, jobs["a3"].uid]
+        assert jobstore.get(jobs["b1"].uid).queue_position == 1
+        assert jobstore.get(jobs["a3"].uid).queue_position == 2
+
+        scheduler.release(jobs["a1"].uid)
+        await asyncio.sleep(0)
+        assert tasks["b1"].done() and not tasks["a3"].done()
+        assert jobstore.get(jobs["b1"].uid).queue_position is None
+
+        assert scheduler.abort(jobs["a3"].uid, "job was cancelled")
+        with pytest.raises(JobAborted):
+            await tasks["a3"]
+
+        # too big for the budget, but runs once everything else is done
+        tasks["big"] = submit("big", "c", 1000)
+        scheduler.release(jobs["a2"].uid)
+        await asyncio.sleep(0)
+        assert not tasks["big"].done()
+        scheduler.release(jobs["b1"].uid)
+        await asyncio.sleep(0)
+        assert tasks["big"].done()
+
+    asyncio.run(main())
+
+
+def test_estimate_selectivity():
+    key = ("dr19", "star", "test")
+    assert estimate_selectivity(*key, 100) == 1.0
+    assert estimate_selectivity(*key, 100, crossmatch="1\n2\n\n") == 0.02
+    assert estimate_selectivity(*key, 100, expression="teff>1") == 0.5
+    record_selectivity(*key, rows_total=100, rows_matched=10)
+    assert estimate_selectivity(*key, 100, expression="teff>1") == 0.1
@@ -0,0 +1,57 @@
+"""Tests for scratch space eviction."""
+
+import fcntl
+import os
+from time import time
+
+from .jobs import Job, MemoryJobStore
+from .scratch import ScratchManager
+
+
+def write_job(root, store, status: str, nbytes: int, age: float) -> Job:
+    job = Job(status=status)
+    os.makedirs(root / str(job.uid))
+    path = root / str(job.uid) / "subset.parquet"
+    path.write_bytes(b"0" * nbytes)
+    os.utime(path, (time() - age, time() - age))
+    store.put(job)
+    return job
+
+
+def test_sweep_evicts_lru_over_quota(tmp_path):
+    store = MemoryJobStore(ttl=60)
+    oldest = write_job(tmp_path, store, "complete", 100, age=30)
+    running = write_job(tmp_path, store, "in_progress", 100, age=20)
+    newest = write_job(tmp_path, store, "complete", 100, age=10)
+
+    manager = ScratchManager(str(tmp_path), store, quota=200, maxage=3600)
+    assert manager.sweep() == 100
+
+    statuses = {job.uid: job.status for job in store.page()}
+    assert statuses[oldest.uid] == "expired"
+    assert not (tmp_path / str(oldest.uid)).exists()
+    assert (tmp_path / str(running.uid)).exists()
+    assert (tmp_path / str(newest.uid)).exists()
+
+
+def test_sweep_evicts_old(tmp_path):
+    store = MemoryJobStore(ttl=60)
+    old = write_job(tmp_path, store, "complete", 10, age=100)
+    write_job(tmp_path, store, "complete", 10, age=1)
+
+    manager = ScratchManager(str(tmp_path), store, quota=1000, maxage=50)
+    assert manager.sweep() == 10
+    statuses = {job.uid: job.status for job in store.page()}
+    assert statuses[old.uid] == "expired"
+
+
+def test_sweep_once_at_a_time(tmp_path):
+    store = MemoryJobStore(ttl=60)
+    write_job(tmp_path, store, "complete", 10, age=100)
+
+    manager = ScratchManager(str(tmp_path), store, quota=1000, maxage=50)
+    # as another worker, sweeping
+    with open(tmp_path / manager.LOCKFILE, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        assert manager.sweep() == 0
+    assert manager.sweep() == 10
@@ -1,7 +1,15 @@
 """WSGI instance"""
 
 from __future__ import print_function, division, absolute_import
+from .dataframe import warm_up
 from .main import app
+from ..util.config import settings
+
+# with `--preload`, this runs once in the gunicorn master, so every worker and
+# its export processes share the preloaded dataframes copy-on-write. Without,
+# it runs in each worker and `lifespan` finds the cache already warm.
+if settings.preload:
+    warm_up()
 
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,309 @@
+"""Inverted index from targeting bits to the rows with each bit set.
+
+Each release/datatype file gets a sidecar of bitmaps, one per bit of
+`sdss5_target_flags`, built offline with
+
+    python -m sdss_explorer.util.sidecars [files]
+
+Bitmaps are compressed roaring-style. Rows are cut into containers of
+`CONTAINER_SIZE`, and each container of a bit is stored either as the sorted
+row offsets within it, if few, or as a packed bitmap of the whole container.
+Any selection of cartons and mappers is then the union of its bits' containers,
+which touches only the rows that are set, instead of scanning every byte of
+the flags of every row.
+
+Dataframes derived from a file (shuffled, filtered or extracted) keep a hidden
+`ROW_COLUMN` of rows in the file, to look the union up by.
+"""
+
+import logging
+import os
+import uuid
+import weakref
+from functools import lru_cache
+
+import numpy as np
+import vaex as vx
+
+__all__ = [
+    "ROW_COLUMN",
+    "CartonBitmaps",
+    "sidecar_path",
+    "source_stat",
+    "file_identity",
+    "open_bitmaps",
+    "add_row_column",
+    "materialize_row_column",
+    "attach_bitmaps",
+    "attached_bitmaps",
+]
+
+logger = logging.getLogger("dashboard")
+
+# hidden column of each row's position in its file
+ROW_COLUMN = "__row"
+
+# column of targeting flags, as bytes of bits
+TARGET_FLAGS = "sdss5_target_flags"
+
+# rows per container, as in roaring bitmaps
+CONTAINER_SIZE = 1 << 16
+
+# containers with at least this many rows are stored as packed bitmaps
+DENSE_SIZE = 4096
+
+# rows of flags read at once when building
+BUILD_CHUNK_SIZE = 16 * CONTAINER_SIZE
+
+# bitmaps by the row column of dataframes derived from their file
+_attached: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+class CartonBitmaps:
+    """Compressed bitmaps of the rows with each targeting bit set.
+
+    Containers are ordered by bit, then by row. Container `i` holds
+    `values[starts[i]:starts[i + 1]]`: row offsets within the container if
+    sparse, or `CONTAINER_SIZE` bits packed little-endian into `uint16` words
+    if dense.
+
+    Attributes:
+        nrows: number of rows in the file
+        offsets: range of containers of each bit, of length `nbits + 1`
+        chunks: which `CONTAINER_SIZE` rows each container covers
+        dense: whether each container is a packed bitmap
+        starts: range of values of each container, of length `ncontainers + 1`
+        values: row offsets and packed bitmaps of all containers
+        source_size: size in bytes of the file the bitmaps were built from
+        source_mtime: modification time in ns of the file the bitmaps were built from
+        identity: the files the bitmaps were opened from, see `file_identity`,
+            or unique to these bitmaps if they weren't
+    """
+
+    def __init__(self,
+                 nrows: int,
+                 offsets: np.ndarray,
+                 chunks: np.ndarray,
+                 dense: np.ndarray,
+                 starts: np.ndarray,
+                 values: np.ndarray,
+                 source_size: int = 0,
+                 source_mtime: int = 0):
+        self.nrows = nrows
+        self.offsets = offsets
+        self.chunks = chunks
+        self.dense = dense
+        self.starts = starts
+        self.values = values
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        self.identity = uuid.uuid4().hex
+
+    @property
+    def nbits(self) -> int:
+        return len(self.offsets) - 1
+
+    @classmethod
+    def build(cls,
+              df: vx.DataFrame,
+              column: str = TARGET_FLAGS,
+              source_size: int = 0,
+              source_mtime: int = 0) -> "CartonBitmaps":
+        """Builds bitmaps of a flags column, reading `BUILD_CHUNK_SIZE` rows at once.
+
+        Args:
+            df: dataframe of a whole file, unfiltered
+            column: 2-D column of flag bytes, bit `i` being `1 << (i % 8)` of byte `i // 8`
+            source_size: size of the file, to tell when the bitmaps are stale
+            source_mtime: modification time of the file, likewise
+        """
+        nbits = df[column].shape[1] * 8
+        containers: list[list[tuple[int, bool, np.ndarray]]] = [
+            [] for _ in range(nbits)
+        ]
+        for start in range(0, len(df), BUILD_CHUNK_SIZE):
+            end = min(start + BUILD_CHUNK_SIZE, len(df))
+            flags = np.asarray(df.evaluate(column, start, end), dtype=np.uint8)
+            for offset in range(0, end - start, CONTAINER_SIZE):
+                chunk = (start + offset) // CONTAINER_SIZE
+                bits = np.unpackbits(flags[offset:offset + CONTAINER_SIZE],
+                                     axis=1,
+                                     bitorder="little")
+                # sorted by bit, then row
+                bit, row = np.nonzero(bits.T)
+                bounds = np.searchsorted(bit, np.arange(nbits + 1))
+                for b in np.flatnonzero(np.diff(bounds)):
+                    rows = row[bounds[b]:bounds[b + 1]]
+                    if len(rows) >= DENSE_SIZE:
+                        packed = np.zeros(CONTAINER_SIZE, dtype=bool)
+                        packed[rows] = True
+                        words = np.packbits(packed,
+                                            bitorder="little").view("<u2")
+                        containers[b].append((chunk, True, words))
+                    else:
+                        containers[b].append(
+                            (chunk, False, rows.astype("<u2")))
+
+        flat = [container for bit in containers for container in bit]
+        sizes = [len(values) for _, _, values in flat]
+        return cls(
+            nrows=len(df),
+            offsets=np.cumsum([0] + [len(bit) for bit in containers]),
+            chunks=np.array([chunk for chunk, _, _ in flat], dtype=np.int64),
+            dense=np.array([dense for _, dense, _ in flat], dtype=bool),
+            starts=np.cumsum([0] + sizes),
+            values=(np.concatenate([values for _, _, values in flat])
+                    if flat else np.zeros(0, dtype="<u2")),
+            source_size=source_size,
+            source_mtime=source_mtime,
+        )
+
+    def save(self, path: str) -> None:
+        """Saves the bitmaps, replacing any existing file at once."""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f,
+                     nrows=self.nrows,
+                     offsets=self.offsets,
+                     chunks=self.chunks,
+                     dense=self.dense,
+                     starts=self.starts,
+                     values=self.values,
+                     source_size=self.source_size,
+                     source_mtime=self.source_mtime)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "CartonBitmaps":
+        with np.load(path) as data:
+            return cls(
+                nrows=int(data["nrows"]),
+                offsets=data["offsets"],
+                chunks=data["chunks"],
+                dense=data["dense"],
+                starts=data["starts"],
+                values=data["values"],
+                source_size=int(data["source_size"]),
+                # built before modification times were kept, so stale
+                source_mtime=int(data.get("source_mtime", 0)),
+            )
+
+    def mask(self, bits: np.ndarray | list[int]) -> np.ndarray:
+        """Rows with any of the given bits set.
+
+        Args:
+            bits: targeting bits. Bits beyond `nbits` are ignored.
+
+        Returns:
+            Boolean mask over the rows of the file.
+        """
+        bits = np.unique(np.asarray(bits, dtype=np.int64))
+        bits = bits[(bits >= 0) & (bits < self.nbits)]
+        nchunks = -(-self.nrows // CONTAINER_SIZE)
+        mask = np.zeros(nchunks * CONTAINER_SIZE, dtype=bool)
+        if len(bits) == 0:
+            return mask[:self.nrows]
+        containers = np.concatenate([
+            np.arange(self.offsets[b], self.offsets[b + 1]) for b in bits
+        ]).astype(np.int64)
+
+        sparse = containers[~self.dense[containers]]
+        counts = self.starts[sparse + 1] - self.starts[sparse]
+        base = np.repeat(self.starts[sparse] - (np.cumsum(counts) - counts),
+                         counts)
+        rows = np.repeat(self.chunks[sparse] * CONTAINER_SIZE, counts)
+        mask[rows + self.values[base + np.arange(counts.sum())]] = True
+
+        for i in containers[self.dense[containers]]:
+            words = self.values[self.starts[i]:self.starts[i + 1]]
+            start = self.chunks[i] * CONTAINER_SIZE
+            mask[start:start + CONTAINER_SIZE] |= np.unpackbits(
+                words.view(np.uint8), bitorder="little").view(bool)
+        return mask[:self.nrows]
+
+
+def sidecar_path(path: str) -> str:
+    """Path of the bitmaps of a data file."""
+    return f"{os.path.splitext(path)[0]}.cartons.npz"
+
+
+def source_stat(path: str) -> tuple[int, int]:
+    """Size in bytes and modification time in ns of a file, to tell when sidecars are stale."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def file_identity(*paths: str) -> str:
+    """Identifies the contents of files by their paths, sizes and modification times.
+
+    Equal in every process, unlike the objects loaded from the files.
+    """
+    return "|".join(":".join([os.path.abspath(path), *map(str, source_stat(path))])
+                    for path in paths)
+
+
+@lru_cache(maxsize=None)
+def open_bitmaps(path: str) -> CartonBitmaps | None:
+    """Loads the bitmaps of a data file, once per process.
+
+    Args:
+        path: path of the data file
+
+    Returns:
+        The bitmaps, or `None` if they were not built or are stale.
+    """
+    sidecar = sidecar_path(path)
+    if not os.path.isfile(sidecar):
+        logger.debug(f"no carton bitmaps for {path}")
+        return None
+    try:
+        bitmaps = CartonBitmaps.load(sidecar)
+    except Exception as e:
+        logger.warning(f"failed to load carton bitmaps {sidecar}: {e}")
+        return None
+    if (bitmaps.source_size, bitmaps.source_mtime) != source_stat(path):
+        logger.warning(f"carton bitmaps {sidecar} are stale, ignoring them")
+        return None
+    bitmaps.identity = file_identity(path, sidecar)
+    return bitmaps
+
+
+def add_row_column(df: vx.DataFrame) -> None:
+    """Adds the hidden row column to a dataframe of a whole file, in place.
+
+    The column is lazy, so takes no memory, and follows rows through shuffles,
+    filters and extracts.
+    """
+    df.add_column(ROW_COLUMN, vx.vrange(0, len(df), dtype="int64"))
+
+
+def materialize_row_column(df: vx.DataFrame) -> None:
+    """Holds the row column of a shuffled or extracted dataframe in memory, in place.
+
+    Lookups then slice it rather than take rows through the shuffle or extract,
+    at a cost of 4 bytes a row. The server does this for its extracted
+    pipeline dataframes; the dashboard keeps the column of its whole file lazy.
+    Call before attaching sidecars.
+    """
+    rows = df.evaluate(ROW_COLUMN)
+    dtype = np.int32 if len(rows) and rows.max() < 2**31 else np.int64
+    df.drop(ROW_COLUMN, inplace=True)
+    df.add_column(ROW_COLUMN, rows.astype(dtype))
+
+
+def attach_bitmaps(df: vx.DataFrame, bitmaps: CartonBitmaps) -> None:
+    """Attaches bitmaps to a dataframe derived from their file, and its copies.
+
+    Args:
+        df: dataframe with the row column from `add_row_column`
+        bitmaps: bitmaps of the file
+    """
+    _attached[df.columns[ROW_COLUMN]] = bitmaps
+
+
+def attached_bitmaps(df: vx.DataFrame) -> CartonBitmaps | None:
+    """Bitmaps attached to a dataframe, or `None`."""
+    column = df.columns.get(ROW_COLUMN)
+    if column is None:
+        return None
+    return _attached.get(column)
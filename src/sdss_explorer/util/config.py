@@ -12,6 +12,42 @@ class Settings(BaseSettings):
 
     nprocesses: int = Field(default=2, description="How many export processes to run concurrently. The max possible will on memory spec of the machine.")
 
+    dfcache_size: int = Field(
+        default=4_000_000_000,
+        description="Memory budget in bytes for each export process's cache of loaded pipeline dataframes. Least recently used dataframes are evicted beyond this."
+    )
+
+    job_timeout: int = Field(default=600,
+                             description="Maximum run time in seconds of an export job before it is stopped.")
+
+    job_memory: int = Field(default=16_000_000_000,
+                            description="Maximum resident memory in bytes of an export process before its job is stopped.")
+
+    job_memory_budget: int = Field(
+        default=32_000_000_000,
+        description="Total estimated peak memory in bytes of export jobs admitted at once by each server worker. Further jobs are queued."
+    )
+
+    job_grace: int = Field(
+        default=10,
+        description="Time in seconds a cancelled or over-limit export job has to stop by itself before its process is killed and replaced."
+    )
+
+    job_heartbeat: int = Field(
+        default=30,
+        description="Time in seconds between heartbeats of running export jobs. Jobs missing several are taken as orphaned by a crashed server worker."
+    )
+
+    aggregate_cache_size: int = Field(
+        default=1_000_000_000,
+        description="Maximum size in bytes of the cache of histogram and heatmap aggregates in the scratch space."
+    )
+
+    preload: bool = Field(
+        default=True,
+        description="Whether to load all pipeline dataframes on startup, in the server and in each export process, instead of on their first request or job."
+    )
+
     home: str = Field(default=os.path.expanduser("~"),
                       validation_alias="VAEX_HOME",
                       description="The home directory for caching and fingerprinting by vaex. Defaults to `$HOME`.")
@@ -28,6 +64,23 @@ class Settings(BaseSettings):
     scratch: str = Field(default="./scratch",
                          description="The datapath to a scratch space for custom summary file outputs.")
 
+    jobstore: str = Field(
+        default="",
+        description="Path to the SQLite job store shared by all server workers. Defaults to `jobs.sqlite` in the scratch space. Set to `memory` for an in-process store (single worker only)."
+    )
+
+    jobttl: int = Field(default=7 * 24 * 3600,
+                        description="Time in seconds to keep a job in the job store after its last update. Defaults to one week.")
+
+    scratch_quota: int = Field(default=100_000_000_000,
+                               description="Maximum total size in bytes of exports in the scratch space. Least recently used exports are removed beyond this.")
+
+    scratch_maxage: int = Field(default=7 * 24 * 3600,
+                                description="Time in seconds since last access after which exports are removed from the scratch space. Defaults to one week.")
+
+    scratch_interval: int = Field(default=600,
+                                  description="Time in seconds between sweeps of the scratch space.")
+
     dev: bool = Field(
         default=False,
         description="Whether to consider the environment a development one or not. Also checks against whether server instance is production for dashboard."
@@ -45,6 +98,11 @@ class Settings(BaseSettings):
     api_url: str = Field(default="http://localhost:8050",
                          description="API url for download server. Defaults to localhost on port 8050.")
 
+    aggregate_remote: bool = Field(
+        default=False,
+        description="Whether the dashboard delegates histogram and heatmap aggregation to the download server at `api_url`, so sessions share cached results."
+    )
+
     download_url: str = Field(
         default="https://bing.com/search?query=",
         description="Public download URL for serving files. Defaults to bing (for fun)."
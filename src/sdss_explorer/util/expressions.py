@@ -0,0 +1,396 @@
+"""Parser of filter expressions, shared by the dashboard and the server.
+
+The grammar is comparisons of columns with numbers or strings, including
+chained comparisons (`a < col <= b`), combined with `&` and `|` and grouped with
+parentheses. `&` binds tighter than `|`, and comparisons tighter than both:
+
+    expression := conjunction ('|' conjunction)*
+    conjunction := term ('&' term)*
+    term := '(' expression ')' | comparison
+    comparison := operand (comparator operand){1,2}
+    operand := column | number | string
+
+Expressions are parsed into a tree and printed in a canonical form, with columns
+on the left of comparisons, numbers normalized, and the operands of `&` and `|`
+flattened, deduplicated and sorted. Equivalent expressions then share one
+canonical form, which is what vaex is given. Parses and validations are cached,
+so checking an expression again costs microseconds.
+"""
+
+import re
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Sequence, Union
+
+__all__ = [
+    "ExpressionError",
+    "Comparison",
+    "Combination",
+    "ParsedExpression",
+    "parse_expression",
+    "compile_expression",
+]
+
+# maximum number of cached parses and validations
+EXPRESSION_CACHE_SIZE = 1024
+
+# (columns, canonical expression) of validated expressions, least recently used first
+_validated: OrderedDict[tuple[tuple[str, ...], str], None] = OrderedDict()
+
+# comparator with its sides swapped
+FLIPPED = {"<": ">", "<=": ">=", ">": "<", ">=": "<=", "==": "==", "!=": "!="}
+
+TOKEN_REGEX = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<number>-?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<string>'[^']*'|"[^"]*")
+  | (?P<comparator><=|>=|==|!=|<|>)
+  | (?P<symbol>[&|()])
+""", re.VERBOSE)
+
+INTEGER_REGEX = re.compile(r"-?\d+")
+
+
+class ExpressionError(ValueError):
+    """An invalid expression.
+
+    Attributes:
+        message: what is wrong
+        position: index of the offending character in the expression
+    """
+
+    def __init__(self, message: str, position: int):
+        super().__init__(message, position)
+        self.message = message
+        self.position = position
+
+    def __str__(self) -> str:
+        return f"{self.message} (at character {self.position + 1})"
+
+
+@dataclass(frozen=True)
+class Token:
+    kind: str
+    text: str
+    position: int
+
+
+@dataclass(frozen=True)
+class Operand:
+    """A column, number or string in a comparison, with numbers as written."""
+
+    kind: str
+    value: str
+    position: int = field(compare=False)
+
+    @property
+    def number(self) -> int | float:
+        """Value of a number, exact for integers beyond float precision, like ids."""
+        if INTEGER_REGEX.fullmatch(self.value):
+            return int(self.value)
+        return float(self.value)
+
+    def canonical(self) -> str:
+        if self.kind == "number":
+            value = self.number
+            if isinstance(value, float) and value.is_integer() and abs(
+                    value) < 1e16:
+                value = int(value)
+            return repr(value)
+        if self.kind == "string":
+            return repr(self.value)
+        return self.value
+
+
+@dataclass(frozen=True)
+class Comparison:
+    """A comparison of a column, with the column on the left where possible."""
+
+    left: Operand
+    comparator: str
+    right: Operand
+
+    def canonical(self) -> str:
+        return f"({self.left.canonical()}{self.comparator}{self.right.canonical()})"
+
+    def operands(self) -> tuple[Operand, ...]:
+        return (self.left, self.right)
+
+
+@dataclass(frozen=True)
+class Combination:
+    """Terms combined by `&` or `|`."""
+
+    operator: str
+    terms: tuple["Node", ...]
+
+    def canonical(self) -> str:
+        parts = []
+        for term in self.terms:
+            part = term.canonical()
+            if isinstance(term, Combination):
+                part = f"({part})"  # `|` in `&`, or `&` in `|`
+            parts.append(part)
+        return self.operator.join(parts)
+
+    def operands(self) -> tuple[Operand, ...]:
+        return tuple(operand for term in self.terms
+                     for operand in term.operands())
+
+
+Node = Union[Comparison, Combination]
+
+
+@dataclass(frozen=True)
+class ParsedExpression:
+    """A parsed expression.
+
+    Attributes:
+        tree: root of the parse tree
+        canonical: canonical form of the expression, as given to vaex
+        columns: names of columns in the expression
+    """
+
+    tree: Node
+    canonical: str
+    columns: frozenset[str]
+
+
+def tokenize(expression: str) -> list[Token]:
+    """Splits an expression into tokens, leaving out whitespace.
+
+    Raises:
+        ExpressionError: at the first character which starts no token
+    """
+    tokens = []
+    position = 0
+    while position < len(expression):
+        match = TOKEN_REGEX.match(expression, position)
+        if (match is None) or (match.lastgroup is None):
+            raise ExpressionError(
+                f"unexpected character '{expression[position]}'", position)
+        if match.lastgroup != "space":
+            tokens.append(Token(match.lastgroup, match.group(), position))
+        position = match.end()
+    return tokens
+
+
+def _combine(operator: str, terms: list[Node]) -> Node:
+    """Flattens, deduplicates and sorts terms, so equivalent combinations are equal."""
+    flat: list[Node] = []
+    for term in terms:
+        if isinstance(term, Combination) and term.operator == operator:
+            flat.extend(term.terms)
+        else:
+            flat.append(term)
+    unique = {term.canonical(): term for term in flat}
+    if len(unique) == 1:
+        return next(iter(unique.values()))
+    return Combination(operator,
+                       tuple(unique[key] for key in sorted(unique)))
+
+
+def _compare(left: Operand, comparator: str, right: Operand) -> Comparison:
+    """Puts a column on the left, or the first column by name if both are."""
+    swap = (left.kind != "name") and (right.kind == "name")
+    if (left.kind == "name") and (right.kind == "name"):
+        swap = right.value < left.value
+    if swap:
+        return Comparison(right, FLIPPED[comparator], left)
+    return Comparison(left, comparator, right)
+
+
+class _Parser:
+    """Recursive descent parser of the expression grammar."""
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.tokens = tokenize(expression)
+        self.index = 0
+
+    def peek(self) -> Token | None:
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+        return None
+
+    def error(self, message: str) -> ExpressionError:
+        token = self.peek()
+        position = token.position if token else len(self.expression)
+        found = f"'{token.text}'" if token else "end of expression"
+        return ExpressionError(f"{message}, found {found}", position)
+
+    def accept(self, text: str) -> bool:
+        token = self.peek()
+        if (token is not None) and (token.text == text):
+            self.index += 1
+            return True
+        return False
+
+    def parse(self) -> Node:
+        tree = self.expression_()
+        if self.peek() is not None:
+            raise self.error("expected '&', '|' or end of expression")
+        return tree
+
+    def expression_(self) -> Node:
+        terms = [self.conjunction()]
+        while self.accept("|"):
+            terms.append(self.conjunction())
+        return _combine("|", terms)
+
+    def conjunction(self) -> Node:
+        terms = [self.term()]
+        while self.accept("&"):
+            terms.append(self.term())
+        return _combine("&", terms)
+
+    def term(self) -> Node:
+        if self.accept("("):
+            tree = self.expression_()
+            if not self.accept(")"):
+                raise self.error("expected ')'")
+            return tree
+        return self.comparison()
+
+    def operand(self) -> Operand:
+        token = self.peek()
+        if (token is None) or (token.kind not in ("name", "number", "string")):
+            raise self.error("expected a column, number or string")
+        self.index += 1
+        if token.kind == "number":
+            return Operand("number", token.text, token.position)
+        if token.kind == "string":
+            return Operand("string", token.text[1:-1], token.position)
+        return Operand("name", token.text, token.position)
+
+    def comparator(self) -> Token | None:
+        token = self.peek()
+        if (token is not None) and (token.kind == "comparator"):
+            self.index += 1
+            return token
+        return None
+
+    def comparison(self) -> Node:
+        first = self.operand()
+        op = self.comparator()
+        if op is None:
+            raise self.error("expected a comparator")
+        second = self.operand()
+        chained = self.comparator()
+        if chained is None:
+            if (first.kind != "name") and (second.kind != "name"):
+                raise ExpressionError("one side must be a column",
+                                      first.position)
+            return _compare(first, op.text, second)
+
+        # a < col <= b, or a > col >= b
+        third = self.operand()
+        ascending = {op.text, chained.text} <= {"<", "<="}
+        descending = {op.text, chained.text} <= {">", ">="}
+        if not (ascending or descending):
+            raise ExpressionError(
+                "chained comparisons must both be < or <=, or both > or >=",
+                chained.position)
+        if second.kind != "name":
+            raise ExpressionError("the middle of a chained comparison must be a column",
+                                  second.position)
+        for end in (first, third):
+            if end.kind != "number":
+                raise ExpressionError(
+                    "the ends of a chained comparison must be numbers",
+                    end.position)
+        lower, upper = (first, third) if ascending else (third, first)
+        if lower.number >= upper.number:
+            raise ExpressionError(
+                f"empty range, {lower.canonical()} is not below {upper.canonical()}",
+                first.position)
+        return _combine("&", [
+            _compare(first, op.text, second),
+            _compare(second, chained.text, third)
+        ])
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def parse_expression(expression: str) -> ParsedExpression:
+    """Parses an expression into its tree and canonical form.
+
+    Args:
+        expression: filter expression
+
+    Returns:
+        The parsed expression.
+
+    Raises:
+        ExpressionError: if the expression doesn't follow the grammar
+    """
+    tree = _Parser(expression).parse()
+    columns = frozenset(operand.value for operand in tree.operands()
+                        if operand.kind == "name")
+    return ParsedExpression(tree, f"({tree.canonical()})", columns)
+
+
+def validate_expression(parsed: ParsedExpression, columns: Sequence[str],
+                        is_string: Callable[[str], bool]) -> None:
+    """Checks the columns of an expression exist, and are compared to the right types.
+
+    Raises:
+        ExpressionError: at the first invalid column or value
+    """
+    valid = set(columns)
+    for operand in parsed.tree.operands():
+        if (operand.kind == "name") and (operand.value not in valid):
+            raise ExpressionError(f"unknown column '{operand.value}'",
+                                  operand.position)
+
+    def check(term: Node) -> None:
+        if isinstance(term, Combination):
+            for subterm in term.terms:
+                check(subterm)
+            return
+        value = term.right
+        if value.kind == "name":
+            return  # two columns
+        string = is_string(term.left.value)
+        if string and (value.kind != "string"):
+            raise ExpressionError(
+                f"column '{term.left.value}' must be compared with a string",
+                value.position)
+        if not string and (value.kind != "number"):
+            raise ExpressionError(
+                f"column '{term.left.value}' must be compared with a number",
+                value.position)
+
+    check(parsed.tree)
+
+
+def compile_expression(expression: str, columns: Sequence[str],
+                       is_string: Callable[[str], bool]) -> str:
+    """Parses and validates an expression, giving its canonical form.
+
+    Validations are cached by the columns and canonical form, so equivalent
+    expressions are validated once. Columns of a dataset are assumed to keep
+    their types.
+
+    Args:
+        expression: filter expression
+        columns: valid columns
+        is_string: whether a column holds strings, only called on a cache miss
+
+    Returns:
+        The canonical form of the expression.
+
+    Raises:
+        ExpressionError: if the expression is invalid, with where
+    """
+    parsed = parse_expression(expression)
+    key = (tuple(columns), parsed.canonical)
+    if key in _validated:
+        _validated.move_to_end(key)
+        return parsed.canonical
+    validate_expression(parsed, columns, is_string)
+    _validated[key] = None
+    while len(_validated) > EXPRESSION_CACHE_SIZE:
+        _validated.popitem(last=False)
+    return parsed.canonical
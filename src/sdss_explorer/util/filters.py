@@ -1,25 +1,98 @@
 """All filter conversion functions. Validation done in UI, but conversion to Expressions is done via these functions"""
 
+import json
+import math
 import operator
 import logging
-import re
+import threading
+import weakref
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any
+
 import numpy as np
 import vaex as vx
 
+from .bitmaps import ROW_COLUMN, attached_bitmaps
+from .expressions import ExpressionError, compile_expression, parse_expression
+from .quickflags import attached_quickflags, registry
+from .spatial import POSITION_CMTYPE, ZoneIndex, parse_positions
+from .zonemaps import attached_zonemaps
+
 # TODO: get dashboard or main depending on context of functions
 logger = logging.getLogger("dashboard")
 
 __all__ = [
-    "check_flags", "filter_expression", "filter_carton_mapper", "filter_flags"
+    "check_flags", "check_flags_packed", "in_bitmap", "in_cones", "filter_expression",
+    "filter_carton_mapper", "filter_flags", "filter_positions", "filter_range",
+    "filter_rows", "filter_zones"
 ]
 
 
+@lru_cache(maxsize=256)
+def _packed_filters(filters: bytes,
+                    width: int) -> tuple[int, tuple[tuple[int, int, int], ...]]:
+    """Filters as `uint64` masks over groups of rows spanning whole words.
+
+    Args:
+        filters: filter byte of each flag byte
+        width: number of flag bytes per row
+
+    Returns:
+        The number of rows per group, and `(row, word, mask)` of each word a
+        row's filtered bytes fall in, by row within the group.
+    """
+    group = 8 // math.gcd(width, 8)
+    masks: dict[tuple[int, int], int] = {}
+    for row in range(group):
+        for byte in np.flatnonzero(np.frombuffer(filters, dtype=np.uint8)):
+            position = row * width + int(byte)
+            key = (row, position // 8)
+            masks[key] = masks.get(key, 0) | (filters[byte] <<
+                                              (8 * (position % 8)))
+    return group, tuple((row, word, mask)
+                        for (row, word), mask in sorted(masks.items()))
+
+
+def check_flags_packed(flags: np.ndarray, filters: np.ndarray) -> np.ndarray:
+    """Checks flags against filters a `uint64` word at a time.
+
+    Consecutive rows are viewed as packed words, a group of `8 / gcd(width, 8)`
+    rows spanning whole words, i.e. 8 rows of 57 bytes in 57 words. Only the
+    words holding filtered bytes are tested, with no temporaries the size of
+    the flags.
+
+    Args:
+        flags: C-contiguous `uint8` array of flag bytes, one row per row
+        filters: filter byte of each flag byte
+
+    Returns:
+        Whether each row has any filtered bit set.
+    """
+    n, width = flags.shape
+    group, masks = _packed_filters(
+        np.asarray(filters, dtype=np.uint8).tobytes(), width)
+    packed = n // group * group
+    words = flags[:packed].reshape(-1).view("<u8").reshape(
+        n // group, group * width // 8)
+    out = np.zeros(n, dtype=bool)
+    hits = out[:packed].reshape(-1, group)
+    word = np.empty(len(words), dtype="<u8")
+    for row, index, mask in masks:
+        np.bitwise_and(words[:, index], np.uint64(mask), out=word)
+        np.logical_or(hits[:, row], word, out=hits[:, row])
+    if packed < n:
+        out[packed:] = np.bitwise_and(flags[packed:], filters).any(axis=1)
+    return out
+
+
 @vx.register_function(multiprocessing=True)
 def check_flags(flags: vx.Expression, filters: vx.Expression) -> vx.Expression:
     """Converts flags & values to boolean vaex expression for use as a filter.
 
     Note:
         Registered as a `vaex.expression.Expression` method via the `register_function` decorator.
+        Uses `check_flags_packed` when the flags are a contiguous array of bytes.
 
     Args:
         flags: bit flags expressions
@@ -27,20 +100,90 @@ def check_flags(flags: vx.Expression, filters: vx.Expression) -> vx.Expression:
     Returns:
         Boolean expression of filters
     """
-    return np.logical_and(flags, filters).any(axis=1)
+    if (isinstance(flags, np.ndarray) and (flags.ndim == 2)
+            and (flags.dtype == np.uint8) and flags.flags.c_contiguous
+            and (flags.shape[1] == len(filters))):
+        return check_flags_packed(flags, filters)
+    return np.bitwise_and(flags, filters).any(axis=1)
+
+
+@vx.register_function(multiprocessing=True)
+def in_cones(ra: vx.Expression, dec: vx.Expression, key: np.ndarray,
+             zdec: np.ndarray, radius: np.ndarray) -> vx.Expression:
+    """Converts positions to a boolean expression of whether they fall in any cone.
+
+    Note:
+        Registered as a `vaex.expression.Expression` method via the `register_function` decorator.
+
+    Args:
+        ra: right ascension expression, in degrees
+        dec: declination expression, in degrees
+        key: cone centers, as the sorted keys of a `ZoneIndex`
+        zdec: declination of each cone center
+        radius: radius of each cone, in degrees
+    Returns:
+        Boolean expression of matches
+    """
+    index = ZoneIndex(key, zdec, radius=radius)
+    ra, dec = np.asarray(ra), np.asarray(dec)
+    mask = np.zeros(len(ra), dtype=bool)
+    mask[index.search(ra, dec, radius.max())[1]] = True
+    return mask
+
+
+# number of built masks of `filter_rows` filters kept; more are rebuilt on use.
+# Masks are kept packed, at 1 bit a row of the file, so at most 2 bytes a row.
+MASK_CACHE_SIZE = 16
+
+# sources of `filter_rows` masks by identity, while they are loaded
+_sources: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+# built masks by key, packed little-endian, least recently used first
+_masks: OrderedDict[str, np.ndarray] = OrderedDict()
+_masks_lock = threading.Lock()
+
+
+def _mask(key: str) -> np.ndarray:
+    """Packed mask of a `filter_rows` filter, built on first use."""
+    with _masks_lock:
+        mask = _masks.get(key)
+        if mask is None:
+            identity, method, args = json.loads(key)
+            mask = np.packbits(getattr(_sources[identity], method)(*args),
+                               bitorder="little")
+            _masks[key] = mask
+            while len(_masks) > MASK_CACHE_SIZE:
+                _masks.popitem(last=False)
+        else:
+            _masks.move_to_end(key)
+        return mask
+
+
+@vx.register_function(multiprocessing=True)
+def in_bitmap(rows: vx.Expression, key: str) -> vx.Expression:
+    """Converts rows to a boolean expression of whether they are set in a mask.
+
+    Note:
+        Registered as a `vaex.expression.Expression` method via the `register_function` decorator.
+
+    Args:
+        rows: expression of row positions in the file, i.e. `ROW_COLUMN`
+        key: what the mask is built from, from `filter_rows`
+    Returns:
+        Boolean expression of set rows
+    """
+    index = np.asarray(rows)
+    bits = _mask(key)[index >> 3] >> (index & 7).astype(np.uint8)
+    return (bits & 1).astype(bool)
+
 
+# zone maps are used when they leave at most this fraction of rows to read
+ZONE_SCAN_FRACTION = 0.5
 
 operator_map = {"AND": operator.and_, "OR": operator.or_, "XOR": operator.xor}
 
-flagList = {
-    # TODO: more quick flags based on scientist input
-    "sdss5 only": "release=='sdss5'",
-    "snr > 50": "snr>=50",
-    "purely non-flagged": "result_flags==0",
-    #'no apo 1m': "telescope!='apo1m'", # WARNING: this one doesn't work for some reason, maybe it's not string; haven't checked
-    "no bad flags": "flag_bad==0",
-    "gmag < 17": "g_mag<=17",
-}
+# quick flags by name, see `util.quickflags`
+flagList = registry
 
 # map crossmatch names to columns
 crossmatchList = {
@@ -58,88 +201,29 @@ def filter_expression(
     expression: str,
     invert: bool = False,
 ):
-    """Converts expression to valid filter"""
-    # first, remove all spaces
-    expr = expression.replace(" ", "")
-    logger.debug(f"expr: {expr}")
-    num_regex = r"^-?[0-9]+(?:\.[0-9]+)?(?:e-?\d+)?$"
-
-    # get expression in parts, saving split via () regex
-    subexpressions = re.split(r"(&|\||\)|\()", expr)
-    n = 1
-    for i, expr in enumerate(subexpressions):
-        # saved regex info -> skip w/o enumerating
-        if expr in ["", "&", "(", ")", "|"]:
-            continue
-
-        # guardrail ace here -- very important
-        illegals = ["eval", "exec", "import", "__main__"]
-        for illegal in illegals:
-            if illegal in expression:
-                logger.critical(
-                    "this user attempted to use ACE-like expressions!")
-                assert False, "Your session and IP has been logged."
-
-        parts = re.split(r"(>=|<=|<|>|==|!=)", expr)
-        if len(parts) == 1:
-            assert False, f"expression {n} is invalid: no comparator"
-        elif len(parts) == 5:
-            # first, check that parts 2 & 4 are lt or lte comparators
-            assert (
-                re.fullmatch(r"<=|<", parts[1]) is not None
-                and re.fullmatch(r"<=|<", parts[3]) is not None
-            ), (f"expression {n} is invalid: not a proper 3-part inequality (a < col <= b)"
-                )
-
-            # check middle
-            assert parts[2] in columns, (
-                f"expression {n} is invalid: must be comparing a data column (a < col <= b)"
-            )
-
-            # check a and b & if a < b
-            assert re.match(num_regex, parts[0]) is not None, (
-                f"expression {n} is invalid: must be numeric for numerical data column"
-            )
-            assert float(parts[0]) < float(parts[-1]), (
-                f"expression {n} is invalid: invalid inequality (a > b for a < col < b)"
-            )
-
-            # change the expression to valid format
-            subexpressions[i] = (
-                f"(({parts[0]}{parts[1]}{parts[2]})&({parts[2]}{parts[3]}{parts[4]}))"
-            )
+    """Converts expression to valid filter.
 
-        elif len(parts) == 3:
-            check = (parts[0] in columns, parts[2] in columns)
-            if np.any(check):
-                if check[0]:
-                    col = parts[0]
-                    num = parts[2]
-                elif check[1]:
-                    col = parts[2]
-                    num = parts[0]
-                dtype = str(df[col].dtype)
-                if "float" in dtype or "int" in dtype:
-                    assert re.match(num_regex, num) is not None, (
-                        f"expression {n} is invalid: must be numeric for numerical data column"
-                    )
-            else:
-                assert False, f"expression {n} is invalid: one part must be column"
-            assert re.match(r">=|<=|<|>|==|!=", parts[1]) is not None, (
-                f"expression {n} is invalid: middle is not comparator")
-
-            # change the expression in subexpression
-            subexpressions[i] = "(" + expr + ")"
-        else:
-            assert False, f"expression {n} is invalid: too many comparators"
+    Args:
+        df: dataframe to filter
+        columns: columns allowed in the expression, including virtual columns
+        expression: filter expression, see `util.expressions` for the grammar
+        invert: whether to invert the filter
 
-        # enumerate the expr counter
-        n = n + 1
+    Returns:
+        Filter expression in canonical form.
 
-    # create expression as str
-    expr = "(" + "".join(subexpressions) + ")"
+    Raises:
+        ExpressionError: if the expression is invalid, with the position of the error
+    """
+    expr = compile_expression(expression, columns,
+                              lambda col: df[col].dtype.is_string)
     logger.debug(f"expr final: {expr}")
 
+    zoned = filter_zones(df, expr, invert=invert)
+    if zoned is not None:
+        logger.debug("filtered by zone maps")
+        return zoned
+
     # set filter corresponding to inverts & exit
     if invert:  # NOTE: df will never be None unless something horrible happens
         logger.debug("inverting expression")
@@ -148,6 +232,60 @@ def filter_expression(
         return df[expr]
 
 
+def filter_zones(df: vx.DataFrame,
+                 expression: str,
+                 invert: bool = False) -> vx.Expression | None:
+    """
+    Filters by an expression with the zone maps of the dataframe's file, if worth it
+
+    Zones that can't match are skipped, and zones that wholly match are taken
+    without reading them. The rest are read when the filter is first
+    evaluated, so only classifying zones happens now.
+
+    Args:
+        df: dataframe to filter
+        expression: filter expression of columns of the file
+        invert: whether to invert the filter
+
+    Returns:
+        None: if there are no zone maps, the expression isn't only of mapped columns, or too few rows would be skipped
+        vx.Expression: filter of the matching rows
+    """
+    zonemaps = attached_zonemaps(df)
+    if zonemaps is None:
+        return None
+    try:
+        parsed = parse_expression(expression)
+    except ExpressionError:
+        return None
+    if not parsed.columns <= set(zonemaps.columns):
+        return None  # virtual or unmapped columns
+    classes = zonemaps.classify(parsed.canonical, invert)
+    if zonemaps.scanned(classes) > ZONE_SCAN_FRACTION * zonemaps.nrows:
+        return None
+    # one mask per canonical expression, however often it is applied
+    return filter_rows(df, zonemaps, "evaluate", parsed.canonical, invert)
+
+
+def filter_range(df: vx.DataFrame, column: str, lower: float,
+                 upper: float) -> vx.Expression:
+    """
+    Filters a column to an open range, like the zoom window of a plot
+
+    Args:
+        df: dataframe to filter
+        column: column or virtual column to filter
+        lower: exclusive lower bound
+        upper: exclusive upper bound
+
+    Returns:
+        vx.Expression: filter of rows in the range
+    """
+    expression = f"(({column} > {lower}) & ({column} < {upper}))"
+    zoned = filter_zones(df, expression)
+    return zoned if zoned is not None else df[expression]
+
+
 def filter_carton_mapper(
     df: vx.DataFrame,
     mapping: vx.DataFrame,
@@ -159,6 +297,9 @@ def filter_carton_mapper(
     """
     Filters a list of cartons and mappers
 
+    Uses the carton bitmaps attached to the dataframe if any, see
+    `bitmaps.attach_bitmaps`, and otherwise scans `sdss5_target_flags`.
+
     Based on code written by Andy Casey for github.com/sdss/semaphore
     """
     if len(mapper) != 0 or len(carton) != 0:
@@ -173,9 +314,20 @@ def filter_carton_mapper(
                 mapping["alt_name"].isin(carton).values,
             )
 
-        # determine active bits via mask and get flag_number & offset
-        # NOTE: hardcoded nbits as 8, and nflags as 57
+        # determine active bits via mask
         bits = np.arange(len(mapping))[mask]
+
+        # union of the rows of each bit, if prebuilt for this file
+        bitmaps = attached_bitmaps(df)
+        if bitmaps is not None:
+            return filter_rows(df,
+                               bitmaps,
+                               "mask",
+                               bits.tolist(),
+                               invert=invert)
+
+        # get flag_number & offset
+        # NOTE: hardcoded nbits as 8, and nflags as 57
         num, offset = np.divmod(bits, 8)
         setbits = 57 > num  # ensure bits in flags
 
@@ -197,6 +349,37 @@ def filter_carton_mapper(
         return cmp_filter
 
 
+def filter_rows(df: vx.DataFrame,
+                source: Any,
+                method: str,
+                *args,
+                invert: bool = False) -> vx.Expression:
+    """
+    Filters rows by a mask over the rows of the file the dataframe derives from
+
+    The mask is `getattr(source, method)(*args)`, built when the filter is
+    first evaluated. The filter names it by the source's identity, the method
+    and its arguments rather than holding it as a variable of the dataframe,
+    so replaced filters leave nothing behind on long-lived dataframes. As
+    vaex caches results by the filter, equal filters in any process, or in a
+    later one, also have equal masks.
+
+    Args:
+        df: dataframe to filter, with the row column of `bitmaps.add_row_column`
+        source: sidecar the mask is built from, with an `identity` of its files
+        method: method of the source building the boolean mask over the rows of the file
+        *args: JSON arguments of the method
+        invert: whether to invert the filter
+
+    Returns:
+        vx.Expression: filter of the rows set in the mask
+    """
+    _sources[source.identity] = source
+    key = json.dumps([source.identity, method, args], separators=(",", ":"))
+    expression = df.func.in_bitmap(df[ROW_COLUMN], key)
+    return ~expression if invert else expression
+
+
 def filter_flags(df: vx.DataFrame,
                  flags: list[str],
                  dataset: str,
@@ -212,23 +395,24 @@ def filter_flags(df: vx.DataFrame,
     """
     filters = []
     for flag in flags:
-        # Skip iteration if the subset's dataset is 'best' and the flag is 'Purely non-flagged'
-        if (dataset == "mwmlite") and (flag == "purely non-flagged"):
-            continue
-        # boss-only pipeline exceptions for zwarning_flags filtering
-        elif np.isin(
-                dataset,
-            ("spall", "lineforest"),
-        ) and (flag == "purely non-flagged"):
-            filters.append("zwarning_flags!=0")
-            continue
-        filters.append(flagList[flag])
+        # flags may be skipped or replaced for some datasets
+        expression = registry[flag].expression_for(dataset)
+        if expression is not None:
+            filters.append(expression)
+
+    masks = attached_quickflags(df)
+    if filters and (masks is not None) and masks.covers(filters):
+        logger.debug("flagfilter from quick flag masks")
+        canonical = sorted(
+            {parse_expression(expression).canonical
+             for expression in filters})
+        return filter_rows(df, masks, "mask", canonical, invert)
 
     # Determine the final concatenated filter
     if filters:
         # Join the filters with ")&(" and wrap them in outer parentheses
-        concat_filter = f"(({')&('.join(filters)}))"
-        concat_filter: vx.Expression = df[concat_filter]
+        concat_filter: vx.Expression | None = df[
+            f"(({')&('.join(filters)}))"]
         if invert and (concat_filter is not None):
             logger.debug("inverting flagfilter")
             concat_filter = ~concat_filter
@@ -257,6 +441,8 @@ def filter_crossmatch(df: vx.DataFrame, crossmatch: str,
         AssertionError: if users pass
 
     """
+    if cmtype == POSITION_CMTYPE:
+        return filter_positions(df, crossmatch)
     assert cmtype in crossmatchList.keys(
     ), "unspported crossmatch column passed"
 
@@ -272,6 +458,7 @@ def filter_crossmatch(df: vx.DataFrame, crossmatch: str,
         # for checking our dtype
         col = df[crossmatchList[cmtype]]
         try:
+            identifiers: list[str] | list[int]
             if col.dtype == "string":
                 identifiers = crossmatch.lstrip().rstrip().split("\n")
             else:
@@ -286,3 +473,27 @@ def filter_crossmatch(df: vx.DataFrame, crossmatch: str,
         return col.isin(identifiers)
     else:
         return None
+
+
+def filter_positions(df: vx.DataFrame, crossmatch: str) -> vx.Expression | None:
+    """
+    Generates a filter for rows within a radius of any of a list of positions
+
+    Args:
+        df: dataframe to filter
+        crossmatch: multiline string of positions, as `ra dec [radius]`, see `spatial.parse_positions`
+
+    Returns:
+        None: if nothing parsed to crossmatch
+        vx.Expression: if there is a valid filter
+
+    Raises:
+        ValueError: if positions are malformed
+    """
+    ra, dec, radius = parse_positions(crossmatch)
+    if len(ra) == 0:
+        return None
+    # the cones are indexed, and every row searched against them
+    index = ZoneIndex.build(ra, dec, radius)
+    return df.func.in_cones(df["ra"], df["dec"], index.key, index.dec,
+                            index.radius)
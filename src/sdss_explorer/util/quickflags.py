@@ -0,0 +1,343 @@
+"""Quick flags: named filters for common cuts, and their precomputed masks.
+
+Quick flags are registered by name with a filter expression, and optionally
+with replacements of it for some datasets. Besides the built-in ones, more are
+read from `quickflags.json` in the root of the datapath, without code changes:
+
+    {
+        "snr > 100": "snr>=100",
+        "good teff": {"expression": "teff_flags==0", "datasets": {"spall": null}}
+    }
+
+where a dataset replaced by `null` skips the flag.
+
+Each release/datatype file gets a sidecar of every flag expression evaluated
+over all its rows, packed 8 rows to a byte, built offline with
+`python -m sdss_explorer.util.sidecars`. Applying flags is then an AND of their
+masks, instead of evaluating their expressions.
+"""
+
+import json
+import logging
+import os
+import uuid
+import weakref
+from dataclasses import dataclass, field
+from functools import lru_cache
+
+import numpy as np
+import vaex as vx
+
+from .bitmaps import ROW_COLUMN, file_identity, source_stat
+from .config import settings
+from .expressions import parse_expression
+
+__all__ = [
+    "QuickFlag",
+    "QuickFlagMasks",
+    "registry",
+    "register_quick_flag",
+    "load_quick_flags",
+    "open_quickflags",
+    "attach_quickflags",
+    "attached_quickflags",
+]
+
+logger = logging.getLogger("dashboard")
+
+# file of extra quick flags, in the root of the datapath
+QUICK_FLAGS_FILE = "quickflags.json"
+
+# rows of a file evaluated at once when building; a multiple of 8
+BUILD_CHUNK_SIZE = 1 << 20
+
+# masks by the row column of dataframes derived from their file
+_attached: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+@dataclass(frozen=True)
+class QuickFlag:
+    """A named filter.
+
+    Attributes:
+        name: name shown to users
+        expression: filter expression
+        datasets: replacement expressions for some datasets, `None` to skip the flag
+    """
+
+    name: str
+    expression: str
+    datasets: dict[str, str | None] = field(default_factory=dict)
+
+    def expression_for(self, dataset: str) -> str | None:
+        """Expression of the flag for a dataset, or `None` if it doesn't apply."""
+        return self.datasets.get(dataset, self.expression)
+
+    @property
+    def expressions(self) -> list[str]:
+        """Every expression of the flag, over all datasets."""
+        return [self.expression] + [
+            expression for expression in self.datasets.values()
+            if expression is not None
+        ]
+
+
+# quick flags by name, in the order shown
+registry: dict[str, QuickFlag] = {}
+
+
+def register_quick_flag(
+        name: str,
+        expression: str,
+        datasets: dict[str, str | None] | None = None) -> QuickFlag:
+    """Registers a quick flag, replacing any of the same name.
+
+    Args:
+        name: name shown to users
+        expression: filter expression
+        datasets: replacement expressions for some datasets, `None` to skip the flag
+
+    Raises:
+        ExpressionError: if an expression can't be parsed
+    """
+    flag = QuickFlag(name, expression, dict(datasets or {}))
+    for expression in flag.expressions:
+        parse_expression(expression)
+    registry[name] = flag
+    return flag
+
+
+def load_quick_flags(path: str) -> None:
+    """Registers the quick flags of a JSON file, if it exists.
+
+    Args:
+        path: file of an object of names to an expression, or to an object
+            with `expression` and optionally `datasets`
+    """
+    if not os.path.isfile(path):
+        return
+    try:
+        with open(path) as f:
+            flags = json.load(f)
+        for name, flag in flags.items():
+            if isinstance(flag, str):
+                flag = {"expression": flag}
+            register_quick_flag(name, flag["expression"],
+                                flag.get("datasets"))
+    except Exception as e:
+        logger.warning(f"failed to load quick flags {path}: {e}")
+
+
+# TODO: more quick flags based on scientist input
+register_quick_flag("sdss5 only", "release=='sdss5'")
+register_quick_flag("snr > 50", "snr>=50")
+register_quick_flag(
+    "purely non-flagged",
+    "result_flags==0",
+    datasets={
+        # best has no result_flags
+        "mwmlite": None,
+        # boss-only pipeline exceptions for zwarning_flags filtering
+        "spall": "zwarning_flags!=0",
+        "lineforest": "zwarning_flags!=0",
+    },
+)
+#'no apo 1m': "telescope!='apo1m'", # WARNING: this one doesn't work for some reason, maybe it's not string; haven't checked
+register_quick_flag("no bad flags", "flag_bad==0")
+register_quick_flag("gmag < 17", "g_mag<=17")
+load_quick_flags(os.path.join(settings.datapath, QUICK_FLAGS_FILE))
+
+
+class QuickFlagMasks:
+    """Masks of quick flag expressions over the rows of a data file.
+
+    Rows are packed 8 to a byte, little-endian. Missing values neither match
+    an expression nor its inverse, so each expression has a mask of the rows
+    it matches and one of the rows where it isn't missing.
+
+    Attributes:
+        nrows: number of rows in the file
+        expressions: canonical form of each expression
+        true: packed rows matching each expression
+        known: packed rows where each expression isn't missing
+        source_size: size in bytes of the file the masks were built from
+        source_mtime: modification time in ns of the file the masks were built from
+        identity: the files the masks were opened from, see `bitmaps.file_identity`,
+            or unique to these masks if they weren't
+    """
+
+    def __init__(self,
+                 nrows: int,
+                 expressions: list[str],
+                 true: np.ndarray,
+                 known: np.ndarray,
+                 source_size: int = 0,
+                 source_mtime: int = 0):
+        self.nrows = nrows
+        self.expressions = expressions
+        self.true = true
+        self.known = known
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        self.identity = uuid.uuid4().hex
+        self._index = {
+            expression: i
+            for i, expression in enumerate(expressions)
+        }
+
+    @classmethod
+    def build(cls,
+              df: vx.DataFrame,
+              expressions: list[str],
+              source_size: int = 0,
+              source_mtime: int = 0) -> "QuickFlagMasks":
+        """Evaluates expressions over a file, reading `BUILD_CHUNK_SIZE` rows at once.
+
+        Args:
+            df: dataframe of a whole file, unfiltered
+            expressions: filter expressions of columns of the file
+            source_size: size of the file, to tell when the masks are stale
+            source_mtime: modification time of the file, likewise
+        """
+        nbytes = -(-len(df) // 8)
+        true = np.zeros((len(expressions), nbytes), dtype=np.uint8)
+        known = np.zeros((len(expressions), nbytes), dtype=np.uint8)
+        for i, expression in enumerate(expressions):
+            for start in range(0, len(df), BUILD_CHUNK_SIZE):
+                end = min(start + BUILD_CHUNK_SIZE, len(df))
+                values = df.evaluate(expression,
+                                     start,
+                                     end,
+                                     array_type="numpy")
+                packed = slice(start // 8, -(-end // 8))
+                true[i, packed] = np.packbits(np.ma.filled(values, False),
+                                              bitorder="little")
+                known[i, packed] = np.packbits(~np.ma.getmaskarray(values),
+                                               bitorder="little")
+        return cls(
+            nrows=len(df),
+            expressions=[
+                parse_expression(expression).canonical
+                for expression in expressions
+            ],
+            true=true,
+            known=known,
+            source_size=source_size,
+            source_mtime=source_mtime,
+        )
+
+    def save(self, path: str) -> None:
+        """Saves the masks, replacing any existing file at once."""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f,
+                     nrows=self.nrows,
+                     expressions=np.array(self.expressions, dtype=str),
+                     true=self.true,
+                     known=self.known,
+                     source_size=self.source_size,
+                     source_mtime=self.source_mtime)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "QuickFlagMasks":
+        with np.load(path) as data:
+            return cls(
+                nrows=int(data["nrows"]),
+                expressions=data["expressions"].tolist(),
+                true=data["true"],
+                known=data["known"],
+                source_size=int(data["source_size"]),
+                # built before modification times were kept, so stale
+                source_mtime=int(data.get("source_mtime", 0)),
+            )
+
+    def covers(self, expressions: list[str]) -> bool:
+        """Whether every expression has a mask."""
+        return all(
+            parse_expression(expression).canonical in self._index
+            for expression in expressions)
+
+    def mask(self,
+             expressions: list[str],
+             invert: bool = False) -> np.ndarray:
+        """Rows matching all expressions, or matching the inverse of that.
+
+        Args:
+            expressions: filter expressions, in any equivalent form
+            invert: whether to invert the conjunction
+
+        Returns:
+            Boolean mask over the rows of the file.
+
+        Raises:
+            KeyError: if any expression has no mask, see `covers`
+        """
+        rows = [
+            self._index[parse_expression(expression).canonical]
+            for expression in expressions
+        ]
+        packed = np.bitwise_and.reduce(self.true[rows], axis=0)
+        if invert:
+            packed = np.bitwise_and.reduce(self.known[rows], axis=0) & ~packed
+        return np.unpackbits(packed, count=self.nrows,
+                             bitorder="little").view(bool)
+
+
+def registry_expressions() -> list[str]:
+    """Every expression of the registered quick flags, once each."""
+    expressions: dict[str, str] = {}
+    for flag in registry.values():
+        for expression in flag.expressions:
+            expressions.setdefault(
+                parse_expression(expression).canonical, expression)
+    return list(expressions.values())
+
+
+def sidecar_path(path: str) -> str:
+    """Path of the quick flag masks of a data file."""
+    return f"{os.path.splitext(path)[0]}.quickflags.npz"
+
+
+@lru_cache(maxsize=None)
+def open_quickflags(path: str) -> QuickFlagMasks | None:
+    """Loads the quick flag masks of a data file, once per process.
+
+    Args:
+        path: path of the data file
+
+    Returns:
+        The masks, or `None` if they were not built or are stale.
+    """
+    sidecar = sidecar_path(path)
+    if not os.path.isfile(sidecar):
+        logger.debug(f"no quick flag masks for {path}")
+        return None
+    try:
+        masks = QuickFlagMasks.load(sidecar)
+    except Exception as e:
+        logger.warning(f"failed to load quick flag masks {sidecar}: {e}")
+        return None
+    if (masks.source_size, masks.source_mtime) != source_stat(path):
+        logger.warning(f"quick flag masks {sidecar} are stale, ignoring them")
+        return None
+    masks.identity = file_identity(path, sidecar)
+    return masks
+
+
+def attach_quickflags(df: vx.DataFrame, masks: QuickFlagMasks) -> None:
+    """Attaches quick flag masks to a dataframe derived from their file, and its copies.
+
+    Args:
+        df: dataframe with the row column from `bitmaps.add_row_column`
+        masks: quick flag masks of the file
+    """
+    _attached[df.columns[ROW_COLUMN]] = masks
+
+
+def attached_quickflags(df: vx.DataFrame) -> QuickFlagMasks | None:
+    """Quick flag masks attached to a dataframe, or `None`."""
+    column = df.columns.get(ROW_COLUMN)
+    if column is None:
+        return None
+    return _attached.get(column)
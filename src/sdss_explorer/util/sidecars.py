@@ -0,0 +1,97 @@
+"""Builds and attaches the sidecar indexes of explorer data files.
+
+Sidecars are built offline, next to each data file:
+
+    python -m sdss_explorer.util.sidecars
+    python -m sdss_explorer.util.sidecars --datapath ./home
+    python -m sdss_explorer.util.sidecars ./home/dr19/explorerAllStar-0.6.0.hdf5
+
+Rebuild them whenever a data file changes; sidecars are stale, and ignored,
+once the size or modification time of their data file changes. Copy data
+files with their modification times (`cp -p`, `rsync -t`) to keep sidecars.
+"""
+
+import argparse
+import glob
+import os
+
+import vaex as vx
+
+from . import bitmaps, quickflags, zonemaps
+from .expressions import parse_expression
+from .config import settings
+
+__all__ = ["attach_sidecars", "build_sidecars"]
+
+
+def attach_sidecars(df: vx.DataFrame, path: str) -> None:
+    """Attaches the sidecars of a data file to a dataframe derived from it.
+
+    Args:
+        df: dataframe with the row column from `bitmaps.add_row_column`
+        path: path of the data file
+    """
+    cartons = bitmaps.open_bitmaps(path)
+    if cartons is not None:
+        bitmaps.attach_bitmaps(df, cartons)
+    zones = zonemaps.open_zonemaps(path)
+    if zones is not None:
+        zonemaps.attach_zonemaps(df, zones)
+    masks = quickflags.open_quickflags(path)
+    if masks is not None:
+        quickflags.attach_quickflags(df, masks)
+
+
+def build_sidecars(path: str) -> None:
+    """Builds every sidecar of a data file."""
+    df = vx.open(path)
+    size, mtime = bitmaps.source_stat(path)
+    if bitmaps.TARGET_FLAGS in df.get_column_names():
+        cartons = bitmaps.CartonBitmaps.build(df,
+                                              source_size=size,
+                                              source_mtime=mtime)
+        cartons.save(bitmaps.sidecar_path(path))
+        print(f"{bitmaps.sidecar_path(path)}: {len(cartons.chunks)} containers, "
+              f"{os.path.getsize(bitmaps.sidecar_path(path)) / 1e6:.1f} MB")
+    else:
+        print(f"{path}: no {bitmaps.TARGET_FLAGS}, no carton bitmaps")
+
+    zones = zonemaps.ZoneMaps.build(path)
+    zones.save(zonemaps.sidecar_path(path))
+    print(f"{zonemaps.sidecar_path(path)}: {len(zones.columns)} columns, "
+          f"{zones.nzones} zones")
+
+    # flags of columns other files have are left to scans
+    columns = set(df.get_column_names())
+    expressions = [
+        expression for expression in quickflags.registry_expressions()
+        if parse_expression(expression).columns <= columns
+    ]
+    masks = quickflags.QuickFlagMasks.build(df,
+                                            expressions,
+                                            source_size=size,
+                                            source_mtime=mtime)
+    masks.save(quickflags.sidecar_path(path))
+    print(f"{quickflags.sidecar_path(path)}: {len(expressions)} expressions, "
+          f"{os.path.getsize(quickflags.sidecar_path(path)) / 1e6:.1f} MB")
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="data files. Defaults to every explorerAll file under --datapath.")
+    parser.add_argument("--datapath", default=settings.datapath)
+    args = parser.parse_args(argv)
+
+    files = args.files or sorted(
+        glob.glob(
+            os.path.join(args.datapath, "*",
+                         f"explorerAll*-{settings.vastra}.hdf5")))
+    for path in files:
+        build_sidecars(path)
+
+
+if __name__ == "__main__":
+    main()
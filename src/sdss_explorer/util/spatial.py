@@ -0,0 +1,185 @@
+"""Positional crossmatching by angular distance, with a declination zone index.
+
+The sky is cut into declination zones of `ZONE_HEIGHT` degrees. Points are
+sorted by zone, then right ascension, into one array of keys. A cone then spans
+one contiguous range of keys per zone it overlaps, found by binary search, so
+matching `m` cones against `n` points takes `O(m log n)` plus the candidates.
+"""
+
+import numpy as np
+
+__all__ = [
+    "POSITION_CMTYPE",
+    "DEFAULT_RADIUS",
+    "ZONE_HEIGHT",
+    "ZoneIndex",
+    "parse_positions",
+]
+
+# crossmatch type of positions, as opposed to identifiers
+POSITION_CMTYPE = "position"
+
+# radius in arcseconds of positions given without one
+DEFAULT_RADIUS = 1.0
+
+# height of declination zones in degrees
+ZONE_HEIGHT = 0.1
+
+# offset between keys of consecutive zones; more than any right ascension
+ZONE_STRIDE = 400.0
+
+NZONES = int(np.ceil(180 / ZONE_HEIGHT))
+
+
+def parse_positions(
+        crossmatch: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Parses positions, one `ra dec [radius]` per line.
+
+    Right ascension and declination are in degrees, and the optional radius in
+    arcseconds, defaulting to `DEFAULT_RADIUS`. Values may be separated by
+    whitespace or commas.
+
+    Args:
+        crossmatch: multiline string of positions
+
+    Returns:
+        Right ascensions, declinations and radii, all in degrees.
+
+    Raises:
+        ValueError: if a position is malformed or out of range
+    """
+    lines = [line for line in crossmatch.replace(",", " ").splitlines()
+             if line.strip()]
+    counts = np.fromiter(map(len, map(str.split, lines)), np.int64, len(lines))
+    bad = np.flatnonzero((counts < 2) | (counts > 3))
+    if len(bad):
+        raise ValueError(f"expected 'ra dec [radius]', got '{lines[bad[0]]}'")
+    try:
+        values = np.fromiter(map(float, " ".join(lines).split()), np.float64)
+    except ValueError:
+        raise ValueError("failed to convert positions to numbers")
+    if not np.all(np.isfinite(values)):
+        raise ValueError("positions must be finite")
+    starts = np.cumsum(counts) - counts
+    values = np.append(values, DEFAULT_RADIUS)  # so `starts + 2` is in range
+    ra, dec = values[starts], values[starts + 1]
+    radius = np.where(counts == 3, values[starts + 2], DEFAULT_RADIUS)
+    if np.any(np.abs(dec) > 90):
+        raise ValueError("declinations must be between -90 and 90")
+    if np.any(radius <= 0):
+        raise ValueError("radii must be positive")
+    return ra % 360, dec, radius / 3600
+
+
+def _zone(dec: np.ndarray) -> np.ndarray:
+    return np.clip(np.floor((dec + 90) / ZONE_HEIGHT), 0,
+                   NZONES - 1).astype(np.int64)
+
+
+def _expand(starts: np.ndarray,
+            ends: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Group of each position in ranges `[starts, ends)`, and the positions."""
+    counts = ends - starts
+    groups = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.cumsum(counts) - counts
+    return groups, starts[groups] + np.arange(counts.sum()) - offsets[groups]
+
+
+class ZoneIndex:
+    """Points on the sky sorted by declination zone and right ascension.
+
+    Attributes:
+        key: sorted zone keys, `zone * ZONE_STRIDE + ra`
+        dec: declination of each key, in degrees
+        rows: original position of each key, if sorted by `build`
+        radius: radius of each point in degrees, when the points are cones
+    """
+
+    def __init__(self,
+                 key: np.ndarray,
+                 dec: np.ndarray,
+                 rows: np.ndarray | None = None,
+                 radius: np.ndarray | None = None):
+        self.key = key
+        self.dec = dec
+        self.rows = rows
+        self.radius = radius
+
+    @classmethod
+    def build(cls,
+              ra: np.ndarray,
+              dec: np.ndarray,
+              radius: np.ndarray | None = None) -> "ZoneIndex":
+        """Sorts points into an index. Points with missing coordinates are left out."""
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        rows = np.flatnonzero(np.isfinite(ra) & np.isfinite(dec))
+        key = _zone(dec[rows]) * ZONE_STRIDE + ra[rows] % 360
+        order = np.argsort(key, kind="stable")
+        rows = rows[order].astype(np.int32 if len(ra) < 2**31 else np.int64)
+        return cls(key[order], dec[rows], rows,
+                   None if radius is None else radius[rows])
+
+    def __len__(self) -> int:
+        return len(self.key)
+
+    def search(self, ra: np.ndarray, dec: np.ndarray,
+               radius: np.ndarray | float) -> tuple[np.ndarray, np.ndarray]:
+        """Finds the points within a radius of each position.
+
+        Args:
+            ra: right ascensions of positions, in degrees
+            dec: declinations of positions, in degrees
+            radius: search radius of each position in degrees. If the index
+                holds cones, a pair matches within the cone's radius instead,
+                so this should be at least the largest cone.
+
+        Returns:
+            Pairs of matches, as indices into the index, and of positions.
+        """
+        ra = np.asarray(ra, dtype=np.float64) % 360
+        dec = np.asarray(dec, dtype=np.float64)
+        radius = np.broadcast_to(np.asarray(radius, dtype=np.float64),
+                                 ra.shape)
+        valid = np.flatnonzero(np.isfinite(ra) & np.isfinite(dec))
+
+        # every zone each position overlaps
+        zlo = _zone(dec[valid] - radius[valid])
+        zhi = _zone(dec[valid] + radius[valid])
+        groups, zones = _expand(zlo, zhi + 1)
+        query = valid[groups]
+
+        # half-width in right ascension, all of it near the poles
+        r = np.radians(radius[query])
+        ratio = np.sin(r) / np.maximum(np.cos(np.radians(dec[query])), 1e-12)
+        polar = (ratio >= 1) | (np.abs(dec[query]) + radius[query] >= 90)
+        dra = np.where(polar, 180.0,
+                       np.degrees(np.arcsin(np.minimum(ratio, 1))))
+        lo = np.where(polar, 0.0, ra[query] - dra)
+        hi = np.where(polar, 360.0, ra[query] + dra)
+
+        # split ranges wrapping around 0 or 360
+        under = np.flatnonzero(lo < 0)
+        over = np.flatnonzero(hi > 360)
+        zones = np.concatenate([zones, zones[under], zones[over]])
+        query = np.concatenate([query, query[under], query[over]])
+        lo = np.concatenate([np.maximum(lo, 0), lo[under] + 360,
+                             np.zeros(len(over))])
+        hi = np.concatenate([np.minimum(hi, 360),
+                             np.full(len(under), 360.0), hi[over] - 360])
+
+        starts = np.searchsorted(self.key, zones * ZONE_STRIDE + lo, "left")
+        ends = np.searchsorted(self.key, zones * ZONE_STRIDE + hi, "right")
+        groups, points = _expand(starts, ends)
+        query = query[groups]
+
+        # exact check of candidates, by haversine
+        key = np.asarray(self.key[points])
+        pra = np.radians(key - np.floor(key / ZONE_STRIDE) * ZONE_STRIDE)
+        pdec = np.radians(np.asarray(self.dec[points]))
+        qra, qdec = np.radians(ra[query]), np.radians(dec[query])
+        hav = (np.sin((pdec - qdec) / 2)**2 +
+               np.cos(pdec) * np.cos(qdec) * np.sin((pra - qra) / 2)**2)
+        limit = radius[query] if self.radius is None else self.radius[points]
+        keep = hav <= np.sin(np.radians(limit) / 2)**2
+        return points[keep], query[keep]
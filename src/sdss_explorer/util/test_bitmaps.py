@@ -0,0 +1,155 @@
+"""Tests for carton bitmaps."""
+
+import os
+
+import numpy as np
+import pytest
+import vaex as vx
+
+from . import bitmaps as bitmaps_module
+from .bitmaps import (
+    CartonBitmaps,
+    add_row_column,
+    attach_bitmaps,
+    open_bitmaps,
+    sidecar_path,
+    source_stat,
+)
+from . import filters as filters_module
+from .filters import check_flags_packed, filter_carton_mapper
+
+NFLAGS = 57  # as hardcoded by the scan in `filter_carton_mapper`
+
+
+@pytest.fixture
+def flags():
+    rng = np.random.default_rng(0)
+    n = 3 * bitmaps_module.CONTAINER_SIZE + 123
+    flags = np.zeros((n, NFLAGS), dtype=np.uint8)
+    flags[:, 0] = rng.integers(0, 256, n)  # dense bits
+    flags[:, 1] = np.where(rng.random(n) < 0.001, 1 << 3, 0)  # sparse bit
+    flags[:70000, 2] = 1  # dense in the first container, sparse in the second
+    return flags
+
+
+@pytest.fixture
+def mapping():
+    nbits = NFLAGS * 8
+    return vx.from_arrays(
+        mapper=np.array(["mwm", "bhm"] * (nbits // 2)),
+        alt_name=np.array([f"carton_{i}" for i in range(nbits)]),
+    )
+
+
+def test_bitmaps_match_flags(flags):
+    df = vx.from_arrays(sdss5_target_flags=flags)
+    bitmaps = CartonBitmaps.build(df)
+    assert bitmaps.dense.any() and not bitmaps.dense.all()
+    bits = np.unpackbits(flags, axis=1, bitorder="little").astype(bool)
+    for selection in ([0], [11], [16], [3, 11, 16], [16, 455], [], [999]):
+        expected = bits[:, [b for b in selection if b < 8 * NFLAGS]].any(axis=1)
+        assert np.array_equal(bitmaps.mask(selection), expected), selection
+
+
+def test_filter_carton_mapper(flags, mapping, tmp_path):
+    path = str(tmp_path / "explorerAllStar.hdf5")
+    vx.from_arrays(sdss5_target_flags=flags,
+                   x=np.arange(len(flags))).export_hdf5(path)
+    assert open_bitmaps(path) is None
+    open_bitmaps.cache_clear()
+
+    size, mtime = source_stat(path)
+    bitmaps = CartonBitmaps.build(vx.open(path),
+                                  source_size=size,
+                                  source_mtime=mtime)
+    bitmaps.save(sidecar_path(path))
+    opened = open_bitmaps(path)
+    assert opened is not None
+
+    def derive():
+        # a shuffled, filtered dataframe, as in the dashboard and server
+        df = vx.open(path)
+        add_row_column(df)
+        dff = df.shuffle(random_state=42)
+        return dff[dff.x % 3 == 0].extract()
+
+    dff, scanned = derive(), derive()
+    attach_bitmaps(dff, opened)
+    for carton, mapper, invert in [
+        (["carton_1", "carton_11"], [], False),
+        ([], ["bhm"], True),
+        (["carton_16", "carton_2"], ["mwm"], False),
+    ]:
+        expected = filter_carton_mapper(scanned, mapping, carton, mapper,
+                                        invert=invert)
+        copy = dff.copy()  # bitmaps are shared by copies
+        f = filter_carton_mapper(copy, mapping, carton, mapper, invert=invert)
+        assert "in_bitmap" in str(f) and "check_flags" in str(expected)
+        assert np.array_equal(copy.evaluate(f), scanned.evaluate(expected))
+
+
+def test_filter_rows_bounded(flags, mapping, monkeypatch):
+    monkeypatch.setattr(filters_module, "MASK_CACHE_SIZE", 2)
+    df = vx.from_arrays(sdss5_target_flags=flags)
+    add_row_column(df)
+    attach_bitmaps(df, CartonBitmaps.build(df))
+    variables = len(df.variables)
+    bits = np.unpackbits(flags, axis=1, bitorder="little").astype(bool)
+    # a long-lived dataframe, as in the dashboard
+    for i in list(range(8)) * 2:
+        f = filter_carton_mapper(df, mapping, [f"carton_{i}"], [])
+        assert df[f].count() == bits[:, i].sum()
+    assert len(df.variables) == variables
+    assert len(filters_module._masks) <= 2
+
+    # masks of filters still in use are rebuilt once evicted
+    first = filter_carton_mapper(df, mapping, ["carton_0"], [])
+    for i in range(1, 4):
+        df.evaluate(filter_carton_mapper(df, mapping, [f"carton_{i}"], []))
+    assert np.array_equal(df.evaluate(first), bits[:, 0])
+
+
+
+def test_filter_rows_stable(flags, mapping, tmp_path):
+    # vaex caches results by filter, on disk too, so a filter must mean the
+    # same mask in every process
+    path = str(tmp_path / "explorerAllStar.hdf5")
+    vx.from_arrays(sdss5_target_flags=flags).export_hdf5(path)
+    size, mtime = source_stat(path)
+    CartonBitmaps.build(vx.open(path), source_size=size,
+                        source_mtime=mtime).save(sidecar_path(path))
+
+    def filters(cartons):
+        open_bitmaps.cache_clear()  # as in a new process
+        filters_module._masks.clear()
+        df = vx.open(path)
+        add_row_column(df)
+        bitmaps = open_bitmaps(path)
+        assert bitmaps is not None
+        attach_bitmaps(df, bitmaps)
+        return {
+            carton: str(filter_carton_mapper(df, mapping, [carton], []))
+            for carton in cartons
+        }
+
+    first = filters(["carton_0", "carton_1"])
+    assert first == filters(["carton_1", "carton_0"])
+    assert first["carton_0"] != first["carton_1"]
+
+    # a rebuilt file of the same size has stale bitmaps
+    os.utime(path, ns=(mtime, mtime + 10**9))
+    open_bitmaps.cache_clear()
+    assert open_bitmaps(path) is None
+
+@pytest.mark.parametrize("width", [57, 64, 12])
+def test_check_flags_packed(width):
+    rng = np.random.default_rng(width)
+    # odd length, and offset from the start of the buffer, like a chunk
+    flags = rng.integers(0, 256, (1003, width), dtype=np.uint8)[2:]
+    flags[rng.random(flags.shape) < 0.9] = 0
+    for nbytes in (0, 1, 5, width):
+        filters = np.zeros(width, dtype=np.uint8)
+        filters[rng.choice(width, nbytes, replace=False)] = rng.integers(
+            1, 256, nbytes)
+        expected = np.bitwise_and(flags, filters).any(axis=1)
+        assert np.array_equal(check_flags_packed(flags, filters), expected)
@@ -0,0 +1,109 @@
+"""Tests for the filter expression parser."""
+
+import numpy as np
+import pytest
+import vaex as vx
+
+from . import expressions
+from .expressions import ExpressionError, parse_expression
+from .filters import filter_expression
+
+
+@pytest.fixture
+def df():
+    df = vx.from_arrays(
+        teff=np.array([4000.0, 5500.0, 6000.0, 7000.0]),
+        logg=np.array([1.0, 4.5, 3.0, 4.0]),
+        telescope=np.array(["apo25m", "lco25m", "apo1m", "apo25m"]),
+    )
+    df["teff_k"] = df.teff / 1000  # virtual column
+    return df
+
+
+def canonical(expression):
+    return parse_expression(expression).canonical
+
+
+def test_canonical_form():
+    assert canonical("teff > 5000") == "((teff>5000))"
+    # literals on the right, integral floats as integers
+    assert canonical("5000.0 < teff") == canonical("teff>5e3")
+    # operands of & and | are sorted, flattened and deduplicated
+    assert canonical("(a<1 & b>2) & a<1") == canonical("b>2&a<1")
+    assert canonical("a<1 | b>2 & c==3") == "((a<1)|((b>2)&(c==3)))"
+    assert canonical("(a<1 | b>2) & c==3") == "(((a<1)|(b>2))&(c==3))"
+    assert canonical("1 < a <= 2") == canonical("a <= 2 & a > 1")
+    assert canonical("2 >= a > 1") == canonical("1 < a <= 2")
+    assert canonical("s == 'x'") == canonical('s=="x"')
+    # integers stay exact beyond float precision
+    assert canonical("id == 6917528997577384321") == (
+        "((id==6917528997577384321))")
+    assert canonical("id < 6.917528997577384321e18") == (
+        "((id<6.917528997577384e+18))")
+
+
+@pytest.mark.parametrize(
+    "expression,position",
+    [
+        ("teff > ", 7),  # nothing to compare to
+        ("teff 5000", 5),  # no comparator
+        ("5 < 6", 0),  # no column
+        ("(teff > 5000", 12),  # unclosed
+        ("teff > 5000 &", 13),  # nothing after &
+        ("teff > 5000 | eval('x')", 18),  # no calls
+        ("1 < teff > 2", 9),  # mixed directions
+        ("3 < teff < 2", 0),  # empty range
+        ("teff > 5000 $", 12),  # unknown character
+    ],
+)
+def test_syntax_errors(expression, position):
+    with pytest.raises(ExpressionError) as error:
+        parse_expression(expression)
+    assert error.value.position == position
+
+
+def test_filter_expression(df):
+    columns = df.get_column_names()
+    f = filter_expression(df, columns, "5000 < teff <= 6000 | logg < 2")
+    assert df[f].teff.tolist() == [4000, 5500, 6000]
+    f = filter_expression(df, columns, "teff_k > 5 & telescope == 'apo25m'")
+    assert df[f].teff.tolist() == [7000]
+    f = filter_expression(df, columns, "teff > 5000", invert=True)
+    assert df[f].teff.tolist() == [4000]
+
+    with pytest.raises(ExpressionError) as error:
+        filter_expression(df, columns, "teff > 5000 & feh < 0")
+    assert error.value.position == 14
+    with pytest.raises(ExpressionError):
+        filter_expression(df, columns, "telescope == 5")
+    with pytest.raises(ExpressionError):
+        filter_expression(df, columns, "teff > 'hot'")
+
+
+def test_large_integers():
+    ids = np.array([2**62 + 1, 2**62 + 2, 2**62 + 3], dtype=np.int64)
+    df = vx.from_arrays(id=ids)
+    f = filter_expression(df, ["id"], f"id == {2**62 + 2}")
+    assert df[f].id.tolist() == [2**62 + 2]
+    f = filter_expression(df, ["id"], f"{2**62 + 1} < id <= {2**62 + 3}")
+    assert df[f].id.tolist() == [2**62 + 2, 2**62 + 3]
+
+
+def test_validation_cached(df, monkeypatch):
+    monkeypatch.setattr(expressions, "_validated", expressions.OrderedDict())
+    columns = df.get_column_names()
+    checked = []
+
+    def is_string(col):
+        checked.append(col)
+        return df[col].dtype.is_string
+
+    expressions.compile_expression("teff > 5000 & logg < 3", columns,
+                                   is_string)
+    # equivalent expressions are validated once
+    expressions.compile_expression("logg<3&5000<teff", columns, is_string)
+    assert sorted(checked) == ["logg", "teff"]
+    # but again for other columns
+    expressions.compile_expression("teff > 5000 & logg < 3", columns[:2],
+                                   is_string)
+    assert len(checked) == 4
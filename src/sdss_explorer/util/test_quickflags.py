@@ -0,0 +1,152 @@
+"""Tests for quick flags and their masks."""
+
+import json
+import os
+
+import numpy as np
+import pyarrow as pa
+import pytest
+import vaex as vx
+
+from . import quickflags
+from .bitmaps import add_row_column, materialize_row_column
+from .filters import filter_flags
+from .quickflags import (
+    attach_quickflags,
+    load_quick_flags,
+    open_quickflags,
+    register_quick_flag,
+    sidecar_path,
+)
+from .sidecars import build_sidecars
+
+
+@pytest.fixture
+def registry():
+    saved = dict(quickflags.registry)
+    yield quickflags.registry
+    quickflags.registry.clear()
+    quickflags.registry.update(saved)
+
+
+@pytest.fixture
+def path(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 1001  # not a multiple of 8
+    snr = rng.uniform(0, 100, n).astype(np.float32)
+    snr[::17] = np.nan
+    release = np.where(rng.random(n) < 0.7, "sdss5", "dr17").astype(object)
+    release[::13] = None
+    path = str(tmp_path / "explorerAllStar.hdf5")
+    vx.from_arrays(
+        id=np.arange(n),
+        pipeline=np.array(["aspcap", "spall", "mwmlite"])[rng.integers(0, 3,
+                                                                        n)],
+        release=pa.array(release, type=pa.string()),
+        snr=snr,
+        result_flags=np.ma.array(rng.integers(0, 2, n),
+                                 mask=rng.random(n) < 0.1),
+        zwarning_flags=rng.integers(0, 2, n),
+        flag_bad=rng.random(n) < 0.2,
+        g_mag=rng.uniform(10, 20, n).astype(np.float32),
+    ).export_hdf5(path)
+    return path
+
+
+def load(path, dataset):
+    df = vx.open(path)
+    add_row_column(df)
+    dff = df[df[f"pipeline == '{dataset}'"]].extract()
+    materialize_row_column(dff)
+    return dff
+
+
+def test_load_quick_flags(registry, tmp_path):
+    assert registry["purely non-flagged"].expression_for("mwmlite") is None
+    assert registry["purely non-flagged"].expression_for(
+        "spall") == "zwarning_flags!=0"
+    path = str(tmp_path / "quickflags.json")
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "snr > 100": "snr>=100",
+                "good teff": {
+                    "expression": "teff_flags==0",
+                    "datasets": {
+                        "spall": None
+                    }
+                },
+            }, f)
+    load_quick_flags(path)
+    assert registry["snr > 100"].expression_for("aspcap") == "snr>=100"
+    assert registry["good teff"].expression_for("spall") is None
+    # registration order is display order
+    assert list(registry)[-2:] == ["snr > 100", "good teff"]
+
+    with open(path, "w") as f:
+        json.dump({"bad": "snr >> 3"}, f)
+    load_quick_flags(path)
+    assert "bad" not in registry
+
+
+@pytest.mark.parametrize("dataset", ["aspcap", "spall", "mwmlite"])
+@pytest.mark.parametrize("invert", [False, True])
+def test_filter_flags(path, registry, dataset, invert):
+    build_sidecars(path)
+    masks = open_quickflags(path)
+    assert masks is not None
+    register_quick_flag("faint", "g_mag > 18")  # not in the sidecar
+
+    dff, scanned = load(path, dataset), load(path, dataset)
+    attach_quickflags(dff, masks)
+    for flags in (
+        ["purely non-flagged"],
+        ["sdss5 only", "snr > 50"],
+        list(registry)[:5],
+        ["snr > 50", "faint"],
+    ):
+        expected = filter_flags(scanned, flags, dataset, invert=invert)
+        copy = dff.copy()  # masks are shared by copies
+        f = filter_flags(copy, flags, dataset, invert=invert)
+        if expected is None:  # nothing applies to the dataset
+            assert f is None
+            continue
+        assert ("in_bitmap" in str(f)) == ("faint" not in flags)
+        # rows of missing values match neither a filter nor its inverse
+        assert copy[f].id.tolist() == scanned[expected].id.tolist()
+
+
+def test_stale(path):
+    build_sidecars(path)
+    assert open_quickflags(path) is not None
+    with open(path, "ab") as f:
+        f.write(b"\0")
+    open_quickflags.cache_clear()
+    assert open_quickflags(path) is None
+    assert sidecar_path(path).endswith(".quickflags.npz")
+
+    # or rebuilt with the same size
+    build_sidecars(path)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    open_quickflags.cache_clear()
+    assert open_quickflags(path) is None
+
+
+def test_filters_stable(path, registry):
+    # vaex caches results by filter, so a filter must mean the same mask in
+    # every process, whatever the order of the flags
+    build_sidecars(path)
+
+    def filters(flags):
+        open_quickflags.cache_clear()  # as in a new process
+        dff = load(path, "aspcap")
+        masks = open_quickflags(path)
+        assert masks is not None
+        attach_quickflags(dff, masks)
+        return str(filter_flags(dff, flags, "aspcap"))
+
+    first = filters(["sdss5 only", "snr > 50"])
+    assert "in_bitmap" in first
+    assert filters(["snr > 50", "sdss5 only"]) == first
+    assert filters(["snr > 50"]) != first
@@ -0,0 +1,167 @@
+"""Tests for zone maps."""
+
+import os
+
+import numpy as np
+import pytest
+import vaex as vx
+
+from . import zonemaps as zonemaps_module
+from .bitmaps import add_row_column, materialize_row_column
+from .filters import filter_expression, filter_range, filter_zones
+from .zonemaps import (
+    ALL,
+    NONE,
+    SOME,
+    ZoneMaps,
+    attach_zonemaps,
+    open_zonemaps,
+    sidecar_path,
+)
+
+ZONE_SIZE = zonemaps_module.ZONE_SIZE
+
+
+@pytest.fixture
+def path(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 4 * ZONE_SIZE + 99
+    teff = rng.normal(5000, 500, n)
+    teff[ZONE_SIZE:2 * ZONE_SIZE] = np.nan  # a zone of missing values
+    teff[3 * ZONE_SIZE + 7] = np.nan
+    path = str(tmp_path / "explorerAllStar.hdf5")
+    vx.from_arrays(
+        sdss_id=np.arange(n) + 10,  # clustered
+        teff=teff,
+        flags=np.ma.array(rng.integers(0, 3, n), mask=rng.random(n) < 0.1),
+        pipeline=np.array(["aspcap", "astra"] * (n // 2) + ["aspcap"] *
+                          (n % 2)),
+    ).export_hdf5(path)
+    ZoneMaps.build(path).save(sidecar_path(path))
+    open_zonemaps.cache_clear()
+    return path
+
+
+def load(path):
+    # as `server.dataframe.load_dataframe`
+    df = vx.open(path)
+    add_row_column(df)
+    dff = df[df["pipeline == 'aspcap'"]].extract()
+    materialize_row_column(dff)
+    dff["teff_k"] = dff.teff / 1000  # virtual column
+    return dff
+
+
+def opened(path) -> ZoneMaps:
+    zonemaps = open_zonemaps(path)
+    assert zonemaps is not None
+    return zonemaps
+
+
+def test_classify(path):
+    zonemaps = opened(path)
+    assert zonemaps.columns == ["sdss_id", "teff", "flags"]
+    assert zonemaps.classify("sdss_id < 100").tolist() == [SOME] + [NONE] * 4
+    assert zonemaps.classify("sdss_id >= 0").tolist() == [ALL] * 5
+    assert zonemaps.classify("sdss_id >= 0", invert=True).tolist() == [NONE] * 5
+    # missing values never match, even inverted
+    classes = zonemaps.classify("teff > -1e9")
+    assert classes.tolist() == [ALL, NONE, ALL, SOME, ALL]
+    assert zonemaps.classify("teff > -1e9", invert=True).tolist() == [
+        NONE, SOME, NONE, SOME, NONE
+    ]
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "sdss_id < 1000",
+        "sdss_id <= 70000 | sdss_id == 200000",
+        "sdss_id > 250000 & teff > 5500",
+        "1000 < sdss_id <= 140000",
+        "sdss_id != 1000",
+        "teff > 5000",
+        "teff < 3000",
+        "teff == 3000 | sdss_id < 100",
+        "flags == 0 & sdss_id < 1000",
+        "sdss_id < 1000 | flags != 1",
+    ],
+)
+@pytest.mark.parametrize("invert", [False, True])
+def test_filter_expression(path, expression, invert):
+    dff = load(path)
+    columns = dff.get_column_names()
+    expected = filter_expression(dff, columns, expression, invert)
+    expected = dff[expected].sdss_id.tolist()
+    attach_zonemaps(dff, opened(path))
+    copy = dff.copy()  # zone maps are shared by copies
+    f = filter_expression(copy, columns, expression, invert)
+    # rows of missing values match neither a filter nor its inverse
+    assert copy[f].sdss_id.tolist() == expected
+
+
+def test_lazy(path, monkeypatch):
+    dff = load(path)
+    zonemaps = opened(path)
+    attach_zonemaps(dff, zonemaps)
+    built = []
+    evaluate = zonemaps.evaluate
+
+    def counted(*args):
+        built.append(args)
+        return evaluate(*args)
+
+    monkeypatch.setattr(zonemaps, "evaluate", counted)
+    # about a third of the file is read, which is more than a third of the extract
+    f = filter_zones(dff, "sdss_id > 180000")
+    assert f is not None and not built
+    # the mask is built when the filter is used, once per canonical expression
+    g = filter_zones(dff, "180000 < sdss_id")
+    assert dff[f].count() == dff[g].count() == dff["sdss_id > 180000"].sum()
+    assert len(built) == 1
+
+
+def test_fallback(path):
+    dff = load(path)
+    attach_zonemaps(dff, opened(path))
+    assert filter_zones(dff, "sdss_id < 1000") is not None
+    # nothing to skip, virtual columns, or not parsed
+    assert filter_zones(dff, "teff > 5000") is None
+    assert filter_zones(dff, "teff_k < 3") is None
+    assert filter_zones(dff, "sqrt(teff) < 3") is None
+    # but ranges fall back to scans
+    f = filter_range(dff, "teff_k", 4, 5)
+    assert np.array_equal(dff.evaluate(f),
+                          dff.evaluate("(teff_k > 4) & (teff_k < 5)"))
+
+    # stale zone maps are ignored
+    with open(path, "ab") as f:
+        f.write(b"\0")
+    open_zonemaps.cache_clear()
+    assert open_zonemaps(path) is None
+    assert os.path.isfile(sidecar_path(path))
+
+
+def test_stale_same_size(path):
+    # a file rebuilt with the same size
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert open_zonemaps(path) is None
+
+
+def test_filters_stable(path):
+    # vaex caches results by filter, so a filter must mean the same mask in
+    # every process
+    def filters():
+        open_zonemaps.cache_clear()  # as in a new process
+        dff = load(path)
+        attach_zonemaps(dff, opened(path))
+        return [
+            str(filter_zones(dff, "sdss_id < 1000")),
+            str(filter_zones(dff, "sdss_id > 180000", invert=True)),
+            str(filter_range(dff, "sdss_id", 100, 2000)),
+        ]
+
+    first = filters()
+    assert "in_bitmap" in first[2] and len(set(first)) == 3
+    assert filters() == first
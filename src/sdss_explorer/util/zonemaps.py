@@ -0,0 +1,341 @@
+"""Zone maps of data files: the range of each numeric column per chunk of rows.
+
+Each release/datatype file gets a sidecar with the minimum, maximum and number
+of missing values of every numeric column, per `ZONE_SIZE` consecutive rows,
+built offline with `python -m sdss_explorer.util.sidecars`.
+
+A filter expression is classified against them chunk by chunk, as matching no
+rows, all rows, or some. Only chunks of the last kind are read and evaluated,
+so cuts on columns clustered in the file, like identifiers or the columns of
+one pipeline in a stacked file, skip most of it.
+"""
+
+import logging
+import operator
+import os
+import uuid
+import weakref
+from functools import lru_cache, reduce
+
+import numpy as np
+import vaex as vx
+
+from .bitmaps import ROW_COLUMN, file_identity, source_stat
+from .expressions import Comparison, parse_expression
+
+__all__ = [
+    "ZONE_SIZE",
+    "ZoneMaps",
+    "open_zonemaps",
+    "attach_zonemaps",
+    "attached_zonemaps",
+]
+
+logger = logging.getLogger("dashboard")
+
+# rows per zone; the same as the containers of carton bitmaps
+ZONE_SIZE = 1 << 16
+
+# rows of a column read at once when building
+BUILD_CHUNK_SIZE = 16 * ZONE_SIZE
+
+# classes of zones against a filter; `&` takes the least, `|` the greatest
+NONE, SOME, ALL = 0, 1, 2
+
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+# zone maps by the row column of dataframes derived from their file
+_attached: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _chunk_stats(values) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Minimum, maximum and missing count of each zone of a block of values."""
+    if hasattr(values, "to_numpy"):  # arrow, with nulls as nan
+        values = values.to_numpy(zero_copy_only=False)
+    values = np.ma.filled(np.ma.asarray(values).astype(np.float64), np.nan)
+    starts = np.arange(0, len(values), ZONE_SIZE)
+    missing = np.isnan(values)
+    with np.errstate(invalid="ignore"):
+        mins = np.fmin.reduceat(values, starts)
+        maxs = np.fmax.reduceat(values, starts)
+    # widen by an ulp, for integers beyond float precision
+    return (np.nextafter(mins, -np.inf), np.nextafter(maxs, np.inf),
+            np.add.reduceat(missing, starts))
+
+
+class ZoneMaps:
+    """Per-zone ranges of the numeric columns of a data file.
+
+    Attributes:
+        path: path of the data file
+        nrows: number of rows in the file
+        columns: names of the mapped columns
+        mins: minimum of each column in each zone, `nan` if all are missing
+        maxs: maximum of each column in each zone, `nan` if all are missing
+        nulls: number of missing (null or `nan`) values of each column in each zone
+        source_size: size in bytes of the file the zone maps were built from
+        source_mtime: modification time in ns of the file the zone maps were built from
+        identity: the files the zone maps were opened from, see `bitmaps.file_identity`,
+            or unique to these zone maps if they weren't
+    """
+
+    def __init__(self,
+                 path: str,
+                 nrows: int,
+                 columns: list[str],
+                 mins: np.ndarray,
+                 maxs: np.ndarray,
+                 nulls: np.ndarray,
+                 source_size: int = 0,
+                 source_mtime: int = 0):
+        self.path = path
+        self.nrows = nrows
+        self.columns = columns
+        self.mins = mins
+        self.maxs = maxs
+        self.nulls = nulls
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+        self.identity = uuid.uuid4().hex
+        self._index = {column: i for i, column in enumerate(columns)}
+        self._source = None
+
+    @property
+    def nzones(self) -> int:
+        return -(-self.nrows // ZONE_SIZE)
+
+    @property
+    def sizes(self) -> np.ndarray:
+        """Number of rows in each zone."""
+        sizes = np.full(self.nzones, ZONE_SIZE)
+        if self.nzones:
+            sizes[-1] = self.nrows - (self.nzones - 1) * ZONE_SIZE
+        return sizes
+
+    @classmethod
+    def build(cls, path: str) -> "ZoneMaps":
+        """Builds zone maps of every 1-D numeric column of a data file."""
+        df = vx.open(path)
+        columns = [
+            col for col in df.get_column_names()
+            if (len(df[col].shape) == 1) and df.data_type(col).is_numeric
+        ]
+        stats: dict[str, list[tuple[np.ndarray, np.ndarray, np.ndarray]]] = {
+            col: []
+            for col in columns
+        }
+        for start in range(0, len(df), BUILD_CHUNK_SIZE):
+            end = min(start + BUILD_CHUNK_SIZE, len(df))
+            for col in columns:
+                stats[col].append(_chunk_stats(df.evaluate(col, start, end)))
+
+        def stack(i):
+            return np.array([
+                np.concatenate([block[i] for block in stats[col]])
+                for col in columns
+            ]).reshape(len(columns), -1)
+
+        return cls(path, len(df), columns, stack(0), stack(1),
+                   stack(2).astype(np.int64), *source_stat(path))
+
+    def save(self, path: str) -> None:
+        """Saves the zone maps, replacing any existing file at once."""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f,
+                     nrows=self.nrows,
+                     columns=np.array(self.columns, dtype=str),
+                     mins=self.mins,
+                     maxs=self.maxs,
+                     nulls=self.nulls,
+                     source_size=self.source_size,
+                     source_mtime=self.source_mtime)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str, source: str) -> "ZoneMaps":
+        """Loads zone maps saved at `path`, of the data file `source`."""
+        with np.load(path) as data:
+            return cls(source, int(data["nrows"]), data["columns"].tolist(),
+                       data["mins"], data["maxs"], data["nulls"],
+                       int(data["source_size"]),
+                       int(data.get("source_mtime", 0)))
+
+    def source(self) -> vx.DataFrame:
+        """The whole data file, in file order, opened once."""
+        if self._source is None:
+            self._source = vx.open(self.path)
+        return self._source
+
+    def _compare(self, comparison: Comparison) -> np.ndarray:
+        """Classes of zones against one comparison."""
+        some = np.full(self.nzones, SOME, dtype=np.int8)
+        column = self._index.get(comparison.left.value)
+        if (column is None) or (comparison.right.kind != "number"):
+            return some
+        v = comparison.right.number
+        lo, hi = self.mins[column], self.maxs[column]
+        complete = self.nulls[column] == 0
+        empty = self.nulls[column] == self.sizes
+        with np.errstate(invalid="ignore"):
+            none, every = {
+                "<": (lo >= v, hi < v),
+                "<=": (lo > v, hi <= v),
+                ">": (hi <= v, lo > v),
+                ">=": (hi < v, lo >= v),
+                "==": ((lo > v) | (hi < v), np.zeros(self.nzones, bool)),
+                # nan != v, so missing values match
+                "!=": (np.zeros(self.nzones, bool), (lo > v) | (hi < v)),
+            }[comparison.comparator]
+        if comparison.comparator != "!=":
+            none = none | empty
+        every = every & complete
+        some[none] = NONE
+        some[every] = ALL
+        return some
+
+    def _missing(self, columns: frozenset[str]) -> np.ndarray:
+        """Whether each zone may have missing values in any of the columns."""
+        missing = np.zeros(self.nzones, dtype=bool)
+        for column in columns:
+            i = self._index.get(column)
+            if i is None:
+                return np.ones(self.nzones, dtype=bool)
+            missing |= self.nulls[i] > 0
+        return missing
+
+    def classify(self, expression: str, invert: bool = False) -> np.ndarray:
+        """Classifies zones as matching none, some or all of their rows.
+
+        Args:
+            expression: filter expression, see `util.expressions`
+            invert: whether the filter is inverted
+
+        Returns:
+            `NONE`, `SOME` or `ALL` of each zone.
+        """
+        parsed = parse_expression(expression)
+
+        def classify(node) -> np.ndarray:
+            if isinstance(node, Comparison):
+                return self._compare(node)
+            classes = [classify(term) for term in node.terms]
+            reduce = np.minimum if node.operator == "&" else np.maximum
+            return reduce.reduce(classes)
+
+        classes = classify(parsed.tree)
+        if invert:
+            # inverting missing values gives missing values, which don't match
+            inverted = ALL - classes
+            inverted[(classes == NONE) & self._missing(parsed.columns)] = SOME
+            return inverted
+        return classes
+
+    def _read(self, column: str, start: int, end: int) -> np.ndarray:
+        """Values of a column of the file, as a numpy or masked array."""
+        return vx.array_types.to_numpy(self.source().columns[column][start:end])
+
+    def evaluate(self, expression: str, invert: bool = False) -> np.ndarray:
+        """Evaluates a filter over the file, reading only zones it may partly match.
+
+        Note:
+            Columns are read and compared with numpy, as vaex would, but without
+            vaex, so this can run while vaex evaluates a filter using the mask.
+
+        Args:
+            expression: filter expression of mapped columns
+            invert: whether to invert the filter
+
+        Returns:
+            Boolean mask over the rows of the file.
+        """
+        parsed = parse_expression(expression)
+        classes = self.classify(expression, invert)
+        mask = np.repeat(classes == ALL, self.sizes)
+
+        def evaluate(node, values: dict[str, np.ndarray]) -> np.ndarray:
+            if isinstance(node, Comparison):
+                right = (values[node.right.value] if node.right.kind == "name"
+                         else node.right.number)
+                return OPERATORS[node.comparator](values[node.left.value],
+                                                  right)
+            combine = operator.and_ if node.operator == "&" else operator.or_
+            return reduce(combine,
+                          [evaluate(term, values) for term in node.terms])
+
+        # runs of consecutive partial zones, read at once
+        some = np.concatenate([[False], classes == SOME, [False]])
+        edges = np.flatnonzero(np.diff(some.astype(np.int8)))
+        for first, last in zip(edges[::2], edges[1::2]):
+            start = first * ZONE_SIZE
+            end = min(last * ZONE_SIZE, self.nrows)
+            values = {
+                column: self._read(column, start, end)
+                for column in parsed.columns
+            }
+            with np.errstate(invalid="ignore"):
+                matched = evaluate(parsed.tree, values)
+            # missing values stay missing when inverted, and never match
+            mask[start:end] = np.ma.filled(~matched if invert else matched,
+                                           False)
+        return mask
+
+    def scanned(self, classes: np.ndarray) -> int:
+        """Number of rows read to evaluate a filter with these classes."""
+        return int(self.sizes[classes == SOME].sum())
+
+
+def sidecar_path(path: str) -> str:
+    """Path of the zone maps of a data file."""
+    return f"{os.path.splitext(path)[0]}.zonemaps.npz"
+
+
+@lru_cache(maxsize=None)
+def open_zonemaps(path: str) -> ZoneMaps | None:
+    """Loads the zone maps of a data file, once per process.
+
+    Args:
+        path: path of the data file
+
+    Returns:
+        The zone maps, or `None` if they were not built or are stale.
+    """
+    sidecar = sidecar_path(path)
+    if not os.path.isfile(sidecar):
+        logger.debug(f"no zone maps for {path}")
+        return None
+    try:
+        zonemaps = ZoneMaps.load(sidecar, path)
+    except Exception as e:
+        logger.warning(f"failed to load zone maps {sidecar}: {e}")
+        return None
+    if (zonemaps.source_size, zonemaps.source_mtime) != source_stat(path):
+        logger.warning(f"zone maps {sidecar} are stale, ignoring them")
+        return None
+    zonemaps.identity = file_identity(path, sidecar)
+    return zonemaps
+
+
+def attach_zonemaps(df: vx.DataFrame, zonemaps: ZoneMaps) -> None:
+    """Attaches zone maps to a dataframe derived from their file, and its copies.
+
+    Args:
+        df: dataframe with the row column from `bitmaps.add_row_column`
+        zonemaps: zone maps of the file
+    """
+    _attached[df.columns[ROW_COLUMN]] = zonemaps
+
+
+def attached_zonemaps(df: vx.DataFrame) -> ZoneMaps | None:
+    """Zone maps attached to a dataframe, or `None`."""
+    column = df.columns.get(ROW_COLUMN)
+    if column is None:
+        return None
+    return _attached.get(column)